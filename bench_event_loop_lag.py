@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержки цикла событий при подготовке фото к запросу в Gemini
+
+Одновременно готовит N фото (Pillow, base64, JSON тела запроса) двумя
+способами: прямо в цикле событий и через offloader (пул потоков и,
+с --processes, пул процессов). Во время работы LoopLagMonitor замеряет,
+насколько цикл событий опаздывает с обработкой других задач.
+
+Запуск:
+    python bench_event_loop_lag.py [--photos N] [--processes N]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench_image_preprocessing import make_synthetic_photo
+from services.image_preprocessor import ImagePreprocessor, encode_base64, transform_image
+from services.loop_monitor import LoopLagMonitor
+from services.offload import Offloader
+
+PROMPT = "Проанализируй изображение еды."
+
+
+def build_body(b64_data: str, mime_type: str) -> bytes:
+    payload = {"contents": [{"parts": [
+        {"text": PROMPT},
+        {"inline_data": {"mime_type": mime_type, "data": b64_data}},
+    ]}]}
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+async def prepare_inline(preprocessor: ImagePreprocessor, data: bytes) -> int:
+    """Как было: все синхронно в цикле событий"""
+    processed = preprocessor.process_bytes(data)
+    return len(build_body(encode_base64(processed["data"]), processed["mime_type"]))
+
+
+async def prepare_offloaded(preprocessor: ImagePreprocessor, offloader: Offloader, data: bytes) -> int:
+    """Как в GeminiService: Pillow в пуле процессов/потоков, base64 и JSON в пуле потоков"""
+    processed = await offloader.run_in_process(
+        transform_image, data, preprocessor.max_side, preprocessor.quality, preprocessor.output_format)
+    b64_data = await offloader.run_in_thread(encode_base64, processed["data"])
+    body = await offloader.run_in_thread(build_body, b64_data, processed["mime_type"])
+    return len(body)
+
+
+async def measure(name: str, make_task, photos):
+    monitor = LoopLagMonitor(interval=0.005, warn_seconds=float("inf"), enabled=True)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await asyncio.gather(*(make_task(data) for data in photos))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+    stats = monitor.get_stats()
+    print(f"{name:<26}{elapsed:>9.2f}{stats['lag_p50'] * 1000:>10.1f}{stats['lag_p95'] * 1000:>10.1f}"
+          f"{stats['max_lag'] * 1000:>10.1f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=8, help="сколько фото готовить одновременно")
+    parser.add_argument("--threads", type=int, default=4, help="потоков в пуле")
+    parser.add_argument("--processes", type=int, default=0, help="процессов для Pillow (0 - в потоках)")
+    args = parser.parse_args()
+
+    preprocessor = ImagePreprocessor(enabled=True)
+    photos = [make_synthetic_photo(3024, 4032, seed) for seed in range(args.photos)]
+    offloader = Offloader(thread_workers=args.threads, process_workers=args.processes)
+
+    print("🧪 Задержка цикла событий при подготовке фото")
+    print(f"Фото: {args.photos} x 3024x4032, потоков: {args.threads}, процессов: {args.processes}")
+    print("=" * 66)
+    print(f"{'Режим':<26}{'Время, с':>9}{'p50, мс':>10}{'p95, мс':>10}{'max, мс':>10}")
+
+    await measure("в цикле событий", lambda data: prepare_inline(preprocessor, data), photos)
+    await measure("offloader", lambda data: prepare_offloaded(preprocessor, offloader, data), photos)
+    offloader.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
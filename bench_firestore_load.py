@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест доступа к Firestore при росте числа одновременных пользователей
+
+Каждый пользователь присылает апдейт, обработка которого делает столько же
+запросов к Firestore, сколько обработчик фото: чтение пользователя, запись
+пользователя, сохранение анализа. Клиент Firestore имитируется синхронными
+вызовами с сетевой задержкой (time.sleep), как у firebase_admin. Сравниваются
+два способа: запросы прямо в цикле событий (как было) и через
+FirestoreExecutor. Для каждого числа пользователей выводится время обработки
+апдейта (p50/p95) и задержка цикла событий - насколько опаздывают все
+остальные апдейты.
+
+Запуск:
+    python bench_firestore_load.py [--users 1,10,50,100] [--latency 0.05] [--workers 16]
+"""
+import argparse
+import asyncio
+import time
+
+from services.firestore_executor import FirestoreExecutor
+from services.gemini_retry import LatencyTracker
+from services.loop_monitor import LoopLagMonitor
+
+
+class FakeDocument:
+    """Документ синхронного клиента: каждый вызов - сетевой запрос"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def get(self):
+        time.sleep(self.latency)
+        return {'user_id': 1}
+
+    def set(self, data, merge=False):
+        time.sleep(self.latency)
+
+
+async def update_inline(document: FakeDocument):
+    """Как было: синхронные запросы в цикле событий"""
+    document.get()
+    document.set({'last_activity': time.time()}, merge=True)
+    document.set({'analysis_text': '...'})
+
+
+async def update_offloaded(document: FakeDocument, executor: FirestoreExecutor):
+    """Как в FirebaseService: запросы через firestore_executor"""
+    await executor.run('get_user_info', document.get)
+    await executor.run('create_or_update_user', document.set, {'last_activity': time.time()}, merge=True)
+    await executor.run('save_analysis', document.set, {'analysis_text': '...'})
+
+
+async def measure(name: str, users: int, handle_update):
+    monitor = LoopLagMonitor(interval=0.005, warn_seconds=float("inf"), enabled=True)
+    latencies = LatencyTracker(window=users)
+    monitor.start()
+    await asyncio.sleep(0.02)
+
+    async def one_update(arrived: float):
+        await handle_update()
+        latencies.record(time.perf_counter() - arrived)
+
+    # Все апдейты приходят одновременно; время считается от прихода, а не от начала обработки
+    arrived = time.perf_counter()
+    await asyncio.gather(*(one_update(arrived) for _ in range(users)))
+    await asyncio.sleep(0.02)
+    await monitor.stop()
+    lag = monitor.get_stats()
+    print(f"{name:<18}{users:>8}{latencies.percentile(50) * 1000:>10.0f}{latencies.percentile(95) * 1000:>10.0f}"
+          f"{lag['lag_p95'] * 1000:>12.1f}{lag['max_lag'] * 1000:>12.1f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="1,10,50,100", help="числа одновременных пользователей через запятую")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка одного запроса к Firestore, с")
+    parser.add_argument("--workers", type=int, default=16, help="потоков в пуле FirestoreExecutor")
+    args = parser.parse_args()
+
+    levels = [int(value) for value in args.users.split(",")]
+    document = FakeDocument(args.latency)
+    executor = FirestoreExecutor(max_workers=args.workers, timeout=60)
+
+    print("🧪 Время обработки апдейта при одновременных пользователях")
+    print(f"Запросов к Firestore на апдейт: 3, задержка запроса: {args.latency * 1000:.0f} мс, "
+          f"потоков: {args.workers}")
+    print("=" * 70)
+    print(f"{'Режим':<18}{'Польз.':>8}{'p50, мс':>10}{'p95, мс':>10}{'лаг p95, мс':>12}{'лаг max, мс':>12}")
+
+    for users in levels:
+        await measure("в цикле событий", users, lambda: update_inline(document))
+        await measure("firestore_executor", users, lambda: update_offloaded(document, executor))
+    executor.shutdown()
+
+    print("\nВ цикле событий апдейты выполняются по очереди: время растет с числом пользователей,")
+    print("и цикл событий занят все это время. Через пул время остается на уровне 3 запросов, пока")
+    print("пользователей не больше потоков; дальше запросы ждут в очереди пула, а цикл событий свободен.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк предобработки фото перед отправкой в Gemini
+
+Сравнивает размер тела запроса и время подготовки с предобработкой и без нее.
+С флагом --live дополнительно отправляет запросы в Gemini и сравнивает
+время ответа и количество входных токенов (нужен GEMINI_API_KEY).
+
+Запуск:
+    python bench_image_preprocessing.py [--live] [путь_к_фото ...]
+"""
+import asyncio
+import base64
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from services.image_preprocessor import ImagePreprocessor
+
+ITERATIONS = 5
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+PROMPT = "Перечисли продукты на фото и оцени калорийность. Ответь кратко."
+
+
+def make_synthetic_photo(width: int, height: int, seed: int) -> bytes:
+    """Создает JPEG, похожий на фото с камеры телефона (шум, градиенты, качество 95)"""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (rng.randint(150, 255), rng.randint(120, 220), rng.randint(80, 200)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        r = rng.randint(width // 30, width // 6)
+        color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.effect_noise((width, height), 25).convert("RGB")
+    image = Image.blend(image, noise, 0.15)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def load_samples(paths):
+    """Загружает фото из аргументов или генерирует синтетические"""
+    if paths:
+        samples = []
+        for path in paths:
+            with open(path, "rb") as f:
+                samples.append((os.path.basename(path), f.read()))
+        return samples
+    return [
+        ("synthetic_1280x1280", make_synthetic_photo(1280, 1280, 1)),
+        ("synthetic_2560x1920", make_synthetic_photo(2560, 1920, 2)),
+        ("synthetic_4032x3024", make_synthetic_photo(4032, 3024, 3)),
+    ]
+
+
+def measure_local(preprocessor: ImagePreprocessor, data: bytes):
+    """Замеряет время подготовки и размер base64 с предобработкой и без"""
+    raw_times, processed_times = [], []
+    raw_b64 = processed_b64 = ""
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        raw_b64 = base64.b64encode(data).decode("utf-8")
+        raw_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        processed = preprocessor.process_bytes(data)
+        processed_b64 = base64.b64encode(processed["data"]).decode("utf-8")
+        processed_times.append(time.perf_counter() - start)
+
+    return {
+        "raw_ms": statistics.median(raw_times) * 1000,
+        "processed_ms": statistics.median(processed_times) * 1000,
+        "raw_b64": raw_b64,
+        "processed_b64": processed_b64,
+        "mime_type": processed["mime_type"],
+    }
+
+
+async def measure_live(session, api_key: str, b64_data: str, mime_type: str):
+    """Отправляет запрос в Gemini и возвращает (время, входные токены)"""
+    import aiohttp
+    payload = {
+        "contents": [{"parts": [
+            {"text": PROMPT},
+            {"inline_data": {"mime_type": mime_type, "data": b64_data}},
+        ]}]
+    }
+    headers = {"Content-Type": "application/json", "X-goog-api-key": api_key}
+    start = time.perf_counter()
+    async with session.post(GEMINI_URL, headers=headers, json=payload,
+                            timeout=aiohttp.ClientTimeout(total=60)) as response:
+        result = await response.json()
+    elapsed = time.perf_counter() - start
+    tokens = result.get("usageMetadata", {}).get("promptTokenCount", 0)
+    return elapsed, tokens
+
+
+async def main():
+    args = sys.argv[1:]
+    live = "--live" in args
+    paths = [a for a in args if a != "--live"]
+
+    preprocessor = ImagePreprocessor(enabled=True)
+    samples = load_samples(paths)
+
+    print("🧪 Бенчмарк предобработки изображений")
+    print(f"Параметры: max_side={preprocessor.max_side}, quality={preprocessor.quality}, "
+          f"format={preprocessor.output_format}")
+    print("=" * 78)
+    print(f"{'Фото':<24}{'Исходный b64':>14}{'После':>12}{'Экономия':>10}{'t без, мс':>10}{'t с, мс':>10}")
+
+    results = []
+    for name, data in samples:
+        local = measure_local(preprocessor, data)
+        raw_len, processed_len = len(local["raw_b64"]), len(local["processed_b64"])
+        saved_percent = (1 - processed_len / raw_len) * 100 if raw_len else 0
+        print(f"{name:<24}{raw_len / 1024:>11.0f} KB{processed_len / 1024:>9.0f} KB"
+              f"{saved_percent:>9.0f}%{local['raw_ms']:>10.1f}{local['processed_ms']:>10.1f}")
+        results.append((name, data, local))
+
+    if not live:
+        print("\n💡 Добавьте --live, чтобы сравнить время ответа Gemini и входные токены")
+        return
+
+    from config import GEMINI_API_KEY
+    if not GEMINI_API_KEY:
+        print("❌ GEMINI_API_KEY не настроен, live-замер пропущен")
+        return
+
+    import aiohttp
+    print("\n🌐 Live-замер Gemini API")
+    print(f"{'Фото':<24}{'t без, с':>10}{'t с, с':>10}{'токены без':>12}{'токены с':>10}")
+    async with aiohttp.ClientSession() as session:
+        for name, data, local in results:
+            raw_time, raw_tokens = await measure_live(
+                session, GEMINI_API_KEY, local["raw_b64"], ImagePreprocessor.detect_mime_type(data))
+            processed_time, processed_tokens = await measure_live(
+                session, GEMINI_API_KEY, local["processed_b64"], local["mime_type"])
+            print(f"{name:<24}{raw_time:>10.2f}{processed_time:>10.2f}{raw_tokens:>12}{processed_tokens:>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
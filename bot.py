@@ -9,6 +9,14 @@ from handlers import register_handlers
 from config import BOT_TOKEN, TEMP_DIR
 from utils import setup_logging, clean_temp_files
 from services.scheduler_service import SchedulerService
+from services.http_session import http_session_manager
+from services.offload import offloader
+from services.loop_monitor import loop_lag_monitor
+from services.firestore_executor import firestore_executor
+from services.analysis_router import analysis_router
+from services.photo_store import photo_store
+from services.user_cache import user_document_cache
+from services.media_group import media_group_collector
 
 # Настройка логирования
 setup_logging()
@@ -38,6 +46,18 @@ async def setup_bot_commands(bot: Bot):
     except Exception as e:
         logger.error(f"Ошибка настройки команд меню: {e}")
 
+def collect_stats() -> dict:
+    """Метрики всех подсистем бота: маршрутизация анализа, пулы, Firestore, кэши"""
+    return {
+        'analysis': analysis_router.get_stats(),
+        'photo_store': photo_store.get_stats(),
+        'offload': offloader.get_stats(),
+        'event_loop': loop_lag_monitor.get_stats(),
+        'firestore': firestore_executor.get_stats(),
+        'user_cache': user_document_cache.get_stats(),
+        'media_groups': media_group_collector.get_stats(),
+    }
+
 async def main():
     # Проверяем наличие токена
     if not BOT_TOKEN:
@@ -53,6 +73,13 @@ async def main():
     # Регистрируем очистку при завершении
     atexit.register(lambda: clean_temp_files(TEMP_DIR))
     
+    # Создаем общий пул HTTP соединений к Gemini и прогреваем его
+    await http_session_manager.start()
+    await http_session_manager.warmup()
+    
+    # Замер задержки цикла событий (кодирование фото и JSON вынесены в пулы offloader)
+    loop_lag_monitor.start()
+    
     # Инициализируем бота и диспетчер
     bot = Bot(token=BOT_TOKEN)
     storage = MemoryStorage()
@@ -78,8 +105,13 @@ async def main():
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally:
+        logger.info(f"Статистика работы: {collect_stats()}")
         # Останавливаем планировщик
         scheduler.stop_scheduler()
+        await loop_lag_monitor.stop()
+        offloader.shutdown()
+        firestore_executor.shutdown()
+        await http_session_manager.close()
         await bot.session.close()
         logger.info("Бот остановлен")
 
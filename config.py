@@ -3,11 +3,105 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def _parse_model_map(value: str) -> dict:
+    """Разбирает строку вида "correct_analysis:gemini-2.0-flash-lite,analyze_food/lite:..." в словарь"""
+    result = {}
+    for item in value.split(","):
+        if ":" in item:
+            key, model = item.split(":", 1)
+            if key.strip() and model.strip():
+                result[key.strip()] = model.strip()
+    return result
+
+def _parse_tier_map(value: str) -> dict:
+    """Разбирает строку вида "pro:6,trial:4,lite:1" в словарь"""
+    result = {}
+    for item in value.split(","):
+        if ":" in item:
+            key, number = item.split(":", 1)
+            result[key.strip()] = float(number)
+    return result
+
 # Telegram Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # Google Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+
+# Пул ключей Gemini: "ключ" или "ключ@модель" через запятую (по умолчанию - GEMINI_API_KEY)
+GEMINI_API_KEYS = [key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip()]
+# Лимиты одного ключа в минуту и карантин ключа после 429 без Retry-After
+GEMINI_KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "60"))
+GEMINI_KEY_TPM = int(os.getenv("GEMINI_KEY_TPM", "1000000"))
+GEMINI_KEY_QUARANTINE_SECONDS = float(os.getenv("GEMINI_KEY_QUARANTINE_SECONDS", "60"))
+
+# Модели по операциям и тарифам: "операция:модель" или "операция/тариф:модель".
+# Операции: analyze_food, analyze_food_auto_weight, correct_analysis, recommendations, locate_dishes
+GEMINI_MODEL_TIERS = _parse_model_map(os.getenv("GEMINI_MODEL_TIERS", ""))
+# Повтор на GEMINI_MODEL, если ответ более дешевой модели не прошел проверку
+GEMINI_MODEL_ESCALATION = os.getenv("GEMINI_MODEL_ESCALATION", "true").lower() == "true"
+
+# Пул HTTP соединений к Gemini API
+GEMINI_HTTP_POOL_LIMIT = int(os.getenv("GEMINI_HTTP_POOL_LIMIT", "100"))
+GEMINI_HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("GEMINI_HTTP_POOL_LIMIT_PER_HOST", "20"))
+GEMINI_HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("GEMINI_HTTP_KEEPALIVE_TIMEOUT", "60"))
+GEMINI_HTTP_DNS_TTL = int(os.getenv("GEMINI_HTTP_DNS_TTL", "300"))
+
+# Очередь запросов к Gemini с приоритетом по тарифам
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_QUEUE_WEIGHTS = {k: int(v) for k, v in _parse_tier_map(os.getenv("GEMINI_QUEUE_WEIGHTS", "pro:6,trial:4,lite:1")).items()}
+GEMINI_QUEUE_TIMEOUTS = _parse_tier_map(os.getenv("GEMINI_QUEUE_TIMEOUTS", "pro:25,trial:25,lite:10"))
+
+# Повторы и хеджирование запросов к Gemini
+GEMINI_REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "30"))
+GEMINI_TOTAL_DEADLINE = float(os.getenv("GEMINI_TOTAL_DEADLINE", "45"))
+GEMINI_RETRY_MAX_ATTEMPTS = int(os.getenv("GEMINI_RETRY_MAX_ATTEMPTS", "3"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8"))
+GEMINI_HEDGING_ENABLED = os.getenv("GEMINI_HEDGING_ENABLED", "false").lower() == "true"
+GEMINI_HEDGING_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGING_MIN_SAMPLES", "20"))
+
+# Бэкенды анализа в порядке переключения и circuit breaker для каждого
+ANALYSIS_BACKENDS = [b.strip() for b in os.getenv("ANALYSIS_BACKENDS", "main,vpn,direct,openai").split(",") if b.strip()]
+CIRCUIT_BREAKER_WINDOW = int(os.getenv("CIRCUIT_BREAKER_WINDOW", "20"))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "5"))
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "0.5"))
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", "20"))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_CALLS", "1"))
+
+# Структурированный ответ Gemini (JSON по схеме) вместо свободного текста
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "true").lower() == "true"
+
+# Потоковый ответ Gemini с обновлением сообщения в Telegram
+GEMINI_STREAMING_ENABLED = os.getenv("GEMINI_STREAMING_ENABLED", "true").lower() == "true"
+TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.5"))
+
+# Упреждающий анализ фото, пока пользователь вводит вес
+SPECULATIVE_ANALYSIS_ENABLED = os.getenv("SPECULATIVE_ANALYSIS_ENABLED", "true").lower() == "true"
+# Во сколько раз введенный вес может отличаться от оценки модели для локального пересчета
+SPECULATIVE_MAX_RESCALE_RATIO = float(os.getenv("SPECULATIVE_MAX_RESCALE_RATIO", "2.0"))
+SPECULATIVE_TTL_SECONDS = int(os.getenv("SPECULATIVE_TTL_SECONDS", "600"))
+
+# Мульти-тарелка: поиск блюд на фото, затем параллельный анализ каждого
+MULTI_DISH_SPLIT_ENABLED = os.getenv("MULTI_DISH_SPLIT_ENABLED", "true").lower() == "true"
+MULTI_DISH_MAX_DISHES = int(os.getenv("MULTI_DISH_MAX_DISHES", "6"))
+# Поле вокруг рамки блюда (доля ее стороны)
+MULTI_DISH_CROP_PADDING = float(os.getenv("MULTI_DISH_CROP_PADDING", "0.08"))
+
+# Альбом из нескольких фото: сколько ждать остальные фото альбома и сколько анализировать
+MEDIA_GROUP_WINDOW_SECONDS = float(os.getenv("MEDIA_GROUP_WINDOW_SECONDS", "1.0"))
+MEDIA_GROUP_MAX_PHOTOS = int(os.getenv("MEDIA_GROUP_MAX_PHOTOS", "10"))
+
+# Выбор провайдера анализа по задержке, ошибкам и стоимости
+ANALYSIS_PROVIDER_COSTS = _parse_tier_map(os.getenv("ANALYSIS_PROVIDER_COSTS", "main:1,direct:1,vpn:1,openai:5"))
+ANALYSIS_PROVIDER_DAILY_BUDGETS = _parse_tier_map(os.getenv("ANALYSIS_PROVIDER_DAILY_BUDGETS", "openai:200"))
+ANALYSIS_ROUTER_DEFAULT_LATENCY = float(os.getenv("ANALYSIS_ROUTER_DEFAULT_LATENCY", "10"))
+ANALYSIS_ROUTER_EWMA_ALPHA = float(os.getenv("ANALYSIS_ROUTER_EWMA_ALPHA", "0.2"))
+ANALYSIS_ROUTER_ERROR_PENALTY = float(os.getenv("ANALYSIS_ROUTER_ERROR_PENALTY", "4"))
+ANALYSIS_ROUTER_COST_WEIGHT = float(os.getenv("ANALYSIS_ROUTER_COST_WEIGHT", "0.5"))
 
 # OpenAI API (deprecated)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -20,6 +114,51 @@ GOOGLE_OAUTH_REDIRECT_BASE = os.getenv("GOOGLE_OAUTH_REDIRECT_BASE", "https://ca
 
 # Firebase
 FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH", "caloriesbot-949dd-firebase-adminsdk-fbsvc-4ecc1b1ad9.json")
+# Запросы к Firestore вне цикла событий: потоков в пуле и тайм-аут одного запроса в секундах
+FIRESTORE_WORKERS = int(os.getenv("FIRESTORE_WORKERS", "16"))
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_TIMEOUT_SECONDS", "10"))
+# Кэш документов пользователей: записи бота обновляют его сразу, чужие изменения видны через TTL
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "true").lower() == "true"
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "5000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+# Фоновый пересчет неполных сводок дня: одновременных пересчетов и максимум ожидающих (на экземпляр FirebaseService)
+DAILY_ROLLUP_REBUILD_CONCURRENCY = int(os.getenv("DAILY_ROLLUP_REBUILD_CONCURRENCY", "2"))
+DAILY_ROLLUP_REBUILD_QUEUE = int(os.getenv("DAILY_ROLLUP_REBUILD_QUEUE", "100"))
+
+# Предобработка фото перед отправкой в Gemini
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG")
+# Сначала анализ уменьшенной копии фото, полное разрешение - только при низкой уверенности
+IMAGE_ADAPTIVE_RESOLUTION = os.getenv("IMAGE_ADAPTIVE_RESOLUTION", "true").lower() == "true"
+IMAGE_LOW_RES_SIDE = int(os.getenv("IMAGE_LOW_RES_SIDE", "512"))
+IMAGE_LOW_RES_MIN_CONFIDENCE = float(os.getenv("IMAGE_LOW_RES_MIN_CONFIDENCE", "0.7"))
+
+# Кэш результатов анализа фото
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_MAX_SIZE = int(os.getenv("ANALYSIS_CACHE_MAX_SIZE", "1000"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", str(6 * 3600)))
+ANALYSIS_CACHE_HASH_DISTANCE = int(os.getenv("ANALYSIS_CACHE_HASH_DISTANCE", "2"))
+
+# Кэш исправлений анализа
+CORRECTION_CACHE_ENABLED = os.getenv("CORRECTION_CACHE_ENABLED", "true").lower() == "true"
+CORRECTION_CACHE_MAX_SIZE = int(os.getenv("CORRECTION_CACHE_MAX_SIZE", "500"))
+CORRECTION_CACHE_TTL_SECONDS = int(os.getenv("CORRECTION_CACHE_TTL_SECONDS", "1800"))
+
+# Вынос кодирования фото и JSON из цикла событий: потоки и процессы для Pillow (0 - в потоках)
+OFFLOAD_THREAD_WORKERS = int(os.getenv("OFFLOAD_THREAD_WORKERS", "4"))
+OFFLOAD_PROCESS_WORKERS = int(os.getenv("OFFLOAD_PROCESS_WORKERS", "0"))
+# Замер задержки цикла событий
+LOOP_LAG_MONITOR_ENABLED = os.getenv("LOOP_LAG_MONITOR_ENABLED", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", "0.1"))
+
+# Буфер фото пользователей в памяти (вместо временных файлов)
+PHOTO_STORE_MAX_BYTES = int(os.getenv("PHOTO_STORE_MAX_BYTES", str(200 * 1024 * 1024)))
+PHOTO_STORE_MAX_PHOTO_BYTES = int(os.getenv("PHOTO_STORE_MAX_PHOTO_BYTES", str(20 * 1024 * 1024)))
+PHOTO_STORE_MAX_PER_USER = int(os.getenv("PHOTO_STORE_MAX_PER_USER", "10"))
+PHOTO_STORE_TTL_SECONDS = int(os.getenv("PHOTO_STORE_TTL_SECONDS", "1800"))
 
 # Temporary files directory
 TEMP_DIR = "temp_photos"
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Сводки дня users/{id}/daily/{date}: заполнение и проверка
+
+backfill - пересчитывает сводки по анализам для всех дней с анализами.
+Нужно один раз после появления сводок: сводка дня, созданная первым новым
+анализом, не включает анализы этого дня, сохраненные раньше, а дни без
+сводки до пересчета считаются по анализам при каждом чтении.
+check - сравнивает сводки с пересчетом по анализам и выводит расхождения;
+с --fix пересчитывает расходящиеся сводки.
+
+Пересчет идет в транзакции, поэтому инструмент можно запускать при
+работающем боте.
+
+Запуск:
+    python daily_rollups.py backfill [--user ID] [--since YYYY-MM-DD]
+    python daily_rollups.py check [--user ID] [--since YYYY-MM-DD] [--fix]
+"""
+import argparse
+import asyncio
+
+from services.firebase_service import FirebaseService
+from services.firestore_executor import firestore_executor
+
+
+async def user_dates(firebase: FirebaseService, user_id: int, since: str):
+    return [date for date in await firebase.get_analysis_dates(user_id) if not since or date >= since]
+
+
+async def backfill(firebase: FirebaseService, user_ids, since: str):
+    days = 0
+    for user_id in user_ids:
+        for date in await user_dates(firebase, user_id, since):
+            totals = await firebase.rebuild_daily_rollup(user_id, date)
+            days += 1
+            print(f"✅ {user_id} {date}: {totals['meals']} анализов, {round(totals['calories'])} ккал")
+    print(f"\nПересчитано сводок: {days}")
+
+
+async def check(firebase: FirebaseService, user_ids, since: str, fix: bool):
+    days = 0
+    broken = 0
+    for user_id in user_ids:
+        for date in await user_dates(firebase, user_id, since):
+            days += 1
+            differences = await firebase.check_daily_rollup(user_id, date)
+            if not differences:
+                continue
+            broken += 1
+            print(f"❌ {user_id} {date}: {'; '.join(differences)}")
+            if fix:
+                await firebase.rebuild_daily_rollup(user_id, date)
+                print("   пересчитано")
+    print(f"\nПроверено сводок: {days}, с расхождениями: {broken}")
+    return broken
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["backfill", "check"])
+    parser.add_argument("--user", type=int, help="только этот пользователь")
+    parser.add_argument("--since", help="только дни начиная с YYYY-MM-DD")
+    parser.add_argument("--fix", action="store_true", help="check: пересчитать сводки с расхождениями")
+    args = parser.parse_args()
+
+    firebase = FirebaseService()
+    user_ids = [args.user] if args.user else await firebase.get_all_users()
+    try:
+        if args.command == "backfill":
+            await backfill(firebase, user_ids, args.since)
+        else:
+            broken = await check(firebase, user_ids, args.since, args.fix)
+            if broken and not args.fix:
+                raise SystemExit(1)
+    finally:
+        firestore_executor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,28 @@
-import os
+import asyncio
 import logging
 from datetime import datetime
+from typing import List, Optional
 from aiogram import Router, F
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from services.gemini_service import GeminiService
+from config import MEDIA_GROUP_MAX_PHOTOS
+from services.analysis_router import analysis_router
+from services.progress_message import ProgressMessage
+from services.speculative_analysis import speculative_analysis
+from services.multi_dish import multi_dish_analyzer
+from services.media_group import media_group_collector
+from services.local_correction import local_correction_engine
+from services.photo_store import photo_store, PhotoTooLargeError
 from services.google_calendar import GoogleCalendarService
 from services.analysis_storage import analysis_storage
 from services.firebase_service import FirebaseService
+from services.user_context import UserDocumentMiddleware
 from services.subscription_service import SubscriptionService
 from services.personal_goals_service import PersonalGoalsService
 from services.export_service import ExportService
-from config import TEMP_DIR
+from services.gemini_errors import GeminiServiceError, GeminiQueueTimeoutError
 from utils import error_handler, format_nutrition_info, extract_meal_title
 
 logger = logging.getLogger(__name__)
@@ -58,7 +67,6 @@ async def get_calendar_connect_keyboard(user_id: int):
         return None
 
 # Инициализируем сервисы
-gemini_service = GeminiService()
 calendar_service = GoogleCalendarService()
 firebase_service = FirebaseService()
 subscription_service = SubscriptionService()
@@ -68,6 +76,63 @@ export_service = ExportService()
 # Создаем роутер
 router = Router()
 
+QUEUE_BUSY_LITE_TEASER = "\n\n🌟 В Pro запросы обрабатываются в приоритетной очереди: /pro"
+
+async def answer_gemini_error(message: Message, error: GeminiServiceError, queue_tier: str,
+                              progress: Optional[ProgressMessage] = None):
+    """Сообщает пользователю, что анализ не удался (ошибка не сохраняется как анализ)"""
+    text = error.user_message
+    if isinstance(error, GeminiQueueTimeoutError) and queue_tier == 'lite':
+        text += QUEUE_BUSY_LITE_TEASER
+    if progress:
+        # Заменяем заглушку, чтобы не оставлять в чате незаконченный анализ
+        await progress.finish(text, parse_mode=None)
+    else:
+        await message.answer(text)
+
+async def show_photo_limit_paywall(message: Message, user_id: int):
+    """Пейволл при исчерпанном дневном лимите фото"""
+    # Получаем информацию о текущем использовании
+    subscription = await subscription_service.get_user_subscription(user_id)
+    daily_count = subscription.get('daily_photo_count', 0)
+    
+    # Показываем пейволл с более дружелюбным сообщением
+    from handlers_payments import show_paywall
+    await show_paywall(
+        message,
+        title="📸 Дневной лимит исчерпан",
+        description=f"😊 Вы уже проанализировали {daily_count} фото сегодня!\n\n⏰ Лимит сбросится завтра в 00:00\n\n🌟 **Pro** снимет все ограничения:",
+        features=[
+            "• До 200 фото в месяц",
+            "• Мульти-тарелка (несколько блюд)",
+            "• Детальные витамины и советы", 
+            "• Экспорт в PDF/CSV",
+            "• Google Calendar интеграция"
+        ]
+    )
+
+async def save_user_info(message: Message):
+    """Сохраняет/обновляет информацию о пользователе"""
+    await firebase_service.create_or_update_user(
+        user_id=message.from_user.id,
+        username=message.from_user.username,
+        first_name=message.from_user.first_name,
+        last_name=message.from_user.last_name
+    )
+
+async def download_photo(message: Message) -> Optional[bytes]:
+    """Скачивает фото с максимальным разрешением в память (без временного файла); None - фото слишком большое"""
+    photo = message.photo[-1]
+    if photo.file_size and photo.file_size > photo_store.max_photo_bytes:
+        return None
+    file_info = await message.bot.get_file(photo.file_id)
+    buffer = photo_store.new_buffer()
+    try:
+        await message.bot.download_file(file_info.file_path, destination=buffer)
+    except PhotoTooLargeError:
+        return None
+    return buffer.getvalue()
+
 async def get_goal_progress_text(user_id: int, current_analysis_calories: int = 0) -> str:
     """Получает текст прогресса по целям пользователя"""
     try:
@@ -76,12 +141,9 @@ async def get_goal_progress_text(user_id: int, current_analysis_calories: int =
         if not goal:
             return ""
         
-        # Получаем анализы за сегодня
+        # Итоги за сегодня (сводка дня)
         today = datetime.now().strftime('%Y-%m-%d')
-        daily_analyses = await firebase_service.get_daily_analyses(user_id, today)
-        
-        # Агрегируем данные за день
-        total_nutrition = await firebase_service.aggregate_daily_nutrition(daily_analyses)
+        total_nutrition = await firebase_service.get_daily_nutrition(user_id, today)
         
         # Добавляем текущий анализ
         total_calories = total_nutrition.get('calories', 0) + current_analysis_calories
@@ -143,6 +205,8 @@ async def get_goal_progress_text(user_id: int, current_analysis_calories: int =
 @error_handler
 async def cancel_handler(message: Message, state: FSMContext):
     """Отмена текущей операции и сброс состояния FSM"""
+    speculative_analysis.cancel(message.from_user.id)
+    photo_store.discard_user(message.from_user.id)
     await state.clear()
     await message.answer(
         "❌ Операция отменена.\n\n"
@@ -300,55 +364,44 @@ async def photo_handler(message: Message, state: FSMContext):
     try:
         user_id = message.from_user.id
         
+        # Фото альбома анализируются одной пачкой: его обрабатывает первое сообщение
+        if message.media_group_id:
+            messages = await media_group_collector.collect(message)
+            if messages:
+                await album_handler(messages, state)
+            return
+        
         # Проверяем лимиты подписки
         can_analyze, limit_message = await subscription_service.can_analyze_photo(user_id)
         if not can_analyze:
-            # Получаем информацию о текущем использовании
-            subscription = await subscription_service.get_user_subscription(user_id)
-            daily_count = subscription.get('daily_photo_count', 0)
-            
-            # Показываем пейволл с более дружелюбным сообщением
-            from handlers_payments import show_paywall
-            await show_paywall(
-                message,
-                title="📸 Дневной лимит исчерпан",
-                description=f"😊 Вы уже проанализировали {daily_count} фото сегодня!\n\n⏰ Лимит сбросится завтра в 00:00\n\n🌟 **Pro** снимет все ограничения:",
-                features=[
-                    "• До 200 фото в месяц",
-                    "• Мульти-тарелка (несколько блюд)",
-                    "• Детальные витамины и советы", 
-                    "• Экспорт в PDF/CSV",
-                    "• Google Calendar интеграция"
-                ]
-            )
+            await show_photo_limit_paywall(message, user_id)
             return
         
         # Сохраняем/обновляем информацию о пользователе
-        username = message.from_user.username
-        first_name = message.from_user.first_name
-        last_name = message.from_user.last_name
-        
-        await firebase_service.create_or_update_user(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
+        await save_user_info(message)
         
         # Получаем файл с максимальным разрешением
         photo = message.photo[-1]
+        data = await download_photo(message)
+        if data is None:
+            await message.answer("❌ Фото слишком большое. Отправьте фото меньшего размера.")
+            return
         
-        # Скачиваем фото
-        file_info = await message.bot.get_file(photo.file_id)
-        file_extension = file_info.file_path.split('.')[-1]
-        file_path = os.path.join(TEMP_DIR, f"food_{message.from_user.id}_{photo.file_id}.{file_extension}")
+        # Прошлое фото пользователя больше не нужно
+        photo_store.discard_user(user_id)
+        photo_ref = photo_store.put(user_id, data)
         
-        await message.bot.download_file(file_info.file_path, file_path)
+        # Очередь запросов к Gemini по тарифу пользователя
+        subscription = await subscription_service.get_user_subscription(user_id)
+        queue_tier = subscription_service.get_queue_tier(subscription['type'])
         
-        # Сохраняем путь к файлу в состоянии
-        await state.update_data(photo_path=file_path)
+        # Сохраняем ссылку на фото, file_unique_id (ключ кэша анализов) и очередь в состоянии
+        await state.update_data(photo_ref=photo_ref, photo_unique_id=photo.file_unique_id, queue_tier=queue_tier)
         await state.set_state(FoodAnalysisStates.waiting_for_weight)
         
+        # Начинаем анализ, пока пользователь вводит вес (анализ прошлого фото отменяется)
+        speculative_analysis.start(user_id, photo_ref, photo.file_unique_id, queue_tier)
+        
         # Проверяем доступность мульти-тарелки
         can_multi_dish, multi_message = await subscription_service.can_use_feature(user_id, "multi_dish")
         
@@ -376,6 +429,106 @@ async def photo_handler(message: Message, state: FSMContext):
             "Попробуйте отправить фото еще раз."
         )
 
+async def album_handler(messages: List[Message], state: FSMContext):
+    """Анализ альбома: все фото одновременно, один общий итог"""
+    message = messages[0]
+    user_id = message.from_user.id
+    
+    # Альбом может быть больше, чем осталось фото на сегодня
+    remaining = await subscription_service.remaining_daily_photos(user_id)
+    if remaining <= 0:
+        await show_photo_limit_paywall(message, user_id)
+        return
+    limit = min(remaining, MEDIA_GROUP_MAX_PHOTOS)
+    skipped = len(messages) - limit
+    messages = messages[:limit]
+    
+    await save_user_info(message)
+    
+    # Альбом заменяет прошлое фото и его упреждающий анализ
+    speculative_analysis.cancel(user_id)
+    photo_store.discard_user(user_id)
+    await state.clear()
+    
+    # Скачиваем все фото альбома одновременно
+    downloaded = await asyncio.gather(*(download_photo(item) for item in messages))
+    photos = [
+        {'image_path': photo_store.put(user_id, data), 'file_unique_id': item.photo[-1].file_unique_id}
+        for item, data in zip(messages, downloaded) if data is not None
+    ]
+    too_large = len(messages) - len(photos)
+    if not photos:
+        await message.answer("❌ Фото слишком большие. Отправьте фото меньшего размера.")
+        return
+    
+    # Очередь запросов к Gemini по тарифу пользователя
+    subscription = await subscription_service.get_user_subscription(user_id)
+    queue_tier = subscription_service.get_queue_tier(subscription['type'])
+    
+    progress = await ProgressMessage.create(
+        message, f"🔍 Анализирую {len(photos)} фото...", header="🔍 Анализирую альбом...\n\n")
+    try:
+        analysis = await multi_dish_analyzer.analyze_album(
+            photos, user_id, subscription_type=queue_tier, on_progress=progress.update)
+    except GeminiServiceError as e:
+        await answer_gemini_error(message, e, queue_tier, progress)
+        return
+    finally:
+        for photo in photos:
+            photo_store.discard(photo['image_path'])
+    analysis_result = analysis['analysis_text']
+    analyzed = [dish for dish in analysis['dishes'] if dish['nutrition']]
+    
+    # Лимит расходуется только на проанализированные фото
+    await subscription_service.increment_photo_count(user_id, count=len(analyzed))
+    
+    analysis_storage.store_analysis(
+        user_id=user_id,
+        analysis_text=analysis_result,
+        image_path=None,
+        weight=None,
+        nutrition=analysis['nutrition'],
+        is_multi_dish=True,
+        dishes=analysis['dishes']
+    )
+    
+    # Сохраняем в Firebase одним анализом, как мульти-тарелку
+    analysis_data = {
+        'analysis_text': analysis_result,
+        'weight': 'album',
+        'user_id': str(user_id),
+        'is_multi_dish': True,
+        'dishes': [{'name': dish['name'], 'nutrition': dish['nutrition']} for dish in analyzed]
+    }
+    if analysis['nutrition']:
+        analysis_data['nutrition'] = analysis['nutrition']
+    await firebase_service.save_analysis(user_id, analysis_data)
+    
+    formatted_response = format_nutrition_info(analysis_result)
+    await progress.finish(f"🍽️ **Альбом ({len(photos)} фото):**\n\n{formatted_response}")
+    
+    notes = []
+    if skipped > 0:
+        notes.append(f"⚠️ Не проанализировано фото сверх лимита: {skipped}")
+    if too_large:
+        notes.append(f"⚠️ Слишком большие фото пропущены: {too_large}")
+    
+    # Показываем прогресс по целям
+    try:
+        progress_text = await get_goal_progress_text(user_id, analysis['nutrition'].get('calories', 0))
+        if progress_text:
+            await message.answer(progress_text, parse_mode="Markdown")
+    except Exception as e:
+        logger.warning(f"Ошибка показа прогресса по целям: {e}")
+    
+    await message.answer(
+        "✅ **Анализ альбома завершен!**\n\n"
+        + ("\n".join(notes) + "\n\n" if notes else "")
+        + "💬 Исправления: просто напишите текстом\n"
+        "📸 Или отправьте новое фото",
+        parse_mode="Markdown"
+    )
+
 @router.callback_query(F.data == "unknown_weight")
 @error_handler
 async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
@@ -384,9 +537,9 @@ async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
     
     # Получаем данные из состояния
     data = await state.get_data()
-    photo_path = data.get('photo_path')
+    photo_ref = data.get('photo_ref')
     
-    if not photo_path or not os.path.exists(photo_path):
+    if not photo_ref or not photo_store.exists(photo_ref):
         await callback.message.answer(
             "❌ Фото не найдено. Пожалуйста, отправьте фото еды заново."
         )
@@ -394,10 +547,29 @@ async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
         return
     
     # Показываем индикатор загрузки
-    await callback.message.answer("🔍 Анализирую фото еды и определяю примерный вес...")
+    progress = await ProgressMessage.create(
+        callback.message, "🔍 Анализирую фото еды и определяю примерный вес...", header="🔍 Анализирую...\n\n")
     
     # Анализируем еду через Gemini без указания конкретного веса
-    analysis_result = await gemini_service.analyze_food_auto_weight(photo_path)
+    queue_tier = data.get('queue_tier', 'lite')
+    try:
+        # Результат фонового анализа, запущенного при получении фото
+        analysis = await speculative_analysis.take(callback.from_user.id, photo_ref, on_progress=progress.update)
+        if analysis is None:
+            analysis = await analysis_router.analyze_food_auto_weight(
+                photo_ref,
+                file_unique_id=data.get('photo_unique_id'),
+                user_id=callback.from_user.id,
+                subscription_type=queue_tier,
+                on_progress=progress.update
+            )
+    except GeminiServiceError as e:
+        await answer_gemini_error(callback.message, e, queue_tier, progress)
+        return
+    analysis_result = analysis['analysis_text']
+    
+    # Увеличиваем счетчик анализов
+    await subscription_service.increment_photo_count(callback.from_user.id)
     
     # Сохраняем анализ для возможности редактирования
     user_id = callback.from_user.id if callback.from_user else None
@@ -405,8 +577,9 @@ async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
         analysis_storage.store_analysis(
             user_id=user_id,
             analysis_text=analysis_result,
-            image_path=photo_path,
-            weight=None  # Автоопределение веса
+            image_path=photo_ref,
+            weight=None,  # Автоопределение веса
+            nutrition=analysis['nutrition']
         )
     
         # Сохраняем в Firebase
@@ -417,18 +590,16 @@ async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
                 'weight': 'auto',
                 'user_id': str(user_id)
             }
+            if analysis['nutrition']:
+                analysis_data['nutrition'] = analysis['nutrition']
             analysis_id = await firebase_service.save_analysis(user_id, analysis_data)
     
     # Форматируем ответ
     formatted_response = format_nutrition_info(analysis_result)
     final_response = f"🍽️ **Ваш прием пищи (автоопределение веса):**\n\n{formatted_response}"
     
-    # Отправляем результат пользователю
-    try:
-        await callback.message.answer(final_response, parse_mode="Markdown")
-    except Exception as e:
-        logger.warning(f"Ошибка отправки с Markdown: {e}")
-        await callback.message.answer(final_response)
+    # Показываем результат на месте заглушки
+    await progress.finish(final_response)
     
     # Показываем прогресс по целям
     try:
@@ -439,17 +610,14 @@ async def unknown_weight_handler(callback: CallbackQuery, state: FSMContext):
     except Exception as e:
         logger.warning(f"Ошибка показа прогресса по целям: {e}")
     
-    # Удаляем временный файл
-    try:
-        os.remove(photo_path)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить временный файл: {e}")
+    # Фото больше не нужно
+    photo_store.discard(photo_ref)
     
     # Пытаемся создать событие в Google Calendar (если подключен)
     event_id = None
     try:
         if calendar_service:
-            title = extract_meal_title(analysis_result)
+            title = extract_meal_title(analysis_result, analysis['nutrition'])
             success = await calendar_service.create_meal_event(
                 user_id=user_id,
                 title=title,
@@ -510,9 +678,9 @@ async def multi_dish_handler(callback: CallbackQuery, state: FSMContext):
     
     # Получаем данные из состояния
     data = await state.get_data()
-    photo_path = data.get('photo_path')
+    photo_ref = data.get('photo_ref')
     
-    if not photo_path or not os.path.exists(photo_path):
+    if not photo_ref or not photo_store.exists(photo_ref):
         await callback.message.answer(
             "❌ Фото не найдено. Пожалуйста, отправьте фото еды заново."
         )
@@ -520,23 +688,37 @@ async def multi_dish_handler(callback: CallbackQuery, state: FSMContext):
         return
     
     # Показываем индикатор загрузки
-    await callback.message.answer("🔍 Анализирую фото с несколькими блюдами...")
+    progress = await ProgressMessage.create(
+        callback.message, "🔍 Анализирую фото с несколькими блюдами...", header="🔍 Анализирую...\n\n")
+    
+    # Находим блюда на фото и анализируем их параллельно
+    queue_tier = data.get('queue_tier', 'lite')
+    try:
+        analysis = await multi_dish_analyzer.analyze(
+            photo_ref,
+            callback.from_user.id,
+            subscription_type=queue_tier,
+            file_unique_id=data.get('photo_unique_id'),
+            on_progress=progress.update
+        )
+    except GeminiServiceError as e:
+        await answer_gemini_error(callback.message, e, queue_tier, progress)
+        return
+    analysis_result = analysis['analysis_text']
     
     # Увеличиваем счетчик анализов
     await subscription_service.increment_photo_count(callback.from_user.id)
     
-    # Анализируем через специальный метод для мульти-тарелки
-    # TODO: Добавить специальный метод в gemini_service для мульти-тарелки
-    analysis_result = await gemini_service.analyze_food_auto_weight(photo_path)
-    
     # Сохраняем анализ
     user_id = callback.from_user.id
     analysis_storage.store_analysis(
         user_id=user_id,
         analysis_text=analysis_result,
-        image_path=photo_path,
+        image_path=photo_ref,
         weight=None,
-        is_multi_dish=True
+        nutrition=analysis['nutrition'],
+        is_multi_dish=True,
+        dishes=analysis['dishes']
     )
     
     # Сохраняем в Firebase
@@ -546,17 +728,19 @@ async def multi_dish_handler(callback: CallbackQuery, state: FSMContext):
         'user_id': str(user_id),
         'is_multi_dish': True
     }
+    if analysis['nutrition']:
+        analysis_data['nutrition'] = analysis['nutrition']
+    if analysis['dishes']:
+        analysis_data['dishes'] = [
+            {'name': dish['name'], 'nutrition': dish['nutrition']} for dish in analysis['dishes'] if dish['nutrition']
+        ]
     await firebase_service.save_analysis(user_id, analysis_data)
     
     # Форматируем ответ
     formatted_response = format_nutrition_info(analysis_result)
     final_response = f"🍽️ **Мульти-тарелка анализ:**\n\n{formatted_response}"
     
-    try:
-        await callback.message.answer(final_response, parse_mode="Markdown")
-    except Exception as e:
-        logger.warning(f"Ошибка отправки с Markdown: {e}")
-        await callback.message.answer(final_response)
+    await progress.finish(final_response)
     
     # Показываем прогресс по целям
     try:
@@ -567,11 +751,8 @@ async def multi_dish_handler(callback: CallbackQuery, state: FSMContext):
     except Exception as e:
         logger.warning(f"Ошибка показа прогресса по целям: {e}")
     
-    # Удаляем временный файл
-    try:
-        os.remove(photo_path)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить временный файл: {e}")
+    # Фото больше не нужно
+    photo_store.discard(photo_ref)
     
     # Очищаем состояние
     await state.clear()
@@ -648,9 +829,9 @@ async def weight_handler(message: Message, state: FSMContext):
         
         # Получаем данные из состояния
         data = await state.get_data()
-        photo_path = data.get('photo_path')
+        photo_ref = data.get('photo_ref')
         
-        if not photo_path or not os.path.exists(photo_path):
+        if not photo_ref or not photo_store.exists(photo_ref):
             await message.answer(
                 "❌ Фото не найдено. Пожалуйста, отправьте фото еды заново."
             )
@@ -658,17 +839,36 @@ async def weight_handler(message: Message, state: FSMContext):
             return
         
         # Показываем индикатор загрузки
-        await message.answer("🔍 Анализирую фото еды...")
+        progress = await ProgressMessage.create(message, "🔍 Анализирую фото еды...", header="🔍 Анализирую...\n\n")
         
-        # Увеличиваем счетчик анализов
-        await subscription_service.increment_photo_count(message.from_user.id)
+        # Получаем информацию о подписке для адаптации ответа и приоритета в очереди
+        subscription = await subscription_service.get_user_subscription(message.from_user.id)
+        subscription_type = subscription['type']
+        queue_tier = subscription_service.get_queue_tier(subscription_type)
         
         # Анализируем еду через Gemini
-        analysis_result = await gemini_service.analyze_food(photo_path, weight)
+        try:
+            # Фоновый анализ пересчитывается под вес, если оценка модели близка к нему
+            speculative = speculative_analysis.has(message.from_user.id, photo_ref)
+            analysis = await speculative_analysis.take(message.from_user.id, photo_ref, weight)
+            if analysis is None:
+                analysis = await analysis_router.analyze_food(
+                    photo_ref,
+                    weight,
+                    file_unique_id=data.get('photo_unique_id'),
+                    user_id=message.from_user.id,
+                    subscription_type=queue_tier,
+                    on_progress=progress.update,
+                    # Кэш уже содержит фоновый анализ, который не подошел для пересчета
+                    use_cache=not speculative
+                )
+        except GeminiServiceError as e:
+            await answer_gemini_error(message, e, queue_tier, progress)
+            return
+        analysis_result = analysis['analysis_text']
         
-        # Получаем информацию о подписке для адаптации ответа
-        subscription = await subscription_service.get_user_subscription(message.from_user.id)
-        subscription_type = subscription['type']
+        # Увеличиваем счетчик анализов
+        await subscription_service.increment_photo_count(message.from_user.id)
         
         # Сохраняем анализ для возможности редактирования
         user_id = message.from_user.id if message.from_user else None
@@ -676,8 +876,9 @@ async def weight_handler(message: Message, state: FSMContext):
             analysis_storage.store_analysis(
                 user_id=user_id,
                 analysis_text=analysis_result,
-                image_path=photo_path,
-                weight=weight
+                image_path=photo_ref,
+                weight=weight,
+                nutrition=analysis['nutrition']
             )
         
         # Сохраняем в Firebase
@@ -689,19 +890,16 @@ async def weight_handler(message: Message, state: FSMContext):
                 'user_id': str(user_id),
                 'subscription_type': subscription_type
             }
+            if analysis['nutrition']:
+                analysis_data['nutrition'] = analysis['nutrition']
             await firebase_service.save_analysis(user_id, analysis_data)
         
         # Форматируем ответ
         formatted_response = format_nutrition_info(analysis_result)
         final_response = f"🍽️ **Ваш прием пищи ({weight} г):**\n\n{formatted_response}"
         
-        # Отправляем результат пользователю (без Markdown чтобы избежать ошибок парсинга)
-        try:
-            await message.answer(final_response, parse_mode="Markdown")
-        except Exception as e:
-            logger.warning(f"Ошибка отправки с Markdown: {e}")
-            # Отправляем без форматирования если есть проблемы с Markdown
-            await message.answer(final_response)
+        # Показываем результат на месте заглушки (без Markdown, если он не разбирается)
+        await progress.finish(final_response)
         
         # Показываем прогресс по целям
         try:
@@ -718,21 +916,18 @@ async def weight_handler(message: Message, state: FSMContext):
         # Пытаемся создать событие в Google Calendar (если подключен)
         try:
             if calendar_service:
-                title = extract_meal_title(analysis_result)
+                title = extract_meal_title(analysis_result, analysis['nutrition'])
                 await calendar_service.create_meal_event(
                     user_id=user_id,
                     title=title,
                     description=formatted_response,
-                    event_time=callback.message.date
+                    event_time=message.date
                 )
         except Exception as e:
             logger.warning(f"Не удалось создать событие в календаре: {e}")
 
-        # Удаляем временный файл
-        try:
-            os.remove(photo_path)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл: {e}")
+        # Фото больше не нужно
+        photo_store.discard(photo_ref)
         
         # Очищаем состояние
         await state.clear()
@@ -1357,11 +1552,11 @@ async def recommendations_handler(message: Message):
         )
         return
     
-    # Получаем дневное питание
+    # Получаем дневное питание (сводка дня)
     today = datetime.now().strftime('%Y-%m-%d')
-    analyses = await firebase_service.get_daily_analyses(user_id, today)
+    daily_nutrition = await firebase_service.get_daily_nutrition(user_id, today)
     
-    if not analyses:
+    if not daily_nutrition['meals']:
         await message.answer(
             "📊 **Нет данных за сегодня**\n\n"
             "Проанализируйте хотя бы одно блюдо, чтобы получить рекомендации!",
@@ -1369,9 +1564,6 @@ async def recommendations_handler(message: Message):
         )
         return
     
-    # Агрегируем питание за день
-    daily_nutrition = await firebase_service.aggregate_daily_nutrition(analyses)
-    
     # Генерируем рекомендации
     await message.answer("🤖 Генерирую персональные рекомендации...")
     recommendations = await personal_goals_service.generate_smart_recommendations(
@@ -2093,16 +2285,40 @@ async def text_handler(message: Message):
         last_analysis = analysis_storage.get_last_analysis(user_id)
         
         if last_analysis:
-            await message.answer("🔄 Исправляю анализ с учетом ваших замечаний...")
-            
-            # Исправляем анализ через Gemini
-            corrected_analysis = await gemini_service.correct_analysis(
-                original_analysis=last_analysis['analysis_text'],
-                user_correction=message.text
+            # Вес, размер порции и удаление продуктов пересчитываем без модели
+            local = local_correction_engine.correct(
+                last_analysis['analysis_text'],
+                message.text,
+                nutrition=last_analysis.get('nutrition'),
+                weight=last_analysis['weight']
             )
-            
-            # Обновляем сохраненный анализ
-            analysis_storage.update_analysis(user_id, corrected_analysis)
+            if local:
+                corrected_analysis = local['analysis_text']
+                corrected_nutrition = local['nutrition']
+                # Вес, введенный пользователем, заменяет автоопределение
+                new_weight = local['weight'] if local['kind'] != 'remove' or last_analysis['weight'] else None
+                analysis_storage.update_analysis(user_id, corrected_analysis, corrected_nutrition, weight=new_weight)
+                last_analysis = analysis_storage.get_last_analysis(user_id)
+            else:
+                await message.answer("🔄 Исправляю анализ с учетом ваших замечаний...")
+                
+                # Исправляем анализ через Gemini
+                subscription = await subscription_service.get_user_subscription(user_id)
+                queue_tier = subscription_service.get_queue_tier(subscription['type'])
+                try:
+                    corrected_analysis = await analysis_router.correct_analysis(
+                        original_analysis=last_analysis['analysis_text'],
+                        user_correction=message.text,
+                        user_id=user_id,
+                        subscription_type=queue_tier
+                    )
+                except GeminiServiceError as e:
+                    await answer_gemini_error(message, e, queue_tier)
+                    return
+                corrected_nutrition = None
+                
+                # Обновляем сохраненный анализ
+                analysis_storage.update_analysis(user_id, corrected_analysis)
             
             # Форматируем и отправляем исправленный анализ
             formatted_response = format_nutrition_info(corrected_analysis)
@@ -2112,7 +2328,7 @@ async def text_handler(message: Message):
             # Пытаемся обновить событие в Google Calendar
             try:
                 if calendar_service:
-                    title = extract_meal_title(corrected_analysis)
+                    title = extract_meal_title(corrected_analysis, corrected_nutrition)
                     # Для упрощения ищем последнее событие пользователя за сегодня
                     # В реальности лучше хранить event_id в analysis_storage
                     await calendar_service.update_latest_meal_event(
@@ -2179,6 +2395,8 @@ def register_handlers(dp):
     """Регистрирует все обработчики"""
     from commands import commands_router
     from handlers_payments import payments_router
+    # Документ пользователя читается один раз за апдейт, записи в него - одним коммитом
+    dp.update.outer_middleware(UserDocumentMiddleware(firebase_service))
     dp.include_router(router)
     dp.include_router(payments_router)
     dp.include_router(commands_router)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Миграция: числовые поля КБЖУ в старых анализах
+
+Новые анализы сохраняются с полями calories, proteins, fats, carbs,
+vitamins и products. Скрипт записывает эти поля в анализы, сохраненные
+раньше (из структурированного ответа или разбором текста), чтобы отчеты,
+экспорт и итоги не разбирали текст при каждом чтении. Повторный запуск
+пропускает уже обновленные анализы.
+
+Запуск:
+    python migrate_nutrition_fields.py [--user ID] [--dry-run]
+"""
+import argparse
+import asyncio
+
+from services.firebase_service import FirebaseService
+from services.firestore_executor import firestore_executor
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--user", type=int, help="только этот пользователь")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать анализы без полей")
+    args = parser.parse_args()
+
+    firebase = FirebaseService()
+    user_ids = [args.user] if args.user else await firebase.get_all_users()
+    total = 0
+    updated = 0
+    try:
+        for user_id in user_ids:
+            checked, pending = await firebase.migrate_nutrition_fields(user_id, dry_run=args.dry_run)
+            total += checked
+            updated += pending
+            if pending:
+                print(f"{'🔍' if args.dry_run else '✅'} {user_id}: {pending} из {checked} анализов")
+    finally:
+        firestore_executor.shutdown()
+
+    action = "нужно обновить" if args.dry_run else "обновлено"
+    print(f"\nПользователей: {len(user_ids)}, анализов: {total}, {action}: {updated}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
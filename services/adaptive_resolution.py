@@ -0,0 +1,131 @@
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+from config import (
+    IMAGE_ADAPTIVE_RESOLUTION,
+    IMAGE_LOW_RES_SIDE,
+    IMAGE_LOW_RES_MIN_CONFIDENCE,
+    IMAGE_MAX_SIDE,
+)
+from .nutrition_schema import nutrition_problems
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику в лог (в первых проходах)
+STATS_LOG_INTERVAL = 50
+
+# Тарификация изображений Gemini: до 384x384 - 258 токенов,
+# больше - плитки 768x768 по 258 токенов
+IMAGE_TOKENS_PER_TILE = 258
+SMALL_IMAGE_SIDE = 384
+IMAGE_TILE_SIDE = 768
+
+
+def estimate_image_tokens(dimensions: Optional[Tuple[int, int]]) -> int:
+    """Оценка входных токенов изображения по его размерам"""
+    if not dimensions:
+        return IMAGE_TOKENS_PER_TILE
+    width, height = dimensions
+    if width <= SMALL_IMAGE_SIDE and height <= SMALL_IMAGE_SIDE:
+        return IMAGE_TOKENS_PER_TILE
+    return math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE) * IMAGE_TOKENS_PER_TILE
+
+
+def fit_dimensions(dimensions: Tuple[int, int], max_side: int) -> Tuple[int, int]:
+    """Размеры после уменьшения длинной стороны до max_side (без увеличения)"""
+    width, height = dimensions
+    scale = min(1.0, max_side / max(width, height))
+    return round(width * scale), round(height * scale)
+
+
+class AdaptiveResolution:
+    """Двухуровневое разрешение фото для анализа
+
+    Сначала модели отправляется копия фото с длинной стороной low_res_side.
+    Полное разрешение (IMAGE_MAX_SIDE) отправляется, только если модель
+    не уверена в ответе (confidence ниже порога) или ответ не прошел
+    проверку. Считает долю повторов и сэкономленные байты и токены:
+    для принятых ответов - разница с полным разрешением (оценка по площади
+    и плиткам Gemini), для повторов экономия отрицательная - уменьшенная
+    копия отправлена зря.
+    """
+
+    def __init__(self, enabled: bool = IMAGE_ADAPTIVE_RESOLUTION, low_res_side: int = IMAGE_LOW_RES_SIDE,
+                 min_confidence: float = IMAGE_LOW_RES_MIN_CONFIDENCE, full_res_side: int = IMAGE_MAX_SIDE):
+        self.enabled = enabled and low_res_side < full_res_side
+        self.low_res_side = low_res_side
+        self.min_confidence = min_confidence
+        self.full_res_side = full_res_side
+        self._stats = {
+            'first_passes': 0,
+            'accepted': 0,
+            'escalated': 0,
+            'bytes_saved': 0,
+            'tokens_saved': 0,
+        }
+        self._reasons: Dict[str, int] = {}
+
+    def describe_image(self, processed: Dict) -> Dict:
+        """Байты и токены уменьшенной копии и оценка для полного разрешения"""
+        dimensions = processed.get('dimensions')
+        original = processed.get('original_dimensions')
+        full = fit_dimensions(original, self.full_res_side) if original else None
+        low_pixels = dimensions[0] * dimensions[1] if dimensions else 0
+        full_pixels = full[0] * full[1] if full else 0
+        ratio = full_pixels / low_pixels if low_pixels and full_pixels else 1.0
+        return {
+            'bytes': processed['processed_size'],
+            'tokens': estimate_image_tokens(dimensions),
+            'full_bytes_estimate': round(processed['processed_size'] * ratio),
+            'full_tokens_estimate': estimate_image_tokens(full),
+        }
+
+    def rejection_reason(self, nutrition: Optional[Dict], weight_grams: Optional[int] = None) -> Optional[str]:
+        """Почему ответ по уменьшенной копии не принят (None - принят)"""
+        if not nutrition:
+            return "нет структурированного ответа"
+        confidence = nutrition.get('confidence')
+        if confidence is not None and confidence < self.min_confidence:
+            return "низкая уверенность"
+        problems: List[str] = nutrition_problems(nutrition, weight_grams)
+        if problems:
+            return "не прошел проверку"
+        return None
+
+    def record(self, image: Optional[Dict], reason: Optional[str]):
+        """Учитывает первый проход: принят (reason=None) или повторен в полном разрешении"""
+        self._stats['first_passes'] += 1
+        if reason is None:
+            self._stats['accepted'] += 1
+            if image:
+                self._stats['bytes_saved'] += image['full_bytes_estimate'] - image['bytes']
+                self._stats['tokens_saved'] += image['full_tokens_estimate'] - image['tokens']
+        else:
+            self._stats['escalated'] += 1
+            self._reasons[reason] = self._reasons.get(reason, 0) + 1
+            if image:
+                self._stats['bytes_saved'] -= image['bytes']
+                self._stats['tokens_saved'] -= image['tokens']
+            logger.info(f"Анализ уменьшенной копии не принят ({reason}), повторяем в полном разрешении")
+        self._log_stats()
+
+    def _log_stats(self):
+        if self._stats['first_passes'] % STATS_LOG_INTERVAL:
+            return
+        stats = self.get_stats()
+        logger.info(f"Адаптивное разрешение: {stats['first_passes']} анализов, "
+                    f"повторов {stats['escalation_rate'] * 100:.0f}%, сэкономлено "
+                    f"{stats['bytes_saved']} байт и ~{stats['tokens_saved']} токенов")
+
+    def get_stats(self) -> Dict:
+        """Доля повторов в полном разрешении и сэкономленные байты/токены"""
+        passes = self._stats['first_passes']
+        return {
+            **self._stats,
+            'escalation_rate': self._stats['escalated'] / passes if passes else 0.0,
+            'escalation_reasons': dict(self._reasons),
+        }
+
+
+# Глобальная политика адаптивного разрешения
+adaptive_resolution = AdaptiveResolution()
@@ -0,0 +1,262 @@
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from config import (
+    ANALYSIS_CACHE_ENABLED,
+    ANALYSIS_CACHE_MAX_SIZE,
+    ANALYSIS_CACHE_TTL_SECONDS,
+    ANALYSIS_CACHE_HASH_DISTANCE,
+)
+from utils import parse_nutrition_values, extract_portion_weight, rescale_analysis_text
+from .nutrition_schema import scale_nutrition
+from .photo_store import photo_store, is_photo_ref
+from .offload import offloader
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику кэша в лог (в обращениях)
+STATS_LOG_INTERVAL = 50
+
+
+def compute_dhash(data: bytes, hash_size: int = 8) -> int:
+    """Вычисляет разностный перцептивный хэш (dHash) изображения"""
+    with Image.open(io.BytesIO(data)) as image:
+        # draft ускоряет декодирование JPEG сразу в уменьшенном размере
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def compute_image_keys(data: bytes) -> Tuple[Optional[int], str]:
+    """Ключи фото для кэша: dHash (None - Pillow не разобрал фото) и SHA-256 содержимого (в пуле процессов)"""
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        return compute_dhash(data), digest
+    except Exception:
+        return None, digest
+
+
+class AnalysisCache:
+    """LRU кэш результатов анализа фото с TTL
+
+    Запись ищется по file_unique_id из Telegram, а если его нет или фото
+    загружено заново - по перцептивному хэшу изображения. Близкий хэш
+    ищется только среди фото того же пользователя: похожие тарелки разных
+    пользователей могут быть разной едой. Чужая запись подходит только при
+    совпадении file_unique_id или SHA-256 содержимого (тот же файл). Для
+    каждой записи хранится вес порции, поэтому запрос с другим весом тоже
+    попадает в кэш: КБЖУ пересчитываются из значений на 100 г.
+    """
+
+    def __init__(self, max_size: int = ANALYSIS_CACHE_MAX_SIZE, ttl_seconds: int = ANALYSIS_CACHE_TTL_SECONDS,
+                 max_hash_distance: int = ANALYSIS_CACHE_HASH_DISTANCE, enabled: bool = ANALYSIS_CACHE_ENABLED):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.max_hash_distance = max_hash_distance
+        self.enabled = enabled
+
+        # (user_id, dhash) -> запись кэша (порядок = порядок использования)
+        self._entries: "OrderedDict[Tuple[Optional[int], int], Dict]" = OrderedDict()
+        # file_unique_id -> ключ записи
+        self._file_index: Dict[str, Tuple[Optional[int], int]] = {}
+        # SHA-256 содержимого фото -> ключ записи
+        self._digest_index: Dict[str, Tuple[Optional[int], int]] = {}
+
+        self._stats = {
+            'hits': 0,
+            'rescaled_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def _is_expired(self, entry: Dict) -> bool:
+        return time.monotonic() - entry['created_at'] > self.ttl_seconds
+
+    def _remove(self, key: Tuple[Optional[int], int]):
+        """Удаляет запись вместе с индексами file_unique_id и SHA-256"""
+        entry = self._entries.pop(key, None)
+        if entry:
+            for file_unique_id in entry['file_ids']:
+                if self._file_index.get(file_unique_id) == key:
+                    del self._file_index[file_unique_id]
+            if entry['digest'] and self._digest_index.get(entry['digest']) == key:
+                del self._digest_index[entry['digest']]
+
+    def _find_entry(self, user_id: Optional[int], dhash: Optional[int], digest: Optional[str],
+                    file_unique_id: Optional[str]) -> Optional[Tuple[Optional[int], int]]:
+        """Находит ключ записи по file_unique_id, хэшу фото пользователя или SHA-256 содержимого"""
+        if file_unique_id and file_unique_id in self._file_index:
+            return self._file_index[file_unique_id]
+        if dhash is not None:
+            if (user_id, dhash) in self._entries:
+                return (user_id, dhash)
+            if self.max_hash_distance > 0:
+                best_key, best_distance = None, self.max_hash_distance + 1
+                for key in self._entries:
+                    if key[0] != user_id:
+                        continue
+                    distance = bin(key[1] ^ dhash).count("1")
+                    if distance < best_distance:
+                        best_key, best_distance = key, distance
+                if best_key is not None:
+                    return best_key
+        if digest:
+            return self._digest_index.get(digest)
+        return None
+
+    async def image_keys(self, image_path: str) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Ключи фото для lookup и store: (dHash, SHA-256 содержимого)
+
+        Чтение файла и декодирование Pillow выполняются вне цикла событий.
+        Вычисляется один раз на анализ; (None, None) - кэш выключен или фото не прочитано.
+        """
+        if not self.enabled:
+            return None, None
+        try:
+            if is_photo_ref(image_path):
+                data = photo_store.read(image_path)
+            else:
+                data = await offloader.run_in_thread(photo_store.read, image_path)
+            dhash, digest = await offloader.run_in_process(compute_image_keys, data)
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить хэш изображения: {e}")
+            return None, None
+        if dhash is None:
+            logger.warning("Не удалось вычислить перцептивный хэш изображения")
+        return dhash, digest
+
+    def lookup(self, dhash: Optional[int], digest: Optional[str], weight_grams: Optional[int] = None,
+               file_unique_id: Optional[str] = None, user_id: Optional[int] = None) -> Optional[Dict]:
+        """
+        Ищет готовый анализ для фото
+
+        Args:
+            dhash, digest: ключи фото из image_keys
+            weight_grams: вес порции (None - автоопределение веса)
+            file_unique_id: file_unique_id фото из Telegram
+            user_id: ID пользователя (близкие хэши ищутся только среди его фото)
+
+        Returns:
+            {'analysis_text', 'nutrition'} (пересчитанные под вес) или None
+        """
+        if not self.enabled:
+            return None
+
+        key = self._find_entry(user_id, dhash, digest, file_unique_id)
+        entry = self._entries.get(key) if key is not None else None
+
+        if entry and self._is_expired(entry):
+            self._remove(key)
+            self._stats['expirations'] += 1
+            entry = None
+
+        if entry is None:
+            self._count('misses')
+            return None
+
+        # Рескейл возможен только если известен вес закэшированной порции
+        if weight_grams is not None and weight_grams != entry['weight']:
+            if not entry['weight']:
+                self._count('misses')
+                return None
+            factor = weight_grams / entry['weight']
+            result = {
+                'analysis_text': rescale_analysis_text(entry['analysis_text'], factor, weight_grams),
+                'nutrition': scale_nutrition(entry['nutrition'], factor, weight_grams) if entry['nutrition'] else None,
+            }
+            self._stats['rescaled_hits'] += 1
+        else:
+            result = {'analysis_text': entry['analysis_text'], 'nutrition': entry['nutrition']}
+
+        self._entries.move_to_end(key)
+        if file_unique_id:
+            entry['file_ids'].add(file_unique_id)
+            self._file_index[file_unique_id] = key
+
+        logger.info(f"Анализ найден в кэше (вес: {weight_grams or 'авто'}, кэш: {entry['weight']} г)")
+        self._count('hits')
+        return result
+
+    def store(self, dhash: Optional[int], digest: Optional[str], analysis_text: str,
+              weight_grams: Optional[int] = None, file_unique_id: Optional[str] = None,
+              nutrition: Optional[Dict] = None, user_id: Optional[int] = None) -> bool:
+        """Сохраняет успешный анализ в кэш"""
+        if not self.enabled:
+            return False
+
+        if not parse_nutrition_values(analysis_text)['calories']:
+            # Ответы без КБЖУ (ошибки, отказы) не кэшируем
+            return False
+
+        if dhash is None:
+            return False
+
+        key = (user_id, dhash)
+        self._remove(key)
+        entry = {
+            'analysis_text': analysis_text,
+            # Проверенные значения структурированного ответа (если он был)
+            'nutrition': nutrition,
+            # Вес порции нужен, чтобы пересчитать КБЖУ на 100 г под другой вес
+            'weight': weight_grams or (nutrition or {}).get('weight') or extract_portion_weight(analysis_text),
+            'file_ids': {file_unique_id} if file_unique_id else set(),
+            'digest': digest,
+            'created_at': time.monotonic(),
+        }
+        self._entries[key] = entry
+        if file_unique_id:
+            self._file_index[file_unique_id] = key
+        if digest:
+            self._digest_index[digest] = key
+        self._stats['stores'] += 1
+
+        while len(self._entries) > self.max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._stats['evictions'] += 1
+        return True
+
+    def _count(self, counter: str):
+        self._stats[counter] += 1
+        lookups = self._stats['hits'] + self._stats['misses']
+        if lookups % STATS_LOG_INTERVAL == 0:
+            stats = self.get_stats()
+            logger.info(
+                f"Кэш анализов: {stats['hits']}/{stats['lookups']} попаданий "
+                f"({stats['hit_rate']:.1f}%), записей: {stats['size']}"
+            )
+
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики кэша (каждое попадание - сэкономленный вызов Gemini)"""
+        lookups = self._stats['hits'] + self._stats['misses']
+        return {
+            **self._stats,
+            'lookups': lookups,
+            'hit_rate': (self._stats['hits'] / lookups * 100) if lookups else 0.0,
+            'gemini_calls_saved': self._stats['hits'],
+            'size': len(self._entries),
+        }
+
+    def clear(self):
+        """Очищает кэш"""
+        self._entries.clear()
+        self._file_index.clear()
+        self._digest_index.clear()
+
+
+# Глобальный экземпляр кэша анализов
+analysis_cache = AnalysisCache()
@@ -0,0 +1,52 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Колбэк, которому передается промежуточный текст ответа по мере генерации
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+# Операции, которые может выполнять провайдер анализа
+OPERATIONS = ("analyze_food", "analyze_food_auto_weight", "analyze_food_structured", "correct_analysis",
+              "locate_dishes")
+
+
+class AnalysisProvider:
+    """Общий интерфейс бэкендов анализа еды (Gemini напрямую, через VPN, OpenAI)
+
+    Провайдер выполняет один запрос к своему API и при неудаче бросает
+    GeminiServiceError. Кэш, очередь, выбор провайдера и переключение при
+    сбоях делает AnalysisRouter. image_path - ссылка на фото в photo_store
+    (или путь к файлу), байты читаются через photo_store.read.
+    """
+
+    # Имя провайдера в ANALYSIS_BACKENDS, метриках и circuit breaker
+    name: str = "provider"
+    # Принимают ли методы анализа on_progress (потоковый ответ)
+    supports_streaming: bool = False
+    # Принимают ли методы model (выбор модели по уровням ModelTiers)
+    supports_model_tiers: bool = False
+    # Принимает ли analyze_food_structured image_max_side (адаптивное разрешение)
+    supports_image_resolution: bool = False
+
+    async def analyze_food(self, image_path: str, weight_grams: int) -> str:
+        """Анализ фото еды с указанным весом"""
+        raise NotImplementedError
+
+    async def analyze_food_auto_weight(self, image_path: str) -> str:
+        """Анализ фото еды с автоопределением веса"""
+        raise NotImplementedError
+
+    async def analyze_food_structured(self, image_path: str, weight_grams: Optional[int] = None) -> Dict:
+        """Анализ фото еды со структурированным ответом: {'analysis_text', 'nutrition'}"""
+        raise NotImplementedError
+
+    async def correct_analysis(self, original_analysis: str, user_correction: str) -> str:
+        """Исправление анализа по тексту пользователя"""
+        raise NotImplementedError
+
+    async def locate_dishes(self, image_path: str) -> List[Dict]:
+        """Поиск отдельных блюд на фото: [{'name', 'box': [ymin, xmin, ymax, xmax]}] в координатах 0-1000"""
+        raise NotImplementedError
+
+    def supports(self, operation: str) -> bool:
+        """Реализует ли провайдер операцию (переопределен ли метод базового класса)"""
+        method: Optional[object] = getattr(type(self), operation, None)
+        return method is not None and method is not getattr(AnalysisProvider, operation, None)
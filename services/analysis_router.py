@@ -0,0 +1,425 @@
+import logging
+import time
+from datetime import date
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+from config import (
+    OPENAI_API_KEY,
+    ANALYSIS_BACKENDS,
+    ANALYSIS_PROVIDER_COSTS,
+    ANALYSIS_PROVIDER_DAILY_BUDGETS,
+    ANALYSIS_ROUTER_DEFAULT_LATENCY,
+    ANALYSIS_ROUTER_EWMA_ALPHA,
+    ANALYSIS_ROUTER_ERROR_PENALTY,
+    ANALYSIS_ROUTER_COST_WEIGHT,
+    GEMINI_STRUCTURED_OUTPUT,
+)
+from .analysis_provider import AnalysisProvider, ProgressCallback
+from .analysis_cache import analysis_cache
+from .correction_cache import correction_cache
+from .single_flight import single_flight, file_digest
+from .model_tiers import model_tiers
+from .adaptive_resolution import adaptive_resolution
+from .nutrition_schema import nutrition_problems
+from .gemini_scheduler import gemini_scheduler
+from .gemini_errors import GeminiServiceError
+from .gemini_retry import LatencyTracker
+from .circuit_breaker import circuit_breakers, is_backend_failure, is_bad_response, CircuitOpenError
+from utils import parse_nutrition_values, extract_portion_weight
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать метрики маршрутизации в лог (в запросах)
+STATS_LOG_INTERVAL = 50
+
+
+def create_provider(name: str) -> Optional[AnalysisProvider]:
+    """Создает провайдер анализа по имени из ANALYSIS_BACKENDS"""
+    if name == "main":
+        from .gemini_service import GeminiService
+        return GeminiService()
+    if name == "direct":
+        from .gemini_service_direct import GeminiService as DirectProvider
+        return DirectProvider()
+    if name == "vpn":
+        from .gemini_service_vpn import GeminiService as VPNProvider
+        return VPNProvider()
+    if name == "openai" and OPENAI_API_KEY:
+        from .openai_service import OpenAIService
+        return OpenAIService()
+    return None
+
+
+class AnalysisRouter:
+    """Выбор провайдера анализа для каждого запроса
+
+    Для каждого провайдера считаются EWMA времени ответа и доли ошибок.
+    Провайдеры сортируются по оценке
+        latency * (1 + error_penalty * error_rate) + cost_weight * cost,
+    провайдеры с открытым circuit breaker или исчерпанным дневным бюджетом
+    пропускаются. При сбое запрос переходит к следующему по оценке.
+    Провайдер без замеров получает default_latency, так что порядок
+    ANALYSIS_BACKENDS работает как начальный приоритет.
+    """
+
+    def __init__(self, backend_order: Optional[List[str]] = None,
+                 costs: Optional[Dict[str, float]] = None,
+                 daily_budgets: Optional[Dict[str, float]] = None,
+                 default_latency: float = ANALYSIS_ROUTER_DEFAULT_LATENCY,
+                 ewma_alpha: float = ANALYSIS_ROUTER_EWMA_ALPHA,
+                 error_penalty: float = ANALYSIS_ROUTER_ERROR_PENALTY,
+                 cost_weight: float = ANALYSIS_ROUTER_COST_WEIGHT):
+        self.backend_order = backend_order or ANALYSIS_BACKENDS or ["main"]
+        self.costs = dict(costs if costs is not None else ANALYSIS_PROVIDER_COSTS)
+        self.daily_budgets = dict(daily_budgets if daily_budgets is not None else ANALYSIS_PROVIDER_DAILY_BUDGETS)
+        self.default_latency = default_latency
+        self.ewma_alpha = ewma_alpha
+        self.error_penalty = error_penalty
+        self.cost_weight = cost_weight
+        self.structured_output = GEMINI_STRUCTURED_OUTPUT
+
+        # Провайдеры создаются при первом обращении (None - недоступен)
+        self._providers: Dict[str, Optional[AnalysisProvider]] = {}
+        self._stats = {name: self._new_stats() for name in self.backend_order}
+        self._routed_total = 0
+        self._failovers = 0
+
+    @staticmethod
+    def _new_stats() -> Dict:
+        return {
+            'ewma_latency': None,
+            'ewma_error_rate': 0.0,
+            'selected': 0,
+            'requests': 0,
+            'failures': 0,
+            'budget_day': date.today(),
+            'budget_used': 0.0,
+            'latency': LatencyTracker(),
+        }
+
+    def register_provider(self, provider: AnalysisProvider):
+        """Добавляет готовый провайдер (например, в тестах или для нового API)"""
+        self._providers[provider.name] = provider
+        self._stats.setdefault(provider.name, self._new_stats())
+        if provider.name not in self.backend_order:
+            self.backend_order.append(provider.name)
+
+    def _get_provider(self, name: str) -> Optional[AnalysisProvider]:
+        if name not in self._providers:
+            try:
+                self._providers[name] = create_provider(name)
+            except Exception as e:
+                logger.warning(f"Провайдер анализа {name} недоступен: {e}")
+                self._providers[name] = None
+        return self._providers[name]
+
+    def _budget_left(self, name: str) -> bool:
+        budget = self.daily_budgets.get(name)
+        if not budget:
+            return True
+        stats = self._stats[name]
+        if stats['budget_day'] != date.today():
+            stats['budget_day'] = date.today()
+            stats['budget_used'] = 0.0
+        return stats['budget_used'] < budget
+
+    def score(self, name: str) -> float:
+        """Оценка провайдера: чем меньше, тем лучше"""
+        stats = self._stats[name]
+        latency = stats['ewma_latency'] if stats['ewma_latency'] is not None else self.default_latency
+        return (latency * (1 + self.error_penalty * stats['ewma_error_rate'])
+                + self.cost_weight * self.costs.get(name, 0.0))
+
+    def rank_providers(self, operation: str) -> List[str]:
+        """Провайдеры, способные выполнить операцию, в порядке предпочтения"""
+        candidates = []
+        for index, name in enumerate(self.backend_order):
+            provider = self._get_provider(name)
+            if provider is None or not provider.supports(operation):
+                continue
+            if not circuit_breakers.get(name).is_available() or not self._budget_left(name):
+                continue
+            candidates.append((self.score(name), index, name))
+        return [name for _, _, name in sorted(candidates)]
+
+    def _record(self, name: str, success: bool, latency: float):
+        stats = self._stats[name]
+        alpha = self.ewma_alpha
+        stats['requests'] += 1
+        stats['budget_used'] += 1
+        stats['ewma_error_rate'] = alpha * (0.0 if success else 1.0) + (1 - alpha) * stats['ewma_error_rate']
+        if success:
+            stats['latency'].record(latency)
+            if stats['ewma_latency'] is None:
+                stats['ewma_latency'] = latency
+            else:
+                stats['ewma_latency'] = alpha * latency + (1 - alpha) * stats['ewma_latency']
+        else:
+            stats['failures'] += 1
+
+    async def route(self, operation: str, *args, on_progress: Optional[ProgressCallback] = None,
+                    model: Optional[str] = None, image_max_side: Optional[int] = None) -> Union[str, Dict]:
+        """
+        Выполняет операцию на лучшем доступном провайдере с переключением при сбое
+
+        on_progress передается только провайдерам с потоковым ответом,
+        model - только провайдерам с выбором модели, image_max_side - только
+        провайдерам с адаптивным разрешением.
+        """
+        ranked = self.rank_providers(operation)
+        if not ranked:
+            raise GeminiServiceError(f"Нет доступных провайдеров для {operation}")
+
+        self._routed_total += 1
+        last_error = None
+        for attempt, name in enumerate(ranked):
+            provider = self._providers[name]
+            breaker = circuit_breakers.get(name)
+            self._stats[name]['selected'] += 1
+            if attempt:
+                self._failovers += 1
+            logger.info(f"Маршрут {operation}: {name} (оценка {self.score(name):.1f}, кандидаты: {', '.join(ranked)})")
+
+            started = time.monotonic()
+            try:
+                kwargs = {'on_progress': on_progress} if on_progress and provider.supports_streaming else {}
+                if model and provider.supports_model_tiers:
+                    kwargs['model'] = model
+                if image_max_side and provider.supports_image_resolution:
+                    kwargs['image_max_side'] = image_max_side
+                result = await breaker.call(getattr(provider, operation), *args, **kwargs)
+            except CircuitOpenError as e:
+                last_error = e
+                continue
+            except GeminiServiceError as e:
+                failure = is_backend_failure(e)
+                self._record(name, not failure, time.monotonic() - started)
+                if not failure and not is_bad_response(e):
+                    # Ошибка самого запроса - на другом провайдере будет так же
+                    raise
+                logger.warning(f"Провайдер {name} не выполнил {operation}: {e}, пробуем следующий")
+                last_error = e
+                continue
+
+            self._record(name, True, time.monotonic() - started)
+            self._log_stats()
+            return result
+
+        self._log_stats()
+        raise last_error
+
+    async def _analyze(self, image_path: str, weight_grams: Optional[int],
+                       on_progress: Optional[ProgressCallback] = None, plan: Optional[str] = None) -> Dict:
+        """Анализ на модели уровня операции и тарифа, с повтором на основной модели при неправдоподобном ответе"""
+        operation = "analyze_food" if weight_grams else "analyze_food_auto_weight"
+        model = model_tiers.select(operation, plan)
+        result = await self._analyze_with_model(image_path, weight_grams, on_progress, model)
+
+        escalation_model = model_tiers.escalation_model(model)
+        if escalation_model:
+            nutrition = result['nutrition'] or parse_nutrition_values(result['analysis_text'])
+            problems = nutrition_problems(nutrition, weight_grams or extract_portion_weight(result['analysis_text']))
+            if problems:
+                model_tiers.record_escalation(operation, model, problems)
+                result = await self._analyze_with_model(image_path, weight_grams, on_progress, escalation_model)
+        return result
+
+    async def _analyze_with_model(self, image_path: str, weight_grams: Optional[int],
+                                  on_progress: Optional[ProgressCallback], model: str) -> Dict:
+        """Структурированный анализ, а если он недоступен - текстовый"""
+        if self.structured_output and self.rank_providers("analyze_food_structured"):
+            try:
+                return await self._analyze_structured(image_path, weight_grams, on_progress, model)
+            except GeminiServiceError as e:
+                if not (is_backend_failure(e) or is_bad_response(e)):
+                    raise
+                logger.warning(f"Структурированный анализ не удался ({e}), переходим на текстовый")
+
+        if weight_grams:
+            text = await self.route("analyze_food", image_path, weight_grams, on_progress=on_progress, model=model)
+        else:
+            text = await self.route("analyze_food_auto_weight", image_path, on_progress=on_progress, model=model)
+        return {'analysis_text': text, 'nutrition': None}
+
+    async def _analyze_structured(self, image_path: str, weight_grams: Optional[int],
+                                  on_progress: Optional[ProgressCallback], model: str) -> Dict:
+        """Структурированный анализ: сначала уменьшенная копия фото, при сомнениях - полное разрешение"""
+        if adaptive_resolution.enabled:
+            try:
+                result = await self.route("analyze_food_structured", image_path, weight_grams,
+                                          on_progress=on_progress, model=model,
+                                          image_max_side=adaptive_resolution.low_res_side)
+            except GeminiServiceError as e:
+                if not (is_backend_failure(e) or is_bad_response(e)):
+                    raise
+                # Ответ не прошел проверку схемы или запрос не удался - пробуем полное разрешение
+                adaptive_resolution.record(None, "ошибка ответа")
+            else:
+                image_stats = result.pop('image_stats', None)
+                if image_stats is None:
+                    # Провайдер без адаптивного разрешения уже получил фото целиком
+                    return result
+                reason = adaptive_resolution.rejection_reason(result['nutrition'], weight_grams)
+                adaptive_resolution.record(image_stats, reason)
+                if reason is None:
+                    return result
+
+        result = await self.route("analyze_food_structured", image_path, weight_grams,
+                                  on_progress=on_progress, model=model)
+        result.pop('image_stats', None)
+        return result
+
+    async def analyze_food(self, image_path: str, weight_grams: int, file_unique_id: Optional[str] = None,
+                           user_id: Optional[int] = None, subscription_type: Optional[str] = None,
+                           on_progress: Optional[ProgressCallback] = None, use_cache: bool = True) -> Dict:
+        """
+        Анализирует фото еды с указанным весом, используя кэш повторных фото
+
+        Args:
+            image_path: ссылка на фото в буфере (photo_store) или путь к файлу
+            weight_grams: вес еды в граммах
+            file_unique_id: file_unique_id фото из Telegram (ключ кэша)
+            user_id: ID пользователя (для очереди запросов)
+            subscription_type: тариф пользователя (приоритет в очереди)
+            on_progress: колбэк для промежуточного текста, пока ответ генерируется
+            use_cache: искать ли готовый анализ в кэше (False - нужен новый ответ модели)
+
+        Returns:
+            {'analysis_text': текст анализа КБЖУ и витаминов,
+             'nutrition': проверенные значения или None, если ответ был текстовым}
+        """
+        # Хэши фото считаются один раз вне цикла событий и нужны и для поиска, и для записи
+        dhash, digest = await analysis_cache.image_keys(image_path)
+        if use_cache:
+            cached = analysis_cache.lookup(dhash, digest, weight_grams=weight_grams, file_unique_id=file_unique_id,
+                                           user_id=user_id)
+            if cached:
+                return cached
+
+        async def compute(progress: ProgressCallback) -> Dict:
+            async with gemini_scheduler.slot(user_id, subscription_type):
+                result = await self._analyze(image_path, weight_grams, progress, subscription_type)
+            analysis_cache.store(dhash, digest, result['analysis_text'], weight_grams=weight_grams,
+                                 file_unique_id=file_unique_id, nutrition=result['nutrition'], user_id=user_id)
+            return result
+
+        return await self._single_flight("analyze_food", image_path, weight_grams, subscription_type,
+                                         compute, on_progress, digest)
+
+    async def analyze_food_auto_weight(self, image_path: str, file_unique_id: Optional[str] = None,
+                                       user_id: Optional[int] = None, subscription_type: Optional[str] = None,
+                                       on_progress: Optional[ProgressCallback] = None) -> Dict:
+        """
+        Анализирует фото еды с автоопределением веса, используя кэш повторных фото
+
+        Args:
+            image_path: ссылка на фото в буфере (photo_store) или путь к файлу
+            file_unique_id: file_unique_id фото из Telegram (ключ кэша)
+            user_id: ID пользователя (для очереди запросов)
+            subscription_type: тариф пользователя (приоритет в очереди)
+            on_progress: колбэк для промежуточного текста, пока ответ генерируется
+
+        Returns:
+            {'analysis_text', 'nutrition'} как в analyze_food, вес определяет модель
+        """
+        dhash, digest = await analysis_cache.image_keys(image_path)
+        cached = analysis_cache.lookup(dhash, digest, file_unique_id=file_unique_id, user_id=user_id)
+        if cached:
+            return cached
+
+        async def compute(progress: ProgressCallback) -> Dict:
+            async with gemini_scheduler.slot(user_id, subscription_type):
+                result = await self._analyze(image_path, None, progress, subscription_type)
+            analysis_cache.store(dhash, digest, result['analysis_text'], file_unique_id=file_unique_id,
+                                 nutrition=result['nutrition'], user_id=user_id)
+            return result
+
+        return await self._single_flight("analyze_food_auto_weight", image_path, None, subscription_type,
+                                         compute, on_progress, digest)
+
+    async def _single_flight(self, operation: str, image_path: str, weight_grams: Optional[int],
+                             subscription_type: Optional[str],
+                             compute: Callable[[ProgressCallback], Awaitable[Dict]],
+                             on_progress: Optional[ProgressCallback], digest: Optional[str] = None) -> Dict:
+        """Одновременные запросы с тем же фото, весом и моделью выполняются один раз"""
+        digest = digest or file_digest(image_path)
+        if digest is None:
+            return await compute(on_progress)
+        key = (operation, digest, weight_grams, model_tiers.resolve(operation, subscription_type))
+        return await single_flight.run(key, compute, on_progress)
+
+    async def locate_dishes(self, image_path: str, user_id: Optional[int] = None,
+                            subscription_type: Optional[str] = None) -> List[Dict]:
+        """Ищет отдельные блюда на фото (через очередь запросов, по уменьшенной копии фото)"""
+        model = model_tiers.select("locate_dishes", subscription_type)
+        async with gemini_scheduler.slot(user_id, subscription_type):
+            return await self.route("locate_dishes", image_path, model=model,
+                                    image_max_side=adaptive_resolution.low_res_side)
+
+    async def correct_analysis(self, original_analysis: str, user_correction: str,
+                               user_id: Optional[int] = None, subscription_type: Optional[str] = None) -> str:
+        """
+        Исправляет анализ на основе пользовательской коррекции (через очередь запросов)
+
+        Повторное такое же исправление берется из кэша, одновременные - объединяются.
+        """
+        async def compute() -> str:
+            model = model_tiers.select("correct_analysis", subscription_type)
+            async with gemini_scheduler.slot(user_id, subscription_type):
+                corrected = await self.route("correct_analysis", original_analysis, user_correction, model=model)
+                escalation_model = model_tiers.escalation_model(model)
+                if escalation_model:
+                    problems = nutrition_problems(parse_nutrition_values(corrected), extract_portion_weight(corrected))
+                    if problems:
+                        model_tiers.record_escalation("correct_analysis", model, problems)
+                        corrected = await self.route("correct_analysis", original_analysis, user_correction,
+                                                     model=escalation_model)
+                return corrected
+
+        return await correction_cache.get_or_compute(original_analysis, user_correction, compute)
+
+    def _log_stats(self):
+        if self._routed_total % STATS_LOG_INTERVAL:
+            return
+        parts = []
+        for name, stats in self.get_stats()['providers'].items():
+            if stats['requests']:
+                parts.append(
+                    f"{name}: {stats['selected']} выбран, p95 {stats['latency_p95'] or 0:.1f} с, "
+                    f"ошибки {stats['ewma_error_rate'] * 100:.0f}%, {stats['circuit']}"
+                )
+        logger.info(f"Маршрутизатор анализа ({self._routed_total} запросов, "
+                    f"переключений: {self._failovers}): " + "; ".join(parts))
+
+    def get_stats(self) -> Dict:
+        """Метрики маршрутизации: выбор провайдеров, задержки, ошибки, бюджеты, кэши анализов и очередь"""
+        providers = {}
+        for name, stats in self._stats.items():
+            providers[name] = {
+                'selected': stats['selected'],
+                'requests': stats['requests'],
+                'failures': stats['failures'],
+                'ewma_latency': stats['ewma_latency'],
+                'ewma_error_rate': stats['ewma_error_rate'],
+                'latency_p50': stats['latency'].percentile(50),
+                'latency_p95': stats['latency'].percentile(95),
+                'latency_p99': stats['latency'].percentile(99),
+                'score': self.score(name),
+                'budget_used': stats['budget_used'],
+                'daily_budget': self.daily_budgets.get(name),
+                'circuit': circuit_breakers.get(name).state,
+            }
+        return {
+            'routed': self._routed_total,
+            'failovers': self._failovers,
+            'providers': providers,
+            'single_flight': single_flight.get_stats(),
+            'models': model_tiers.get_stats(),
+            'adaptive_resolution': adaptive_resolution.get_stats(),
+            'analysis_cache': analysis_cache.get_stats(),
+            'correction_cache': correction_cache.get_stats(),
+            'scheduler': gemini_scheduler.get_stats(),
+        }
+
+
+# Глобальный маршрутизатор запросов анализа
+analysis_router = AnalysisRouter()
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
@@ -13,15 +13,20 @@ class AnalysisStorage:
         self._storage: Dict[int, Dict[str, Any]] = {}
         self._cleanup_interval = timedelta(hours=2)  # Очищаем старые записи через 2 часа
     
-    def store_analysis(self, user_id: int, analysis_text: str, image_path: str, weight: Optional[int] = None):
+    def store_analysis(self, user_id: int, analysis_text: str, image_path: str, weight: Optional[int] = None,
+                       nutrition: Optional[Dict] = None, is_multi_dish: bool = False,
+                       dishes: Optional[List[Dict]] = None):
         """
         Сохраняет последний анализ пользователя
         
         Args:
             user_id: ID пользователя Telegram
             analysis_text: Текст анализа от Gemini
-            image_path: Путь к изображению (для повторного анализа)
+            image_path: Ссылка на фото в photo_store (для повторного анализа, пока фото в буфере)
             weight: Вес в граммах (если был указан)
+            nutrition: Проверенные значения структурированного ответа (для локальных исправлений)
+            is_multi_dish: Анализ мульти-тарелки
+            dishes: Анализы отдельных блюд мульти-тарелки (для исправления по блюдам)
         """
         if user_id is None:
             logger.error("user_id не может быть None")
@@ -31,6 +36,9 @@ class AnalysisStorage:
             'analysis_text': analysis_text,
             'image_path': image_path,
             'weight': weight,
+            'nutrition': nutrition,
+            'is_multi_dish': is_multi_dish,
+            'dishes': dishes or [],
             'timestamp': datetime.now(),
             'original_analysis': analysis_text  # Сохраняем оригинальный анализ
         }
@@ -57,16 +65,22 @@ class AnalysisStorage:
         
         return analysis
     
-    def update_analysis(self, user_id: int, updated_analysis: str):
+    def update_analysis(self, user_id: int, updated_analysis: str, nutrition: Optional[Dict] = None,
+                        weight: Optional[int] = None):
         """
         Обновляет анализ пользователя
         
         Args:
             user_id: ID пользователя Telegram  
             updated_analysis: Обновленный текст анализа
+            nutrition: Значения исправленного анализа (None - известен только текст)
+            weight: Новый вес в граммах (если исправление его изменило)
         """
         if user_id in self._storage:
             self._storage[user_id]['analysis_text'] = updated_analysis
+            self._storage[user_id]['nutrition'] = nutrition
+            if weight is not None:
+                self._storage[user_id]['weight'] = weight
             self._storage[user_id]['timestamp'] = datetime.now()
             logger.info(f"Обновлен анализ для пользователя {user_id}")
     
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+import aiohttp
+from config import (
+    CIRCUIT_BREAKER_WINDOW,
+    CIRCUIT_BREAKER_MIN_CALLS,
+    CIRCUIT_BREAKER_FAILURE_RATE,
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+    CIRCUIT_BREAKER_SLOW_CALL_RATE,
+    CIRCUIT_BREAKER_OPEN_SECONDS,
+    CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+)
+from .gemini_errors import GeminiServiceError, GeminiRetryableError, GeminiQueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Сбои соединения и тайм-ауты (в том числе обернутые провайдерами в GeminiServiceError)
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+
+
+class CircuitOpenError(GeminiServiceError):
+    """Бэкенд временно отключен circuit breaker'ом - запрос не отправлялся"""
+
+    def __init__(self, backend: str, retry_in: float):
+        super().__init__(f"Бэкенд {backend} недоступен (circuit open), повтор через {retry_in:.0f} с")
+        self.backend = backend
+        self.retry_in = retry_in
+
+
+def _is_transport_error(error: Optional[BaseException]) -> bool:
+    while error is not None:
+        if isinstance(error, TRANSPORT_ERRORS):
+            return True
+        error = error.__cause__
+    return False
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """Ошибка говорит о проблеме бэкенда: сбой соединения, тайм-аут, 5xx или 429"""
+    if isinstance(error, (GeminiQueueTimeoutError, CircuitOpenError)):
+        return False
+    if isinstance(error, GeminiRetryableError):
+        return True
+    status = getattr(error, 'status', None)
+    if status is not None:
+        # 4xx (кроме 429) - проблема запроса, бэкенд при этом исправен
+        return status >= 500 or status == 429
+    # Без статуса ответа - только сбой соединения; ошибки разбора и проверки
+    # схемы значат, что бэкенд ответил, и не открывают цепь
+    return _is_transport_error(error)
+
+
+def is_bad_response(error: Exception) -> bool:
+    """Бэкенд ответил, но ответ не разобран или не прошел проверку схемы (стоит попробовать иначе)"""
+    return (isinstance(error, GeminiServiceError)
+            and not isinstance(error, (GeminiQueueTimeoutError, CircuitOpenError))
+            and error.status is None and not is_backend_failure(error))
+
+
+class CircuitBreaker:
+    """Circuit breaker для одного бэкенда анализа
+
+    - closed: запросы идут, результаты пишутся в скользящее окно
+    - open: доля ошибок или медленных ответов в окне превысила порог,
+      запросы сразу отклоняются CircuitOpenError в течение open_seconds
+    - half_open: пропускается несколько пробных запросов; успех закрывает
+      цепь, ошибка снова открывает ее
+    """
+
+    def __init__(self, name: str, window_size: int = CIRCUIT_BREAKER_WINDOW,
+                 min_calls: int = CIRCUIT_BREAKER_MIN_CALLS,
+                 failure_rate: float = CIRCUIT_BREAKER_FAILURE_RATE,
+                 slow_call_seconds: float = CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate: float = CIRCUIT_BREAKER_SLOW_CALL_RATE,
+                 open_seconds: float = CIRCUIT_BREAKER_OPEN_SECONDS,
+                 half_open_calls: int = CIRCUIT_BREAKER_HALF_OPEN_CALLS):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        # (успех, время ответа) последних запросов
+        self._window: Deque[Tuple[bool, float]] = deque(maxlen=window_size)
+        self._stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self._stats['opened'] += 1
+        elif state == CLOSED:
+            self._window.clear()
+        self._half_open_in_flight = 0
+
+    def retry_in(self) -> float:
+        """Сколько секунд осталось до пробного запроса (0 - запросы разрешены)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def is_available(self) -> bool:
+        """Можно ли сейчас отправить запрос в этот бэкенд (без занятия пробного слота)"""
+        if self.state == OPEN:
+            return self.retry_in() == 0
+        if self.state == HALF_OPEN:
+            return self._half_open_in_flight < self.half_open_calls
+        return True
+
+    def _acquire(self):
+        if self.state == OPEN and self.retry_in() == 0:
+            self._transition(HALF_OPEN)
+        if self.state == OPEN or (
+                self.state == HALF_OPEN and self._half_open_in_flight >= self.half_open_calls):
+            self._stats['rejected'] += 1
+            raise CircuitOpenError(self.name, self.retry_in())
+        if self.state == HALF_OPEN:
+            self._half_open_in_flight += 1
+
+    def _record(self, success: bool, latency: float):
+        self._stats['calls'] += 1
+        if not success:
+            self._stats['failures'] += 1
+
+        if self.state == HALF_OPEN:
+            self._transition(CLOSED if success else OPEN)
+            return
+
+        self._window.append((success, latency))
+        if len(self._window) < self.min_calls:
+            return
+        failures = sum(1 for ok, _ in self._window if not ok)
+        slow = sum(1 for _, elapsed in self._window if elapsed >= self.slow_call_seconds)
+        if failures / len(self._window) >= self.failure_rate:
+            logger.error(f"Circuit breaker {self.name}: {failures}/{len(self._window)} ошибок, отключаем бэкенд")
+            self._transition(OPEN)
+        elif slow / len(self._window) >= self.slow_call_rate:
+            logger.error(f"Circuit breaker {self.name}: {slow}/{len(self._window)} медленных ответов, отключаем бэкенд")
+            self._transition(OPEN)
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Выполняет запрос через breaker, при открытой цепи сразу бросает CircuitOpenError"""
+        self._acquire()
+        probe = self.state == HALF_OPEN
+        started = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self._record(not is_backend_failure(e), time.monotonic() - started)
+            raise
+        except BaseException:
+            # Отмена запроса ничего не говорит о здоровье бэкенда
+            if probe and self.state == HALF_OPEN:
+                self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+            raise
+        self._record(True, time.monotonic() - started)
+        return result
+
+    def get_stats(self) -> Dict:
+        window = list(self._window)
+        return {
+            **self._stats,
+            'state': self.state,
+            'retry_in': self.retry_in(),
+            'window_size': len(window),
+            'window_failure_rate': (sum(1 for ok, _ in window if not ok) / len(window)) if window else 0.0,
+        }
+
+
+class CircuitBreakerRegistry:
+    """Реестр circuit breaker'ов по именам бэкендов"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(name)
+        return self._breakers[name]
+
+    def get_stats(self) -> Dict:
+        return {name: breaker.get_stats() for name, breaker in self._breakers.items()}
+
+
+# Глобальный реестр circuit breaker'ов бэкендов анализа
+circuit_breakers = CircuitBreakerRegistry()
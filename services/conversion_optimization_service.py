@@ -2,6 +2,7 @@ import logging
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 from services.firebase_service import FirebaseService
+from services.firestore_executor import firestore_executor
 from services.subscription_service import SubscriptionService
 
 logger = logging.getLogger(__name__)
@@ -46,7 +47,7 @@ class ConversionOptimizationService:
             today = datetime.now().strftime('%Y-%m-%d')
             week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
             
-            today_analyses = await self.firebase_service.get_daily_analyses(user_id, today)
+            today_meals = (await self.firebase_service.get_daily_nutrition(user_id, today))['meals']
             week_analyses = await self.firebase_service.get_weekly_analyses(user_id, week_ago)
             
             # Подсчитываем серию дней
@@ -54,13 +55,13 @@ class ConversionOptimizationService:
             
             # Определяем лучший триггер
             best_trigger = await self._determine_best_trigger(
-                user_id, subscription, len(today_analyses), len(week_analyses), streak_days
+                user_id, subscription, today_meals, len(week_analyses), streak_days
             )
             
             return {
                 "user_id": user_id,
                 "subscription_type": subscription.get('type', 'lite'),
-                "daily_count": len(today_analyses),
+                "daily_count": today_meals,
                 "weekly_count": len(week_analyses),
                 "streak_days": streak_days,
                 "best_trigger": best_trigger,
@@ -86,14 +87,12 @@ class ConversionOptimizationService:
         try:
             streak = 0
             current_date = datetime.now().date()
+            # Последние 30 дней одним чтением сводок, без пересчета старых дней
+            dates = [(current_date - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(30)]
+            meals = await self.firebase_service.get_daily_meals(user_id, dates)
             
-            for i in range(30):  # Проверяем последние 30 дней
-                check_date = current_date - timedelta(days=i)
-                analyses = await self.firebase_service.get_daily_analyses(
-                    user_id, check_date.strftime('%Y-%m-%d')
-                )
-                
-                if analyses:
+            for date in dates:
+                if meals[date]:
                     streak += 1
                 else:
                     break
@@ -237,8 +236,7 @@ class ConversionOptimizationService:
             }
             
             # Сохраняем в Firebase
-            events_ref = self.firebase_service.db.collection('conversion_events')
-            events_ref.add(event_data)
+            await self.firebase_service.add_document('conversion_events', event_data, 'track_conversion_event')
             
             logger.info(f"Событие конверсии отслежено: {event_type} для пользователя {user_id}")
             
@@ -253,7 +251,7 @@ class ConversionOptimizationService:
             
             events_ref = self.firebase_service.db.collection('conversion_events')
             query = events_ref.where('timestamp', '>=', thirty_days_ago)
-            docs = query.stream()
+            docs = await firestore_executor.stream('get_conversion_stats', query)
             
             events = []
             for doc in docs:
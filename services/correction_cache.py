@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+from config import (
+    CORRECTION_CACHE_ENABLED,
+    CORRECTION_CACHE_MAX_SIZE,
+    CORRECTION_CACHE_TTL_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику кэша в лог (в обращениях)
+STATS_LOG_INTERVAL = 50
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_correction(text: str) -> str:
+    """Приводит текст исправления к виду для сравнения: регистр, пробелы и знаки препинания"""
+    text = _PUNCTUATION_RE.sub(' ', (text or '').lower().replace('ё', 'е'))
+    return _SPACES_RE.sub(' ', text).strip()
+
+
+def correction_key(original_analysis: str, user_correction: str) -> str:
+    """Ключ кэша: хэш исходного анализа и нормализованного исправления"""
+    digest = hashlib.sha256()
+    digest.update(original_analysis.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(normalize_correction(user_correction).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class CorrectionCache:
+    """LRU кэш исправлений анализа с TTL и объединением одинаковых запросов
+
+    Повторное исправление (после ошибки отправки или двойного нажатия)
+    берется из кэша. Если такой же запрос уже выполняется, второй ждет его
+    результат вместо нового вызова модели. Ошибки не кэшируются.
+    """
+
+    def __init__(self, max_size: int = CORRECTION_CACHE_MAX_SIZE, ttl_seconds: int = CORRECTION_CACHE_TTL_SECONDS,
+                 enabled: bool = CORRECTION_CACHE_ENABLED):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+
+        # ключ -> (исправленный анализ, время записи)
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # ключ -> выполняющийся запрос к модели
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+        self._stats = {
+            'hits': 0,
+            'coalesced': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    async def get_or_compute(self, original_analysis: str, user_correction: str,
+                             compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        Возвращает исправленный анализ из кэша, из уже идущего запроса или вызывает compute
+
+        Args:
+            original_analysis: исходный текст анализа
+            user_correction: текст исправления пользователя
+            compute: фабрика корутины, выполняющей исправление моделью
+        """
+        if not self.enabled:
+            return await compute()
+
+        key = correction_key(original_analysis, user_correction)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() - entry['created_at'] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                logger.info("Исправление найдено в кэше")
+                return entry['result']
+            del self._entries[key]
+            self._stats['expirations'] += 1
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._count('coalesced')
+            logger.info("Такое же исправление уже выполняется, ждем его результат")
+        else:
+            self._count('misses')
+            task = asyncio.create_task(compute())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._on_done(key, done))
+
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = {'result': task.result(), 'created_at': time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _count(self, counter: str):
+        self._stats[counter] += 1
+        lookups = self._stats['hits'] + self._stats['coalesced'] + self._stats['misses']
+        if lookups % STATS_LOG_INTERVAL == 0:
+            stats = self.get_stats()
+            logger.info(
+                f"Кэш исправлений: {stats['hits']} попаданий, {stats['coalesced']} объединено "
+                f"из {stats['lookups']}, записей: {stats['size']}"
+            )
+
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики кэша (попадания и объединения - сэкономленные вызовы Gemini)"""
+        lookups = self._stats['hits'] + self._stats['coalesced'] + self._stats['misses']
+        return {
+            **self._stats,
+            'lookups': lookups,
+            'gemini_calls_saved': self._stats['hits'] + self._stats['coalesced'],
+            'in_flight': len(self._in_flight),
+            'size': len(self._entries),
+        }
+
+    def clear(self):
+        """Очищает кэш (выполняющиеся запросы не отменяются)"""
+        self._entries.clear()
+
+
+# Глобальный экземпляр кэша исправлений
+correction_cache = CorrectionCache()
@@ -0,0 +1,91 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+from firebase_admin import firestore
+
+# Числовые поля сводки дня (складываются через Increment)
+ROLLUP_FIELDS = ('calories', 'proteins', 'fats', 'carbs')
+
+# Допустимое расхождение сводки и пересчета по анализам (ошибки округления float)
+ROLLUP_TOLERANCE = 0.5
+
+
+def empty_totals() -> Dict:
+    """Итоги дня без анализов"""
+    return {'calories': 0, 'proteins': 0, 'fats': 0, 'carbs': 0, 'vitamins': {}, 'meals': 0}
+
+
+def rollup_increment(nutrition: Dict, date: str, meals: int = 1) -> Dict:
+    """Запись в сводку users/{id}/daily/{date} для нового анализа (set с merge=True)"""
+    update = {
+        'date': date,
+        'meals': firestore.Increment(meals),
+        'updated_at': datetime.now(),
+    }
+    for field in ROLLUP_FIELDS:
+        update[field] = firestore.Increment(nutrition.get(field) or 0)
+    # Витамины за день - максимум по анализам, как в aggregate_daily_nutrition
+    if nutrition.get('vitamins'):
+        update['vitamins'] = {name: firestore.Maximum(percent) for name, percent in nutrition['vitamins'].items()}
+    return update
+
+
+def rollup_change(old: Dict, new: Dict, date: str) -> Dict:
+    """
+    Запись в сводку при исправлении анализа: разница старых и новых значений
+
+    Максимум витаминов нельзя уменьшить приращением: если витамин исправлен
+    в меньшую сторону или удален, сводка помечается needs_rebuild и
+    пересчитывается по анализам в фоне после следующего чтения.
+    """
+    update = {'date': date, 'updated_at': datetime.now()}
+    for field in ROLLUP_FIELDS:
+        update[field] = firestore.Increment((new.get(field) or 0) - (old.get(field) or 0))
+    old_vitamins = old.get('vitamins') or {}
+    new_vitamins = new.get('vitamins') or {}
+    if new_vitamins:
+        update['vitamins'] = {name: firestore.Maximum(percent) for name, percent in new_vitamins.items()}
+    if any(new_vitamins.get(name, 0) < percent for name, percent in old_vitamins.items()):
+        update['needs_rebuild'] = True
+    return update
+
+
+def rollup_document(totals: Dict, date: str) -> Dict:
+    """Сводка дня целиком (пересчет по анализам)"""
+    return {
+        **{field: totals[field] for field in ROLLUP_FIELDS},
+        'vitamins': dict(totals['vitamins']),
+        'meals': totals['meals'],
+        'date': date,
+        'needs_rebuild': False,
+        'updated_at': datetime.now(),
+        'rebuilt_at': datetime.now(),
+    }
+
+
+def rollup_totals(data: Dict) -> Dict:
+    """Итоги дня из документа сводки (в формате aggregate_daily_nutrition и число приемов пищи)"""
+    return {
+        'calories': round(data.get('calories') or 0),
+        'proteins': round(data.get('proteins') or 0, 1),
+        'fats': round(data.get('fats') or 0, 1),
+        'carbs': round(data.get('carbs') or 0, 1),
+        'vitamins': dict(data.get('vitamins') or {}),
+        'meals': int(data.get('meals') or 0),
+    }
+
+
+def rollup_differences(rollup: Optional[Dict], totals: Dict) -> List[str]:
+    """Расхождения сводки с пересчетом по анализам (пусто - сводка верна)"""
+    if rollup is None:
+        return ["сводки нет"] if totals['meals'] else []
+    differences = []
+    if int(rollup.get('meals') or 0) != totals['meals']:
+        differences.append(f"meals: {rollup.get('meals')} != {totals['meals']}")
+    for field in ROLLUP_FIELDS:
+        if abs((rollup.get(field) or 0) - totals[field]) > ROLLUP_TOLERANCE:
+            differences.append(f"{field}: {rollup.get(field)} != {totals[field]}")
+    if (rollup.get('vitamins') or {}) != totals['vitamins']:
+        differences.append("vitamins")
+    if rollup.get('needs_rebuild'):
+        differences.append("needs_rebuild")
+    return differences
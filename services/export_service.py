@@ -57,9 +57,7 @@ class ExportService:
             
             # Данные
             for analysis in analyses:
-                nutrition = self.firebase_service.parse_nutrition_data(
-                    analysis.get('analysis_text', '')
-                )
+                nutrition = self.firebase_service.get_analysis_nutrition(analysis)
                 
                 timestamp = analysis.get('timestamp', datetime.now())
                 if isinstance(timestamp, str):
@@ -1,15 +1,62 @@
+import asyncio
 import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime, timedelta
 import logging
-from typing import Dict, List, Optional
-from config import FIREBASE_CREDENTIALS_PATH
+from typing import Dict, List, Optional, Tuple
+from config import (
+    FIREBASE_CREDENTIALS_PATH,
+    DAILY_ROLLUP_REBUILD_CONCURRENCY,
+    DAILY_ROLLUP_REBUILD_QUEUE,
+)
+from utils import parse_nutrition_values
+from .firestore_executor import firestore_executor, FirestoreTimeoutError
+from .user_context import current_user_context, WRITE_UPDATE, WRITE_MERGE
+from .user_cache import user_document_cache
+from .daily_rollup import (
+    empty_totals,
+    rollup_increment,
+    rollup_change,
+    rollup_document,
+    rollup_totals,
+    rollup_differences,
+)
 
 logger = logging.getLogger(__name__)
 
+# Версия числовых полей КБЖУ в документе анализа (при изменении разбора - повторить миграцию)
+NUTRITION_FIELDS_VERSION = 2
+
 class FirebaseService:
+    """Хранение пользователей и анализов в Firestore
+
+    Клиент Firestore синхронный, поэтому все запросы идут через
+    firestore_executor (пул потоков с тайм-аутом) и не блокируют цикл
+    событий. Другие сервисы пишут в документ пользователя через
+    update_user/merge_user, а не через self.db напрямую. Во время апдейта
+    пользователя документ читается один раз (UserContext), а записи в него
+    откладываются до одного batch-коммита в конце апдейта (кроме записей
+    с immediate=True, которые сохраняются до ответа пользователю). Между апдейтами
+    документы пользователей берутся из user_document_cache.
+
+    Итоги дня хранятся в сводке users/{id}/daily/{date}: save_analysis и
+    update_analysis меняют ее в том же коммите, что и анализ, и чтение
+    итогов дня - один документ вместо всех анализов дня. Неполные сводки
+    (needs_rebuild) читатели не пересчитывают сами: итоги считаются по
+    анализам без записи, а сводка пересчитывается в фоне (не больше
+    DAILY_ROLLUP_REBUILD_CONCURRENCY пересчетов одновременно на экземпляр). Дни,
+    начатые до появления сводок, пересчитывает backfill из daily_rollups.py.
+
+    КБЖУ анализа (calories, proteins, fats, carbs, vitamins, products)
+    разбираются один раз при записи и хранятся полями документа; текст
+    разбирается только для старых анализов без этих полей.
+    """
+
     def __init__(self):
         self.db = None
+        # Фоновые пересчеты сводок дня: (user_id, date) -> задача; семафор создается в работающем цикле
+        self._rebuild_tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._rebuild_slots: Optional[asyncio.Semaphore] = None
         self._initialize_firebase()
     
     def _initialize_firebase(self):
@@ -31,8 +78,14 @@ class FirebaseService:
             doc_ref = self.db.collection('users').document(str(user_id)).collection('analyses').document()
             analysis_data['timestamp'] = datetime.now()
             analysis_data['date'] = datetime.now().strftime('%Y-%m-%d')
+            analysis_data.update(self.nutrition_fields(analysis_data))
+            rollup = rollup_increment(self.get_analysis_nutrition(analysis_data), analysis_data['date'])
             
-            doc_ref.set(analysis_data)
+            # Анализ и сводка дня записываются одним коммитом
+            batch = self.db.batch()
+            batch.set(doc_ref, analysis_data)
+            batch.set(self._daily_ref(user_id, analysis_data['date']), rollup, merge=True)
+            await firestore_executor.run('save_analysis', batch.commit)
             logger.info(f"Анализ сохранен для пользователя {user_id}")
             return doc_ref.id
         except Exception as e:
@@ -45,19 +98,135 @@ class FirebaseService:
             doc_ref = self.db.collection('users').document(str(user_id)).collection('analyses').document(analysis_id)
             analysis_data['updated_at'] = datetime.now()
             
-            doc_ref.update(analysis_data)
+            # Разница с прежними значениями попадает в сводку дня в той же транзакции
+            await firestore_executor.run('update_analysis', firestore.transactional(self._update_analysis_sync),
+                                         self.db.transaction(), user_id, doc_ref, analysis_data)
             logger.info(f"Анализ {analysis_id} обновлен для пользователя {user_id}")
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления анализа: {e}")
             return False
     
+    def _daily_ref(self, user_id: int, date: str):
+        return self.db.collection('users').document(str(user_id)).collection('daily').document(date)
+
+    def _update_analysis_sync(self, transaction, user_id: int, doc_ref, analysis_data: Dict):
+        """Обновление анализа и сводки дня (в потоке; транзакция повторяется при конфликте)"""
+        snapshot = doc_ref.get(transaction=transaction)
+        old = snapshot.to_dict() if snapshot.exists else None
+        if old is None:
+            # Несуществующий анализ: update вернет NotFound, как без транзакции
+            transaction.update(doc_ref, analysis_data)
+            return
+        new = {**old, **analysis_data}
+        if 'analysis_text' in analysis_data or 'nutrition' in analysis_data:
+            # Числовые поля пересчитываются по исправленному анализу
+            fields = self.nutrition_fields(new)
+            new.update(fields)
+            analysis_data = {**analysis_data, **fields}
+        transaction.update(doc_ref, analysis_data)
+        if old.get('date'):
+            transaction.set(self._daily_ref(user_id, old['date']),
+                            rollup_change(self.get_analysis_nutrition(old), self.get_analysis_nutrition(new),
+                                          old['date']),
+                            merge=True)
+
+    def _rebuild_daily_sync(self, transaction, user_id: int, date: str) -> Dict:
+        analyses_ref = self.db.collection('users').document(str(user_id)).collection('analyses')
+        analyses = [doc.to_dict() for doc in transaction.get(analyses_ref.where('date', '==', date))]
+        totals = {**self._aggregate(analyses), 'meals': len(analyses)}
+        if analyses:
+            transaction.set(self._daily_ref(user_id, date), rollup_document(totals, date))
+        return totals
+
+    async def rebuild_daily_rollup(self, user_id: int, date: str) -> Dict:
+        """
+        Пересчитывает сводку дня по анализам (в транзакции, чтобы не потерять одновременный save_analysis)
+        
+        Returns:
+            итоги дня (дни без анализов не записываются)
+        """
+        return await firestore_executor.run('rebuild_daily_rollup', firestore.transactional(self._rebuild_daily_sync),
+                                            self.db.transaction(), user_id, date)
+
+    async def get_daily_nutrition(self, user_id: int, date: str) -> Dict:
+        """
+        Итоги дня из сводки: calories, proteins, fats, carbs, vitamins и meals (число анализов)
+        
+        Если сводки нет (день до появления сводок) или она помечена needs_rebuild,
+        итоги считаются по анализам дня без записи, а сводка пересчитывается в фоне.
+        """
+        try:
+            snapshot = await firestore_executor.run('get_daily_nutrition', self._daily_ref(user_id, date).get)
+            if snapshot.exists and not snapshot.to_dict().get('needs_rebuild'):
+                return rollup_totals(snapshot.to_dict())
+            analyses = await self.get_daily_analyses(user_id, date)
+            if analyses or snapshot.exists:
+                self._schedule_rollup_rebuild(user_id, date)
+            return rollup_totals({**self._aggregate(analyses), 'meals': len(analyses)})
+        except Exception as e:
+            logger.error(f"Ошибка получения итогов дня: {e}")
+            return empty_totals()
+
+    def _schedule_rollup_rebuild(self, user_id: int, date: str):
+        """Ставит пересчет сводки дня в фон (повторный запрос того же дня и переполненная очередь пропускаются)"""
+        key = (user_id, date)
+        if key in self._rebuild_tasks or len(self._rebuild_tasks) >= DAILY_ROLLUP_REBUILD_QUEUE:
+            return
+        self._rebuild_tasks[key] = asyncio.create_task(self._rebuild_in_background(user_id, date))
+
+    def _rebuild_semaphore(self) -> asyncio.Semaphore:
+        if self._rebuild_slots is None:
+            self._rebuild_slots = asyncio.Semaphore(DAILY_ROLLUP_REBUILD_CONCURRENCY)
+        return self._rebuild_slots
+
+    async def _rebuild_in_background(self, user_id: int, date: str):
+        try:
+            async with self._rebuild_semaphore():
+                await self.rebuild_daily_rollup(user_id, date)
+            logger.info(f"Сводка дня {date} пересчитана для пользователя {user_id}")
+        except Exception as e:
+            logger.warning(f"Не удалось пересчитать сводку дня {date} для пользователя {user_id}: {e}")
+        finally:
+            self._rebuild_tasks.pop((user_id, date), None)
+
+    async def get_daily_meals(self, user_id: int, dates: List[str]) -> Dict[str, int]:
+        """
+        Число анализов по дням только из сводок (без пересчета и чтения анализов)
+
+        Дни без сводки получают 0: старые дни заполняет backfill из daily_rollups.py.
+        """
+        try:
+            refs = [self._daily_ref(user_id, date) for date in dates]
+            snapshots = await firestore_executor.run('get_daily_meals', lambda: list(self.db.get_all(refs)))
+            meals = {date: 0 for date in dates}
+            for snapshot in snapshots:
+                if snapshot.exists:
+                    meals[snapshot.id] = snapshot.to_dict().get('meals') or 0
+            return meals
+        except Exception as e:
+            logger.error(f"Ошибка получения сводок дней: {e}")
+            return {date: 0 for date in dates}
+
+    async def check_daily_rollup(self, user_id: int, date: str) -> List[str]:
+        """Сравнивает сводку дня с пересчетом по анализам; возвращает расхождения (пусто - сводка верна)"""
+        snapshot = await firestore_executor.run('check_daily_rollup', self._daily_ref(user_id, date).get)
+        analyses = await self.get_daily_analyses(user_id, date)
+        totals = {**self._aggregate(analyses), 'meals': len(analyses)}
+        return rollup_differences(snapshot.to_dict() if snapshot.exists else None, totals)
+
+    async def get_analysis_dates(self, user_id: int) -> List[str]:
+        """Дни, за которые у пользователя есть анализы (для пересчета сводок)"""
+        analyses_ref = self.db.collection('users').document(str(user_id)).collection('analyses')
+        docs = await firestore_executor.stream('get_analysis_dates', analyses_ref.select(['date']))
+        return sorted({doc.to_dict().get('date') for doc in docs} - {None})
+
     async def get_daily_analyses(self, user_id: int, date: str) -> List[Dict]:
         """Получает все анализы пользователя за день"""
         try:
             analyses_ref = self.db.collection('users').document(str(user_id)).collection('analyses')
             query = analyses_ref.where('date', '==', date)
-            docs = query.stream()
+            docs = await firestore_executor.stream('get_daily_analyses', query)
             
             analyses = []
             for doc in docs:
@@ -78,7 +247,7 @@ class FirebaseService:
             
             analyses_ref = self.db.collection('users').document(str(user_id)).collection('analyses')
             query = analyses_ref.where('timestamp', '>=', start_dt).where('timestamp', '<', end_dt)
-            docs = query.stream()
+            docs = await firestore_executor.stream('get_weekly_analyses', query)
             
             analyses = []
             for doc in docs:
@@ -94,8 +263,6 @@ class FirebaseService:
     async def create_or_update_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None, timezone: str = None) -> bool:
         """Создает или обновляет данные пользователя в Firestore"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
-            
             user_data = {
                 'user_id': user_id,
                 'created_at': datetime.now(),
@@ -112,7 +279,7 @@ class FirebaseService:
                 user_data['timezone'] = timezone
             
             # Используем merge=True чтобы не перезаписывать существующие данные
-            user_ref.set(user_data, merge=True)
+            await self.merge_user(user_id, user_data, 'create_or_update_user')
             logger.info(f"Пользователь {user_id} создан/обновлен с username: {username}, timezone: {timezone}")
             return True
         except Exception as e:
@@ -122,14 +289,13 @@ class FirebaseService:
     async def save_user_google_tokens(self, user_id: int, tokens: Dict) -> bool:
         """Сохраняет OAuth токены пользователя Google в Firestore"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
             data = {
                 'google': {
                     'tokens': tokens,
                     'updated_at': datetime.now()
                 }
             }
-            user_ref.set(data, merge=True)
+            await self.merge_user(user_id, data, 'save_user_google_tokens')
             logger.info(f"Google токены сохранены для пользователя {user_id}")
             return True
         except Exception as e:
@@ -139,10 +305,9 @@ class FirebaseService:
     async def get_user_google_tokens(self, user_id: int) -> Optional[Dict]:
         """Возвращает OAuth токены Google пользователя"""
         try:
-            doc = self.db.collection('users').document(str(user_id)).get()
-            if not doc.exists:
+            data = await self._get_user_document(user_id, 'get_user_google_tokens')
+            if data is None:
                 return None
-            data = doc.to_dict()
             return (data.get('google') or {}).get('tokens')
         except Exception as e:
             logger.error(f"Ошибка получения Google токенов: {e}")
@@ -151,14 +316,13 @@ class FirebaseService:
     async def save_user_calendar_id(self, user_id: int, calendar_id: str) -> bool:
         """Сохраняет идентификатор календаря питания пользователя"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
             data = {
                 'google': {
                     'calendar_id': calendar_id,
                     'updated_at': datetime.now()
                 }
             }
-            user_ref.set(data, merge=True)
+            await self.merge_user(user_id, data, 'save_user_calendar_id')
             logger.info(f"Сохранен calendar_id для пользователя {user_id}")
             return True
         except Exception as e:
@@ -168,9 +332,8 @@ class FirebaseService:
     async def get_user_calendar_id(self, user_id: int) -> Optional[str]:
         """Возвращает идентификатор календаря питания пользователя, если есть"""
         try:
-            doc = self.db.collection('users').document(str(user_id)).get()
-            if doc.exists:
-                data = doc.to_dict()
+            data = await self._get_user_document(user_id, 'get_user_calendar_id')
+            if data is not None:
                 google = data.get('google') or {}
                 return google.get('calendar_id')
             return None
@@ -181,10 +344,9 @@ class FirebaseService:
     async def delete_user_google_tokens(self, user_id: int) -> bool:
         """Удаляет Google токены пользователя"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.update_user(user_id, {
                 'google.tokens': firestore.DELETE_FIELD
-            })
+            }, 'delete_user_google_tokens')
             logger.info(f"Google токены удалены для пользователя {user_id}")
             return True
         except Exception as e:
@@ -194,24 +356,39 @@ class FirebaseService:
     async def delete_user_calendar_id(self, user_id: int) -> bool:
         """Удаляет calendar_id пользователя"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.update_user(user_id, {
                 'google.calendar_id': firestore.DELETE_FIELD
-            })
+            }, 'delete_user_calendar_id')
             logger.info(f"Calendar ID удален для пользователя {user_id}")
             return True
         except Exception as e:
             logger.error(f"Ошибка удаления calendar_id: {e}")
             return False
+
+    async def _get_user_document(self, user_id: int, operation: str) -> Optional[Dict]:
+        """Документ пользователя (None - документа нет): из контекста апдейта или из Firestore"""
+        async def load() -> Optional[Dict]:
+            found, data = user_document_cache.get(user_id)
+            if found:
+                return data
+            generation = user_document_cache.generation(user_id)
+            user_ref = self.db.collection('users').document(str(user_id))
+            doc = await firestore_executor.run(operation, user_ref.get)
+            data = doc.to_dict() if doc.exists else None
+            user_document_cache.put(user_id, data, generation)
+            return data
+        
+        context = current_user_context(user_id)
+        if context is None:
+            return await load()
+        data = await context.get(load)
+        # Документ, созданный отложенными записями, уже существует для следующих чтений
+        return data if context.exists or context.writes else None
+
     async def get_user_info(self, user_id: int) -> Dict:
         """Получает информацию о пользователе"""
         try:
-            user_ref = self.db.collection('users').document(str(user_id))
-            doc = user_ref.get()
-            
-            if doc.exists:
-                return doc.to_dict()
-            return {}
+            return await self._get_user_document(user_id, 'get_user_info') or {}
         except Exception as e:
             logger.error(f"Ошибка получения информации о пользователе: {e}")
             return {}
@@ -220,7 +397,7 @@ class FirebaseService:
         """Получает список всех пользователей"""
         try:
             users_ref = self.db.collection('users')
-            docs = users_ref.stream()
+            docs = await firestore_executor.stream('get_all_users', users_ref)
             
             user_ids = []
             for doc in docs:
@@ -235,7 +412,7 @@ class FirebaseService:
         """Получает список всех пользователей с их часовыми поясами"""
         try:
             users_ref = self.db.collection('users')
-            docs = users_ref.stream()
+            docs = await firestore_executor.stream('get_users_with_timezones', users_ref)
             
             users = []
             for doc in docs:
@@ -254,65 +431,160 @@ class FirebaseService:
             logger.error(f"Ошибка получения пользователей с часовыми поясами: {e}")
             return []
     
-    def parse_nutrition_data(self, analysis_text: str) -> Dict:
-        """Парсит данные о питании из текста анализа"""
-        nutrition = {
-            'calories': 0,
-            'proteins': 0,
-            'fats': 0,
-            'carbs': 0,
-            'vitamins': {}
-        }
+    async def update_user(self, user_id: int, data: Dict, operation: str = 'update_user', immediate: bool = False):
+        """
+        Обновляет поля документа пользователя (документ должен существовать); ошибки пробрасываются
         
+        Args:
+            immediate: записать сразу, а не в конце апдейта (оплаты, подписка, лимиты -
+                то, о чем пользователю сообщают до конца апдейта)
+        """
+        await self._write_user(user_id, WRITE_UPDATE, data, operation, immediate)
+
+    async def merge_user(self, user_id: int, data: Dict, operation: str = 'merge_user', immediate: bool = False):
+        """Записывает поля в документ пользователя с merge=True; ошибки пробрасываются (immediate - как в update_user)"""
+        await self._write_user(user_id, WRITE_MERGE, data, operation, immediate)
+
+    async def _write_user(self, user_id: int, kind: str, data: Dict, operation: str, immediate: bool):
+        context = current_user_context(user_id)
+        if context is not None:
+            context.stage(kind, data)
+            if immediate:
+                await self.flush_user_writes(user_id)
+            return
+        user_ref = self.db.collection('users').document(str(user_id))
+        try:
+            if kind == WRITE_UPDATE:
+                await firestore_executor.run(operation, user_ref.update, data)
+            else:
+                await firestore_executor.run(operation, user_ref.set, data, merge=True)
+        except Exception:
+            user_document_cache.invalidate(user_id)
+            raise
+        user_document_cache.apply_writes(user_id, [(kind, data)])
+
+    async def flush_user_writes(self, user_id: int):
+        """Записывает отложенные записи текущего апдейта пользователя сейчас; ошибки пробрасываются"""
+        context = current_user_context(user_id)
+        if context is None or not context.writes:
+            return
         try:
-            lines = analysis_text.split('\n')
-            for line in lines:
-                line = line.strip()
-                
-                # Парсинг калорий
-                if 'Калории:' in line:
-                    import re
-                    match = re.search(r'(\d+)', line)
-                    if match:
-                        nutrition['calories'] = int(match.group(1))
-                
-                # Парсинг белков
-                elif 'Белки:' in line:
-                    import re
-                    match = re.search(r'(\d+(?:\.\d+)?)', line)
-                    if match:
-                        nutrition['proteins'] = float(match.group(1))
-                
-                # Парсинг жиров
-                elif 'Жиры:' in line:
-                    import re
-                    match = re.search(r'(\d+(?:\.\d+)?)', line)
-                    if match:
-                        nutrition['fats'] = float(match.group(1))
-                
-                # Парсинг углеводов
-                elif 'Углеводы:' in line:
-                    import re
-                    match = re.search(r'(\d+(?:\.\d+)?)', line)
-                    if match:
-                        nutrition['carbs'] = float(match.group(1))
-                
-                # Парсинг витаминов
-                elif line.startswith('-') and '%' in line:
-                    import re
-                    match = re.search(r'- ([^:]+):\s*(\d+)%', line)
-                    if match:
-                        vitamin_name = match.group(1).strip()
-                        percentage = int(match.group(2))
-                        nutrition['vitamins'][vitamin_name] = percentage
+            await self.commit_user_writes(user_id, context.take_writes())
+        except Exception:
+            # В копии документа остались несохраненные записи
+            context.discard_document()
+            raise
+        context.mark_flushed()
+
+    async def commit_user_writes(self, user_id: int, writes: List[Tuple[str, Dict]]):
+        """
+        Записывает отложенные изменения документа пользователя одним batch-коммитом; ошибки пробрасываются
         
+        Если коммит отклонен (например, update несуществующего документа), записи
+        повторяются по одной, как до откладывания, и пробрасывается первая ошибка.
+        После тайм-аута не повторяются: коммит мог пройти, а Increment применился
+        бы дважды - пробрасывается FirestoreTimeoutError.
+        """
+        user_ref = self.db.collection('users').document(str(user_id))
+        batch = self.db.batch()
+        for kind, data in writes:
+            if kind == WRITE_UPDATE:
+                batch.update(user_ref, data)
+            else:
+                batch.set(user_ref, data, merge=True)
+        try:
+            await firestore_executor.run('commit_user_writes', batch.commit)
+            user_document_cache.apply_writes(user_id, writes)
+            return
+        except FirestoreTimeoutError as e:
+            logger.error(f"Отложенные записи пользователя {user_id} не подтверждены: {e}")
+            user_document_cache.invalidate(user_id)
+            raise
         except Exception as e:
-            logger.error(f"Ошибка парсинга данных о питании: {e}")
+            logger.warning(f"Batch-коммит пользователя {user_id} отклонен ({e}), записываем по одной")
+        
+        # Какие из записей прошли, неизвестно заранее - документ перечитается
+        user_document_cache.invalidate(user_id)
+        error = None
+        for kind, data in writes:
+            try:
+                if kind == WRITE_UPDATE:
+                    await firestore_executor.run('commit_user_writes', user_ref.update, data)
+                else:
+                    await firestore_executor.run('commit_user_writes', user_ref.set, data, merge=True)
+            except Exception as e:
+                logger.error(f"Ошибка записи в документ пользователя {user_id}: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+
+    async def add_document(self, collection: str, data: Dict, operation: str = 'add_document'):
+        """Добавляет документ в коллекцию верхнего уровня; ошибки пробрасываются"""
+        await firestore_executor.run(operation, self.db.collection(collection).add, data)
+
+    def nutrition_fields(self, analysis: Dict) -> Dict:
+        """
+        Числовые поля КБЖУ для записи в документ анализа
         
-        return nutrition
+        Берутся из структурированного ответа (nutrition) или, если его нет,
+        из разбора текста - сохраненные ранее поля не используются.
+        """
+        nutrition = analysis.get('nutrition') or parse_nutrition_values(analysis.get('analysis_text', ''))
+        return {
+            'calories': nutrition.get('calories', 0),
+            'proteins': nutrition.get('proteins', 0),
+            'fats': nutrition.get('fats', 0),
+            'carbs': nutrition.get('carbs', 0),
+            'vitamins': dict(nutrition.get('vitamins') or {}),
+            'products': list(nutrition.get('products') or []),
+            'nutrition_fields_version': NUTRITION_FIELDS_VERSION,
+        }
+
+    def get_analysis_nutrition(self, analysis: Dict) -> Dict:
+        """Возвращает КБЖУ анализа: сохраненные поля, значения структурированного ответа или разбор текста"""
+        if analysis.get('nutrition_fields_version') == NUTRITION_FIELDS_VERSION:
+            return {
+                'calories': analysis.get('calories') or 0,
+                'proteins': analysis.get('proteins') or 0,
+                'fats': analysis.get('fats') or 0,
+                'carbs': analysis.get('carbs') or 0,
+                'vitamins': analysis.get('vitamins') or {},
+                'products': analysis.get('products') or [],
+            }
+        nutrition = analysis.get('nutrition')
+        if nutrition:
+            return nutrition
+        return parse_nutrition_values(analysis.get('analysis_text', ''))
+
+    async def migrate_nutrition_fields(self, user_id: int, batch_size: int = 400, dry_run: bool = False) -> Tuple[int, int]:
+        """
+        Записывает числовые поля КБЖУ в старые анализы пользователя
+        
+        Args:
+            batch_size: Записей в одном batch-коммите (у Firestore лимит 500)
+            dry_run: Только посчитать анализы без полей
+        
+        Returns:
+            (всего анализов, обновлено анализов)
+        """
+        analyses_ref = self.db.collection('users').document(str(user_id)).collection('analyses')
+        docs = await firestore_executor.stream('migrate_nutrition_fields', analyses_ref)
+        pending = [doc for doc in docs if doc.to_dict().get('nutrition_fields_version') != NUTRITION_FIELDS_VERSION]
+        if dry_run:
+            return len(docs), len(pending)
+        
+        for start in range(0, len(pending), batch_size):
+            batch = self.db.batch()
+            for doc in pending[start:start + batch_size]:
+                batch.update(doc.reference, self.nutrition_fields(doc.to_dict()))
+            await firestore_executor.run('migrate_nutrition_fields', batch.commit)
+        return len(docs), len(pending)
     
     async def aggregate_daily_nutrition(self, analyses: List[Dict]) -> Dict:
         """Агрегирует данные о питании за день"""
+        return self._aggregate(analyses)
+
+    def _aggregate(self, analyses: List[Dict]) -> Dict:
         total = {
             'calories': 0,
             'proteins': 0,
@@ -322,7 +594,7 @@ class FirebaseService:
         }
         
         for analysis in analyses:
-            nutrition = self.parse_nutrition_data(analysis.get('analysis_text', ''))
+            nutrition = self.get_analysis_nutrition(analysis)
             
             total['calories'] += nutrition['calories']
             total['proteins'] += nutrition['proteins']
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+from config import FIRESTORE_WORKERS, FIRESTORE_TIMEOUT_SECONDS
+from .gemini_retry import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Как часто писать статистику в лог (в запросах)
+STATS_LOG_INTERVAL = 500
+
+
+class FirestoreTimeoutError(TimeoutError):
+    """Запрос к Firestore не уложился в тайм-аут"""
+
+
+class FirestoreExecutor:
+    """Запросы синхронного клиента Firestore вне цикла событий
+
+    firebase_admin дает синхронный клиент: каждый get/set/stream - сетевой
+    запрос, который останавливал весь цикл событий, и один медленный запрос
+    задерживал апдейты всех пользователей. Запросы выполняются в отдельном
+    пуле из max_workers потоков (не в пуле offloader, чтобы не ждать
+    обработку фото), одновременно - не больше размера пула, остальные ждут
+    в очереди. Запрос ждется не дольше timeout секунд: вызывающий получает
+    FirestoreTimeoutError, а поток дорабатывает запрос в фоне.
+    """
+
+    def __init__(self, max_workers: int = FIRESTORE_WORKERS, timeout: float = FIRESTORE_TIMEOUT_SECONDS):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._latency = LatencyTracker(window=1000)
+        self._in_flight = 0
+        self._stats = {'calls': 0, 'errors': 0, 'timeouts': 0, 'max_in_flight': 0, 'max_seconds': 0.0}
+        # Операция -> число запросов (какие запросы чаще всего ходят в Firestore)
+        self._operations: Dict[str, int] = {}
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="firestore")
+        return self._pool
+
+    async def run(self, operation: str, func: Callable[..., T], *args,
+                  timeout: Optional[float] = None, **kwargs) -> T:
+        """
+        Выполняет func(*args, **kwargs) - запрос клиента Firestore - в пуле потоков
+
+        Args:
+            operation: Название запроса для статистики и логов (например, "get_user")
+            timeout: Тайм-аут запроса в секундах (по умолчанию self.timeout)
+
+        Raises:
+            FirestoreTimeoutError: запрос не уложился в тайм-аут
+        """
+        timeout = self.timeout if timeout is None else timeout
+        call = functools.partial(func, *args, **kwargs)
+        future = asyncio.get_running_loop().run_in_executor(self._thread_pool(), call)
+        self._in_flight += 1
+        self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._in_flight)
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            logger.warning(f"Firestore: {operation} не уложился в {timeout} с")
+            raise FirestoreTimeoutError(f"Firestore: {operation} не уложился в {timeout} с")
+        except Exception:
+            self._stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self._in_flight -= 1
+            self._latency.record(elapsed)
+            self._stats['max_seconds'] = max(self._stats['max_seconds'], elapsed)
+            self._operations[operation] = self._operations.get(operation, 0) + 1
+            self._stats['calls'] += 1
+            self._log_stats()
+
+    async def stream(self, operation: str, query: Any, timeout: Optional[float] = None) -> List[Any]:
+        """Читает все документы запроса (query.stream()) в пуле потоков"""
+        return await self.run(operation, lambda: list(query.stream()), timeout=timeout)
+
+    def _log_stats(self):
+        if self._stats['calls'] % STATS_LOG_INTERVAL:
+            return
+        stats = self.get_stats()
+        logger.info(f"Firestore: {stats['calls']} запросов, p50 {stats['latency_p50'] * 1000:.0f} мс, "
+                    f"p99 {stats['latency_p99'] * 1000:.0f} мс, тайм-аутов {stats['timeouts']}, "
+                    f"максимум одновременно {stats['max_in_flight']}")
+
+    def shutdown(self):
+        """Останавливает пул (при остановке бота)"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def get_stats(self) -> Dict:
+        """Запросы, ошибки и тайм-ауты, перцентили времени (с ожиданием в очереди) и запросы по операциям"""
+        return {
+            **self._stats,
+            'workers': self.max_workers,
+            'in_flight': self._in_flight,
+            'latency_p50': self._latency.percentile(50) or 0.0,
+            'latency_p95': self._latency.percentile(95) or 0.0,
+            'latency_p99': self._latency.percentile(99) or 0.0,
+            'operations': dict(self._operations),
+        }
+
+
+# Глобальный исполнитель запросов к Firestore
+firestore_executor = FirestoreExecutor()
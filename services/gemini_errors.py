@@ -0,0 +1,44 @@
+from typing import Optional
+
+DEFAULT_USER_MESSAGE = "❌ Не удалось проанализировать фото. Попробуйте еще раз через минуту."
+
+
+class GeminiServiceError(Exception):
+    """Ошибка обращения к сервису анализа
+
+    user_message - текст, который можно показать пользователю вместо анализа
+    (сама ошибка не должна сохраняться как результат анализа).
+    """
+
+    def __init__(self, message: str, user_message: str = DEFAULT_USER_MESSAGE,
+                 status: Optional[int] = None):
+        super().__init__(message)
+        self.user_message = user_message
+        self.status = status
+
+
+class GeminiRetryableError(GeminiServiceError):
+    """Временная ошибка (429, 5xx, таймаут, обрыв соединения) - запрос можно повторить"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(
+            message,
+            user_message="⏳ Сервис анализа сейчас перегружен. Попробуйте еще раз через минуту - фото сохранено.",
+            status=status
+        )
+        self.retry_after = retry_after
+
+
+class GeminiQueueTimeoutError(GeminiServiceError):
+    """Запрос не дождался свободного слота к Gemini за отведенное время"""
+
+    def __init__(self, tier: str, waited: float):
+        super().__init__(
+            f"Очередь Gemini ({tier}): ожидание {waited:.1f} с превысило лимит",
+            user_message=(
+                "⏳ Сейчас очень много запросов на анализ, и ваш не успел дойти до очереди.\n\n"
+                "Попробуйте еще раз через минуту - фото сохранено."
+            )
+        )
+        self.tier = tier
+        self.waited = waited
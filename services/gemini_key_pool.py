@@ -0,0 +1,174 @@
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from config import (
+    GEMINI_API_KEY,
+    GEMINI_API_KEYS,
+    GEMINI_MODEL,
+    GEMINI_MODEL_TIERS,
+    GEMINI_KEY_RPM,
+    GEMINI_KEY_TPM,
+    GEMINI_KEY_QUARANTINE_SECONDS,
+)
+from .gemini_errors import GeminiRetryableError
+
+logger = logging.getLogger(__name__)
+
+# Окно, в котором считаются запросы и токены (лимиты Gemini - в минуту)
+RATE_WINDOW_SECONDS = 60.0
+# Оценка токенов запроса с фото, пока не пришел usageMetadata
+DEFAULT_REQUEST_TOKENS = 1500
+
+
+def parse_key_entries(keys: List[str]) -> List[Tuple[str, Optional[str]]]:
+    """Разбирает записи GEMINI_API_KEYS вида "ключ" или "ключ@модель" (модель None - не указана)"""
+    entries = []
+    for entry in keys:
+        key, _, model = entry.partition('@')
+        if key.strip():
+            entries.append((key.strip(), model.strip() or None))
+    return entries
+
+
+class GeminiKey:
+    """Ключ API с учетом запросов и токенов за последнюю минуту"""
+
+    def __init__(self, key: str, model: str, rpm: int, tpm: int, pinned: bool = False):
+        self.key = key
+        self.model = model
+        # Модель задана для ключа (ключ@модель) и важнее модели уровня операции
+        self.pinned = pinned
+        self.rpm = rpm
+        self.tpm = tpm
+        self.label = f"...{key[-4:]}"
+        self.quarantined_until = 0.0
+        # Моменты отправки запросов и [момент, токены]: оценка до ответа, затем факт
+        self._requests: Deque[float] = deque()
+        self._tokens: Deque[List[float]] = deque()
+        self.stats = {'requests': 0, 'tokens': 0, 'rate_limited': 0}
+
+    def _trim(self, now: float):
+        border = now - RATE_WINDOW_SECONDS
+        while self._requests and self._requests[0] <= border:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= border:
+            self._tokens.popleft()
+
+    def used(self, now: float) -> Tuple[int, float]:
+        """Запросов и токенов за последнюю минуту"""
+        self._trim(now)
+        return len(self._requests), sum(tokens for _, tokens in self._tokens)
+
+    def headroom(self, now: float) -> float:
+        """Доля свободного лимита (0 - лимит исчерпан, 1 - ключ не использовался)"""
+        requests, tokens = self.used(now)
+        return min(1 - requests / self.rpm, 1 - tokens / self.tpm)
+
+    def available_in(self, now: float) -> float:
+        """Через сколько секунд у ключа освободится лимит"""
+        if self.quarantined_until > now:
+            return self.quarantined_until - now
+        requests, tokens = self.used(now)
+        frees_at = []
+        if requests >= self.rpm:
+            frees_at.append(self._requests[0])
+        if tokens >= self.tpm:
+            frees_at.append(self._tokens[0][0])
+        return max(0.0, max(frees_at) + RATE_WINDOW_SECONDS - now) if frees_at else 0.0
+
+    def reserve(self, now: float) -> List[float]:
+        """Учитывает запрос и оценку его токенов"""
+        reservation = [now, DEFAULT_REQUEST_TOKENS]
+        self._requests.append(now)
+        self._tokens.append(reservation)
+        self.stats['requests'] += 1
+        return reservation
+
+
+class GeminiKeyPool:
+    """Пул ключей Gemini API с лимитами RPM/TPM на каждый ключ
+
+    Запрос уходит на ключ с наибольшим запасом лимита. Токены считаются по
+    usageMetadata ответов (до ответа - по оценке). Ключ, получивший 429,
+    выводится из пула на время Retry-After. Если свободных ключей нет,
+    бросается GeminiRetryableError с retry_after до освобождения ближайшего -
+    ResilientCaller подождет и повторит запрос.
+    """
+
+    def __init__(self, keys: Optional[List[Tuple[str, Optional[str]]]] = None, rpm: int = GEMINI_KEY_RPM,
+                 tpm: int = GEMINI_KEY_TPM, quarantine_seconds: float = GEMINI_KEY_QUARANTINE_SECONDS):
+        if keys is None:
+            keys = parse_key_entries(GEMINI_API_KEYS or ([GEMINI_API_KEY] if GEMINI_API_KEY else []))
+        self.quarantine_seconds = quarantine_seconds
+        self.keys = [GeminiKey(key, model or GEMINI_MODEL, rpm, tpm, pinned=model is not None)
+                     for key, model in keys]
+        pinned = [key.label for key in self.keys if key.pinned]
+        if pinned and GEMINI_MODEL_TIERS:
+            logger.info(f"Ключи Gemini с моделью в GEMINI_API_KEYS ({', '.join(pinned)}) "
+                        f"используют ее вместо GEMINI_MODEL_TIERS")
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def acquire(self) -> Tuple[GeminiKey, List[float]]:
+        """
+        Выбирает ключ для запроса и резервирует под него лимит
+
+        Returns:
+            (ключ, запись токенов) - запись передается в record_usage после ответа
+
+        Raises:
+            GeminiRetryableError: все ключи исчерпали лимит или на карантине
+        """
+        now = time.monotonic()
+        candidates = [key for key in self.keys if key.quarantined_until <= now and key.headroom(now) > 0]
+        if not candidates:
+            wait = min(key.available_in(now) for key in self.keys)
+            logger.warning(f"Все ключи Gemini исчерпали лимит, ближайший освободится через {wait:.1f} с")
+            raise GeminiRetryableError("лимит всех ключей Gemini исчерпан", status=429, retry_after=wait)
+
+        key = max(candidates, key=lambda candidate: candidate.headroom(now))
+        return key, key.reserve(now)
+
+    def record_usage(self, key: GeminiKey, reservation: List[float], usage: Optional[Dict]):
+        """Заменяет оценку токенов фактическим расходом из usageMetadata"""
+        tokens = (usage or {}).get('totalTokenCount')
+        if isinstance(tokens, (int, float)):
+            reservation[1] = tokens
+            key.stats['tokens'] += tokens
+
+    def quarantine(self, key: GeminiKey, retry_after: Optional[float] = None) -> float:
+        """
+        Выводит ключ из пула после 429 на Retry-After (или quarantine_seconds)
+
+        Returns:
+            через сколько секунд повторять запрос: 0, если есть другой свободный ключ
+        """
+        seconds = retry_after if retry_after else self.quarantine_seconds
+        now = time.monotonic()
+        key.quarantined_until = max(key.quarantined_until, now + seconds)
+        key.stats['rate_limited'] += 1
+        logger.warning(f"Ключ Gemini {key.label} получил 429, на карантине {seconds:.0f} с")
+        return min(candidate.available_in(now) for candidate in self.keys)
+
+    def get_stats(self) -> Dict:
+        """Загрузка ключей: запросы и токены за минуту, карантин"""
+        now = time.monotonic()
+        keys = {}
+        for key in self.keys:
+            requests, tokens = key.used(now)
+            keys[key.label] = {
+                **key.stats,
+                'model': key.model,
+                'pinned': key.pinned,
+                'rpm_used': requests,
+                'tpm_used': tokens,
+                'headroom': key.headroom(now),
+                'quarantined_for': max(0.0, key.quarantined_until - now),
+            }
+        return {'keys': keys}
+
+
+# Глобальный пул ключей основного сервиса Gemini
+gemini_key_pool = GeminiKeyPool()
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+from config import (
+    GEMINI_RETRY_MAX_ATTEMPTS,
+    GEMINI_RETRY_BASE_DELAY,
+    GEMINI_RETRY_MAX_DELAY,
+    GEMINI_TOTAL_DEADLINE,
+    GEMINI_REQUEST_TIMEOUT,
+    GEMINI_HEDGING_ENABLED,
+    GEMINI_HEDGING_MIN_SAMPLES,
+)
+from .gemini_errors import GeminiServiceError, GeminiRetryableError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+class LatencyTracker:
+    """Скользящее окно времени ответа для расчета перцентилей"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float):
+        self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class ResilientCaller:
+    """Повторы, экспоненциальная задержка с джиттером и хеджирование запросов
+
+    - повторяются только временные ошибки (429, 5xx, таймауты, обрывы)
+    - задержка: full jitter от base_delay * 2^попытка, но не меньше Retry-After
+    - все попытки укладываются в общий бюджет времени total_deadline
+    - хеджирование: если ответ не пришел за p95 времени ответа этой же
+      операции, отправляется второй такой же запрос и берется тот, что
+      завершится первым (время быстрых операций, например исправлений
+      текста, не влияет на порог для анализа фото)
+    """
+
+    def __init__(self, max_attempts: int = GEMINI_RETRY_MAX_ATTEMPTS,
+                 base_delay: float = GEMINI_RETRY_BASE_DELAY,
+                 max_delay: float = GEMINI_RETRY_MAX_DELAY,
+                 total_deadline: float = GEMINI_TOTAL_DEADLINE,
+                 attempt_timeout: float = GEMINI_REQUEST_TIMEOUT,
+                 hedging_enabled: bool = GEMINI_HEDGING_ENABLED,
+                 hedging_min_samples: int = GEMINI_HEDGING_MIN_SAMPLES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_deadline = total_deadline
+        self.attempt_timeout = attempt_timeout
+        self.hedging_enabled = hedging_enabled
+        self.hedging_min_samples = hedging_min_samples
+        # Операция (operation в call) -> время ответа
+        self.latency: Dict[str, LatencyTracker] = {}
+        self._stats = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0}
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Задержка перед повтором номер attempt (начиная с 1)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def hedge_delay(self, operation: str = "request") -> Optional[float]:
+        """Через сколько секунд отправлять хеджирующий запрос операции (None - не отправлять)"""
+        latency = self.latency.get(operation)
+        if not self.hedging_enabled or latency is None or len(latency) < self.hedging_min_samples:
+            return None
+        return latency.percentile(95)
+
+    async def call(self, send: Callable[[float], Awaitable[T]], operation: str = "request",
+                   hedge: bool = True) -> T:
+        """
+        Выполняет запрос с повторами в рамках общего бюджета времени
+
+        Args:
+            send: корутина-фабрика, принимает таймаут попытки в секундах
+            operation: название операции для логов и порога хеджирования
+            hedge: разрешить хеджирование (для потоковых ответов отключается)
+        """
+        self._stats['calls'] += 1
+        deadline = time.monotonic() + self.total_deadline
+        attempt = 0
+
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                return await self._attempt(send, min(self.attempt_timeout, remaining), operation, hedge)
+            except GeminiRetryableError as e:
+                attempt += 1
+                remaining = deadline - time.monotonic()
+                delay = self.backoff_delay(attempt, e.retry_after)
+                if attempt >= self.max_attempts or delay >= remaining:
+                    self._stats['failures'] += 1
+                    logger.error(f"Gemini {operation}: попытки исчерпаны ({attempt}), последняя ошибка: {e}")
+                    raise
+                self._stats['retries'] += 1
+                logger.warning(
+                    f"Gemini {operation}: временная ошибка ({e}), повтор {attempt}/{self.max_attempts - 1} "
+                    f"через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+            except GeminiServiceError:
+                self._stats['failures'] += 1
+                raise
+
+    async def _timed(self, send: Callable[[float], Awaitable[T]], timeout: float, operation: str) -> T:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(send(timeout), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise GeminiRetryableError(f"таймаут {timeout:.1f} с") from None
+        self.latency.setdefault(operation, LatencyTracker()).record(time.monotonic() - started)
+        return result
+
+    async def _attempt(self, send: Callable[[float], Awaitable[T]], timeout: float, operation: str = "request",
+                       hedge: bool = True) -> T:
+        hedge_after = self.hedge_delay(operation) if hedge else None
+        if hedge_after is None or hedge_after >= timeout:
+            return await self._timed(send, timeout, operation)
+
+        primary = asyncio.create_task(self._timed(send, timeout, operation))
+        pending = {primary}
+        last_error: Optional[BaseException] = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+
+            self._stats['hedges'] += 1
+            logger.info(f"Ответ Gemini {operation} дольше p95 ({hedge_after:.1f} с), отправляем хеджирующий запрос")
+            hedge = asyncio.create_task(self._timed(send, timeout - hedge_after, operation))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._stats['hedge_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            # В том числе при отмене вызывающего: незавершенные запросы освобождают слот пула ключей
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self) -> Dict:
+        """Возвращает счетчики повторов/хеджирования и перцентили времени ответа по операциям"""
+        return {
+            **self._stats,
+            'latency': {
+                operation: {'p50': latency.percentile(50), 'p95': latency.percentile(95), 'samples': len(latency)}
+                for operation, latency in self.latency.items()
+            },
+        }
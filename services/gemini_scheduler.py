@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+from config import (
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_QUEUE_WEIGHTS,
+    GEMINI_QUEUE_TIMEOUTS,
+)
+from .gemini_errors import GeminiQueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIER = "lite"
+
+
+class GeminiRequestScheduler:
+    """Планировщик запросов к Gemini с приоритетами по тарифам
+
+    - общий лимит одновременных запросов к Gemini
+    - отдельные очереди для каждого тарифа, выбираемые взвешенным
+      round-robin (Pro получает больше слотов, но Lite не голодает)
+    - внутри тарифа очередь по кругу между пользователями, чтобы один
+      пользователь с серией фото не занимал все слоты
+    - предельное время ожидания в очереди для каждого тарифа
+    """
+
+    def __init__(self, max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+                 weights: Optional[Dict[str, int]] = None,
+                 queue_timeouts: Optional[Dict[str, float]] = None):
+        self.max_concurrency = max_concurrency
+        self.weights = dict(weights or GEMINI_QUEUE_WEIGHTS)
+        self.queue_timeouts = dict(queue_timeouts or GEMINI_QUEUE_TIMEOUTS)
+        self.weights.setdefault(DEFAULT_TIER, 1)
+
+        self._active = 0
+        # тариф -> (user_id -> очередь ожидающих future)
+        self._queues: Dict[str, "OrderedDict[Optional[int], Deque[asyncio.Future]]"] = {
+            tier: OrderedDict() for tier in self.weights
+        }
+        # Текущие веса для плавного взвешенного round-robin
+        self._current_weights = {tier: 0 for tier in self.weights}
+        self._stats = {
+            tier: {'granted': 0, 'queued': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for tier in self.weights
+        }
+
+    def _tier(self, subscription_type: Optional[str]) -> str:
+        return subscription_type if subscription_type in self.weights else DEFAULT_TIER
+
+    def _queued_count(self, tier: Optional[str] = None) -> int:
+        tiers = [tier] if tier else self._queues.keys()
+        return sum(
+            sum(1 for future in user_queue if not future.done())
+            for t in tiers
+            for user_queue in self._queues[t].values()
+        )
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[int], subscription_type: Optional[str]):
+        """Контекстный менеджер: занимает слот на время запроса к Gemini"""
+        await self.acquire(user_id, subscription_type)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: Optional[int], subscription_type: Optional[str]):
+        """Ждет свободный слот с учетом тарифа и очереди пользователя"""
+        tier = self._tier(subscription_type)
+        stats = self._stats[tier]
+
+        if self._active < self.max_concurrency and self._queued_count() == 0:
+            self._active += 1
+            stats['granted'] += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[tier].setdefault(user_id, deque()).append(future)
+        stats['queued'] += 1
+        started = time.monotonic()
+        timeout = self.queue_timeouts.get(tier, self.queue_timeouts.get(DEFAULT_TIER, 10.0))
+
+        try:
+            await asyncio.wait_for(future, timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._discard(tier, user_id, future)
+            if future.done() and not future.cancelled():
+                # Слот успели выдать одновременно с отменой - возвращаем его
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                waited = time.monotonic() - started
+                stats['timeouts'] += 1
+                logger.warning(
+                    f"Пользователь {user_id} ({tier}) не дождался слота Gemini за {waited:.1f} с, "
+                    f"в очереди: {self._queued_count()}"
+                )
+                raise GeminiQueueTimeoutError(tier, waited) from None
+            raise
+
+        waited = time.monotonic() - started
+        stats['granted'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+        if waited > 1:
+            logger.info(f"Запрос пользователя {user_id} ({tier}) ждал в очереди Gemini {waited:.1f} с")
+
+    def release(self):
+        """Освобождает слот и передает его следующему в очереди"""
+        self._active = max(0, self._active - 1)
+        self._dispatch()
+
+    def _discard(self, tier: str, user_id: Optional[int], future: asyncio.Future):
+        """Убирает future из очереди пользователя"""
+        user_queue = self._queues[tier].get(user_id)
+        if user_queue is None:
+            return
+        try:
+            user_queue.remove(future)
+        except ValueError:
+            pass
+        if not user_queue:
+            del self._queues[tier][user_id]
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency:
+            future = self._next_waiter()
+            if future is None:
+                return
+            self._active += 1
+            future.set_result(None)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        """Выбирает следующий запрос: тариф по весам, внутри тарифа - по кругу между пользователями"""
+        while True:
+            candidates = [tier for tier, users in self._queues.items() if users]
+            if not candidates:
+                return None
+
+            # Плавный взвешенный round-robin (как в nginx)
+            total = 0
+            for tier in candidates:
+                self._current_weights[tier] += self.weights[tier]
+                total += self.weights[tier]
+            tier = max(candidates, key=lambda t: self._current_weights[t])
+            self._current_weights[tier] -= total
+
+            users = self._queues[tier]
+            user_id, user_queue = next(iter(users.items()))
+            future = user_queue.popleft()
+            if user_queue:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+
+            if not future.done():
+                return future
+
+    def get_stats(self) -> Dict:
+        """Возвращает состояние очередей и время ожидания по тарифам"""
+        tiers = {}
+        for tier, stats in self._stats.items():
+            waited_count = stats['granted']
+            tiers[tier] = {
+                **stats,
+                'waiting': self._queued_count(tier),
+                'wait_avg': stats['wait_total'] / waited_count if waited_count else 0.0,
+            }
+        return {
+            'active': self._active,
+            'max_concurrency': self.max_concurrency,
+            'tiers': tiers,
+        }
+
+
+# Глобальный планировщик запросов к Gemini
+gemini_scheduler = GeminiRequestScheduler()
@@ -1,29 +1,71 @@
-import base64
+import asyncio
 import logging
 import aiohttp
 import json
-from config import GEMINI_API_KEY
+from typing import Dict, List, Optional, Tuple
+from config import GEMINI_STREAMING_ENABLED
+from .http_session import http_session_manager
+from .gemini_key_pool import gemini_key_pool, GeminiKey
+from .model_tiers import model_tiers
+from .adaptive_resolution import adaptive_resolution
+from .image_preprocessor import image_preprocessor, encode_base64
+from .offload import offloader
+from .photo_store import photo_store
+from .gemini_errors import GeminiServiceError, GeminiRetryableError
+from .gemini_retry import ResilientCaller, RETRYABLE_STATUSES, parse_retry_after
+from .analysis_provider import AnalysisProvider, ProgressCallback
+from .nutrition_schema import (
+    NUTRITION_RESPONSE_SCHEMA,
+    DISH_LOCATION_SCHEMA,
+    validate_nutrition,
+    validate_dish_locations,
+    render_analysis_text,
+    render_partial_preview,
+)
 
 logger = logging.getLogger(__name__)
 
-class GeminiService:
+class GeminiService(AnalysisProvider):
+    name = "main"
+    supports_streaming = GEMINI_STREAMING_ENABLED
+    supports_model_tiers = True
+    supports_image_resolution = True
+    
     def __init__(self):
-        self.api_key = GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+        # Ключи API (и модели) с учетом лимитов каждого ключа
+        self.key_pool = gemini_key_pool
+        self.api_url = "https://generativelanguage.googleapis.com/v1beta/models"
+        # Повторы временных ошибок и хеджирование медленных запросов
+        self.caller = ResilientCaller()
         
-        if not self.api_key:
-            logger.error("GEMINI_API_KEY не установлен в переменных окружения")
+        if not len(self.key_pool):
+            logger.error("GEMINI_API_KEY / GEMINI_API_KEYS не установлены в переменных окружения")
             raise ValueError("GEMINI_API_KEY не может быть пустым")
     
-    def encode_image(self, image_path: str) -> str:
-        """Кодирует изображение в base64"""
+    async def encode_image(self, image_path: str) -> str:
+        """Кодирует изображение в base64 (вне цикла событий)"""
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            return await offloader.run_in_thread(encode_base64, photo_store.read(image_path))
         except Exception as e:
             logger.error(f"Ошибка при кодировании изображения: {e}")
             raise
     
+    async def prepare_image(self, image_path: str) -> Tuple[str, str]:
+        """Уменьшает изображение и кодирует его в base64, возвращает (данные, MIME тип)"""
+        processed = await self._process_image(image_path)
+        return await offloader.run_in_thread(encode_base64, processed['data']), processed['mime_type']
+    
+    async def _process_image(self, image_path: str, max_side: Optional[int] = None) -> Dict:
+        try:
+            return await image_preprocessor.process_file_async(image_path, max_side)
+        except Exception as e:
+            logger.error(f"Ошибка при подготовке изображения: {e}")
+            raise
+    
+    def encode_payload(self, payload: dict) -> bytes:
+        """Тело запроса: payload без None в JSON (вызывается в пуле потоков)"""
+        return json.dumps(self.clean_payload(payload), ensure_ascii=False).encode('utf-8')
+    
     def clean_payload(self, payload: dict) -> dict:
         """Удаляет None значения из payload для корректной сериализации JSON"""
         def clean_dict(d):
@@ -35,25 +77,154 @@ class GeminiService:
                 return d
         return clean_dict(payload)
     
-    async def analyze_food(self, image_path: str, weight_grams: int) -> str:
+    async def _raise_for_status(self, response: aiohttp.ClientResponse):
+        """Классифицирует неуспешный ответ на временную и постоянную ошибку"""
+        if response.status == 200:
+            return
+        
+        error_text = await response.text()
+        logger.error(f"Ошибка Gemini API {response.status}: {error_text[:500]}")
+        if response.status in RETRYABLE_STATUSES:
+            raise GeminiRetryableError(
+                f"HTTP {response.status}",
+                status=response.status,
+                retry_after=parse_retry_after(response.headers.get('Retry-After'))
+            )
+        raise GeminiServiceError(f"HTTP {response.status}: {error_text[:200]}", status=response.status)
+    
+    def _headers(self, key: GeminiKey) -> Dict:
+        return {
+            'Content-Type': 'application/json',
+            'X-goog-api-key': key.key
+        }
+    
+    def _url(self, key: GeminiKey, model: Optional[str] = None, stream: bool = False) -> str:
+        """URL запроса: модель ключа (ключ@модель), иначе модель уровня операции, иначе GEMINI_MODEL"""
+        method = ":streamGenerateContent?alt=sse" if stream else ":generateContent"
+        if key.pinned or not model:
+            model = key.model
+        return f"{self.api_url}/{model}{method}"
+    
+    async def _post_once(self, body: bytes, timeout: float, model: Optional[str] = None) -> Dict:
+        """Один запрос к Gemini API, ошибки классифицируются на временные и постоянные"""
+        session = http_session_manager.get_session()
+        key, reservation = self.key_pool.acquire()
+        try:
+            async with session.post(
+                self._url(key, model),
+                headers=self._headers(key),
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                await self._raise_for_status(response)
+                result = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise GeminiRetryableError(f"ошибка соединения: {e!r}") from e
+        except GeminiRetryableError as e:
+            if e.status == 429:
+                # Повтор уйдет на другой ключ, ждать нужно только если свободных нет
+                e.retry_after = self.key_pool.quarantine(key, e.retry_after)
+            raise
+        self.key_pool.record_usage(key, reservation, result.get('usageMetadata'))
+        return result
+    
+    async def _stream_once(self, body: bytes, timeout: float, on_text: ProgressCallback,
+                           model: Optional[str] = None) -> str:
+        """
+        Один потоковый запрос (streamGenerateContent, SSE)
+        
+        Каждое событие содержит следующий фрагмент ответа; on_text получает
+        весь накопленный текст после каждого фрагмента.
+        """
+        session = http_session_manager.get_session()
+        key, reservation = self.key_pool.acquire()
+        chunks = []
+        usage = None
+        try:
+            async with session.post(
+                self._url(key, model, stream=True),
+                headers=self._headers(key),
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                await self._raise_for_status(response)
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    try:
+                        event = json.loads(line[5:])
+                    except ValueError:
+                        logger.warning(f"Некорректное событие потока Gemini: {line[:200]}")
+                        continue
+                    # usageMetadata приходит с накопленными значениями, берем последнее
+                    usage = event.get('usageMetadata') or usage
+                    parts = (event.get('candidates') or [{}])[0].get('content', {}).get('parts', [])
+                    piece = "".join(part.get('text', '') for part in parts)
+                    if not piece:
+                        continue
+                    chunks.append(piece)
+                    try:
+                        await on_text("".join(chunks))
+                    except Exception as e:
+                        # Ошибка показа промежуточного результата не должна прерывать анализ
+                        logger.warning(f"Ошибка обработки фрагмента потока: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise GeminiRetryableError(f"ошибка соединения (поток): {e!r}") from e
+        except GeminiRetryableError as e:
+            if e.status == 429:
+                # Повтор уйдет на другой ключ, ждать нужно только если свободных нет
+                e.retry_after = self.key_pool.quarantine(key, e.retry_after)
+            raise
+        
+        self.key_pool.record_usage(key, reservation, usage)
+        if not chunks:
+            raise GeminiServiceError("Пустой потоковый ответ Gemini")
+        return "".join(chunks)
+    
+    def _extract_text(self, result: Dict) -> str:
+        """Извлекает текст ответа модели"""
+        try:
+            return result['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            logger.error(f"Неожиданный формат ответа Gemini: {result}")
+            raise GeminiServiceError("Неожиданный формат ответа Gemini") from None
+    
+    async def _generate_content(self, payload: dict, operation: str,
+                                on_text: Optional[ProgressCallback] = None, model: Optional[str] = None) -> str:
+        """
+        Отправляет payload в Gemini с повторами и хеджированием, возвращает текст ответа
+        
+        С on_text ответ читается потоком (без хеджирования: два потока
+        перебивали бы друг друга в одном сообщении). model - модель уровня
+        из ModelTiers (None - модель ключа из пула).
+        """
+        # Сериализация многомегабайтного payload с фото - в пуле потоков, не в цикле событий
+        body = await offloader.run_in_thread(self.encode_payload, payload)
+        logger.debug(f"Payload keys: {list(payload.keys())}, {len(body)} байт, модель: {model or 'по ключу'}")
+        if on_text and self.supports_streaming:
+            return await self.caller.call(
+                lambda timeout: self._stream_once(body, timeout, on_text, model), f"{operation}:stream", hedge=False)
+        result = await self.caller.call(lambda timeout: self._post_once(body, timeout, model), operation)
+        return self._extract_text(result)
+    
+    async def analyze_food(self, image_path: str, weight_grams: int,
+                           on_progress: Optional[ProgressCallback] = None, model: Optional[str] = None) -> str:
         """
         Анализирует фото еды с помощью Google Gemini API (прямое подключение)
         
         Args:
             image_path: путь к файлу изображения
             weight_grams: вес еды в граммах
+            on_progress: колбэк для промежуточного текста (потоковый режим)
+            model: модель Gemini (None - модель по умолчанию)
             
         Returns:
             Строка с анализом КБЖУ и витаминов
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -116,72 +287,31 @@ class GeminiService:
                 ]
             }
             
-            headers = {
-                'Content-Type': 'application/json',
-                'X-goog-api-key': self.api_key
-            }
-            
-            # Очищаем payload от None значений
-            clean_payload = self.clean_payload(payload)
-            logger.debug(f"Payload keys: {list(clean_payload.keys())}")
-            
-            # Выполняем прямой запрос (без VPN)
             logger.info("Выполняем запрос к Gemini API (прямое подключение)")
-            async with aiohttp.ClientSession() as session:
-                try:
-                    async with session.post(
-                        self.base_url,
-                        headers=headers,
-                        json=clean_payload,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        
-                        if response.status != 200:
-                            error_text = await response.text()
-                            logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
-                            return f"Ошибка анализа изображения: {response.status}"
-                        
-                        result = await response.json()
-                        
-                        # Извлекаем текст ответа
-                        if 'candidates' in result and len(result['candidates']) > 0:
-                            if 'content' in result['candidates'][0]:
-                                if 'parts' in result['candidates'][0]['content']:
-                                    if len(result['candidates'][0]['content']['parts']) > 0:
-                                        return result['candidates'][0]['content']['parts'][0]['text']
-                        
-                        logger.error(f"Неожиданный формат ответа Gemini: {result}")
-                        return "Не удалось получить анализ изображения"
-                
-                except aiohttp.ClientError as e:
-                    logger.error(f"Ошибка HTTP клиента: {e}")
-                    return f"Ошибка соединения с Gemini API: {str(e)}"
-                except Exception as e:
-                    logger.error(f"Неожиданная ошибка при запросе к Gemini: {e}")
-                    return f"Неожиданная ошибка: {str(e)}"
+            return await self._generate_content(payload, "analyze_food", on_progress, model)
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через Gemini: {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
     
-    async def analyze_food_auto_weight(self, image_path: str) -> str:
+    async def analyze_food_auto_weight(self, image_path: str, on_progress: Optional[ProgressCallback] = None,
+                                       model: Optional[str] = None) -> str:
         """
         Анализирует фото еды с автоматическим определением веса Gemini (прямое подключение)
         
         Args:
             image_path: путь к файлу изображения
+            on_progress: колбэк для промежуточного текста (потоковый режим)
+            model: модель Gemini (None - модель по умолчанию)
             
         Returns:
             Строка с анализом КБЖУ и витаминов с автоопределенным весом
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -248,61 +378,176 @@ class GeminiService:
                 ]
             }
             
-            headers = {
-                'Content-Type': 'application/json',
-                'X-goog-api-key': self.api_key
+            logger.info("Выполняем запрос к Gemini API (автовес, прямое подключение)")
+            return await self._generate_content(payload, "analyze_food_auto_weight", on_progress, model)
+            
+        except GeminiServiceError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при анализе еды через Gemini (автовес): {e}")
+            raise GeminiServiceError(str(e)) from e
+    
+    async def analyze_food_structured(self, image_path: str, weight_grams: Optional[int] = None,
+                                      on_progress: Optional[ProgressCallback] = None,
+                                      model: Optional[str] = None,
+                                      image_max_side: Optional[int] = None) -> Dict:
+        """
+        Анализирует фото еды в структурированном режиме (JSON по responseSchema)
+        
+        Args:
+            image_path: путь к файлу изображения
+            weight_grams: вес еды в граммах (None - модель оценивает вес сама)
+            on_progress: колбэк для промежуточного текста (потоковый режим)
+            model: модель Gemini (None - модель по умолчанию)
+            image_max_side: длинная сторона фото для первого прохода в уменьшенном разрешении
+            
+        Returns:
+            Словарь с текстом анализа (analysis_text) и проверенными значениями (nutrition);
+            для уменьшенного фото - еще image_stats (байты и токены для телеметрии)
+        """
+        try:
+            # Сжимаем и кодируем изображение
+            processed = await self._process_image(image_path, image_max_side)
+            base64_image = await offloader.run_in_thread(encode_base64, processed['data'])
+            mime_type = processed['mime_type']
+            
+            if weight_grams:
+                weight_task = f"Общий вес порции: {weight_grams} г, распредели его между продуктами."
+            else:
+                weight_task = ("Оцени вес порции по визуальным признакам (размер тарелки, "
+                               "сравнение с привычными объектами).")
+            
+            prompt = f"""
+            Проанализируй изображение еды. {weight_task}
+            Для каждого продукта укажи название на русском, вес в граммах, калории, белки, жиры и углеводы.
+            Итоговые калории и БЖУ - сумма по продуктам. total_weight_grams - общий вес порции.
+            В vitamins укажи только витамины и минералы (процент от дневной нормы взрослого),
+            без холестерина, клетчатки и антиоксидантов.
+            Анализируй любое изображение с едой, включая десерты и напитки.
+            """
+            
+            payload = {
+                "contents": [
+                    {
+                        "parts": [
+                            {
+                                "text": prompt
+                            },
+                            {
+                                "inline_data": {
+                                    "mime_type": mime_type,
+                                    "data": base64_image
+                                }
+                            }
+                        ]
+                    }
+                ],
+                "generationConfig": {
+                    "responseMimeType": "application/json",
+                    "responseSchema": NUTRITION_RESPONSE_SCHEMA
+                }
+            }
+            
+            logger.info("Выполняем запрос к Gemini API (структурированный ответ)")
+            async def show_partial_products(partial_json: str):
+                # Пока JSON не закончен, показываем уже распознанные продукты
+                preview = render_partial_preview(partial_json)
+                if preview:
+                    await on_progress(preview)
+            response_text = await self._generate_content(
+                payload, "analyze_food_structured", show_partial_products if on_progress else None, model
+            )
+            try:
+                data = json.loads(response_text)
+            except ValueError:
+                logger.error(f"Gemini вернул некорректный JSON: {response_text[:500]}")
+                raise GeminiServiceError("Некорректный JSON в ответе Gemini") from None
+            
+            nutrition = validate_nutrition(data, weight_grams)
+            result = {
+                'analysis_text': render_analysis_text(nutrition, auto_weight=not weight_grams),
+                'nutrition': nutrition,
             }
+            if image_max_side:
+                result['image_stats'] = adaptive_resolution.describe_image(processed)
+            return result
             
-            # Очищаем payload от None значений
-            clean_payload = self.clean_payload(payload)
-            logger.debug(f"Payload keys: {list(clean_payload.keys())}")
+        except GeminiServiceError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при структурированном анализе еды через Gemini: {e}")
+            raise GeminiServiceError(str(e)) from e
+    
+    async def locate_dishes(self, image_path: str, model: Optional[str] = None,
+                            image_max_side: Optional[int] = None) -> List[Dict]:
+        """
+        Находит отдельные блюда на фото для анализа мульти-тарелки по частям
+        
+        Args:
+            image_path: ссылка на фото в photo_store или путь к файлу
+            model: модель Gemini (None - модель по умолчанию)
+            image_max_side: длинная сторона фото (для рамок хватает уменьшенной копии)
             
-            # Выполняем прямой запрос (без VPN)
-            logger.info("Выполняем запрос к Gemini API (автовес, прямое подключение)")
-            async with aiohttp.ClientSession() as session:
-                try:
-                    async with session.post(
-                        self.base_url,
-                        headers=headers,
-                        json=clean_payload,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        
-                        if response.status != 200:
-                            error_text = await response.text()
-                            logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
-                            return f"Ошибка анализа изображения: {response.status}"
-                        
-                        result = await response.json()
-                        
-                        # Извлекаем текст ответа
-                        if 'candidates' in result and len(result['candidates']) > 0:
-                            if 'content' in result['candidates'][0]:
-                                if 'parts' in result['candidates'][0]['content']:
-                                    if len(result['candidates'][0]['content']['parts']) > 0:
-                                        return result['candidates'][0]['content']['parts'][0]['text']
-                        
-                        logger.error(f"Неожиданный формат ответа Gemini: {result}")
-                        return "Не удалось получить анализ изображения"
-                
-                except aiohttp.ClientError as e:
-                    logger.error(f"Ошибка HTTP клиента: {e}")
-                    return f"Ошибка соединения с Gemini API: {str(e)}"
-                except Exception as e:
-                    logger.error(f"Неожиданная ошибка при запросе к Gemini: {e}")
-                    return f"Неожиданная ошибка: {str(e)}"
+        Returns:
+            [{'name', 'box': [ymin, xmin, ymax, xmax]}], координаты от 0 до 1000
+        """
+        try:
+            processed = await self._process_image(image_path, image_max_side)
+            base64_image = await offloader.run_in_thread(encode_base64, processed['data'])
+            
+            prompt = """
+            Найди на фото отдельные блюда и напитки (каждая тарелка, миска, стакан или
+            отдельно лежащая еда - отдельное блюдо). Для каждого укажи короткое название
+            на русском и рамку box_2d [ymin, xmin, ymax, xmax] в координатах от 0 до 1000.
+            Продукты на одной тарелке - одно блюдо. Посуду без еды не указывай.
+            """
+            
+            payload = {
+                "contents": [
+                    {
+                        "parts": [
+                            {
+                                "text": prompt
+                            },
+                            {
+                                "inline_data": {
+                                    "mime_type": processed['mime_type'],
+                                    "data": base64_image
+                                }
+                            }
+                        ]
+                    }
+                ],
+                "generationConfig": {
+                    "responseMimeType": "application/json",
+                    "responseSchema": DISH_LOCATION_SCHEMA
+                }
+            }
+            
+            logger.info("Выполняем запрос к Gemini API (локализация блюд)")
+            response_text = await self._generate_content(payload, "locate_dishes", model=model)
+            try:
+                data = json.loads(response_text)
+            except ValueError:
+                logger.error(f"Gemini вернул некорректный JSON: {response_text[:500]}")
+                raise GeminiServiceError("Некорректный JSON в ответе Gemini") from None
+            return validate_dish_locations(data)
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
-            logger.error(f"Ошибка при анализе еды через Gemini (автовес): {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            logger.error(f"Ошибка при локализации блюд через Gemini: {e}")
+            raise GeminiServiceError(str(e)) from e
     
-    async def correct_analysis(self, original_analysis: str, user_correction: str) -> str:
+    async def correct_analysis(self, original_analysis: str, user_correction: str,
+                               model: Optional[str] = None) -> str:
         """
         Исправляет анализ на основе пользовательской коррекции
         
         Args:
             original_analysis: Оригинальный анализ от Gemini
             user_correction: Текст коррекции от пользователя
+            model: модель Gemini (None - модель по умолчанию)
             
         Returns:
             Исправленный анализ
@@ -341,41 +586,29 @@ class GeminiService:
                 ]
             }
             
-            headers = {
-                'Content-Type': 'application/json',
-                'X-goog-api-key': self.api_key
-            }
-            
-            # Очищаем payload от None значений
-            clean_payload = self.clean_payload(payload)
-            
-            # Выполняем запрос коррекции
             logger.info("Выполняем запрос коррекции анализа к Gemini API")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.base_url,
-                    headers=headers,
-                    json=clean_payload,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Gemini API при коррекции {response.status}: {error_text}")
-                        return f"Ошибка при исправлении анализа: {response.status}"
-                    
-                    result = await response.json()
-                    
-                    # Извлекаем текст ответа
-                    if 'candidates' in result and len(result['candidates']) > 0:
-                        if 'content' in result['candidates'][0]:
-                            if 'parts' in result['candidates'][0]['content']:
-                                if len(result['candidates'][0]['content']['parts']) > 0:
-                                    return result['candidates'][0]['content']['parts'][0]['text']
-                    
-                    logger.error(f"Неожиданный формат ответа Gemini при коррекции: {result}")
-                    return "Не удалось исправить анализ"
+            return await self._generate_content(payload, "correct_analysis", model=model)
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при коррекции анализа через Gemini: {e}")
-            return f"Произошла ошибка при исправлении анализа: {str(e)}"
+            raise GeminiServiceError(str(e), user_message="❌ Не удалось исправить анализ. Попробуйте еще раз через минуту.") from e
+    
+    async def generate_text(self, prompt: str, model: Optional[str] = None) -> str:
+        """
+        Генерирует текст по промпту (рекомендации по питанию)
+        
+        Args:
+            prompt: текст запроса
+            model: модель Gemini (None - уровень "recommendations" из GEMINI_MODEL_TIERS)
+        """
+        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        try:
+            return await self._generate_content(
+                payload, "recommendations", model=model or model_tiers.select("recommendations"))
+        except GeminiServiceError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка генерации текста через Gemini: {e}")
+            raise GeminiServiceError(str(e)) from e
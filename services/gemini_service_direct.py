@@ -2,24 +2,41 @@ import base64
 import logging
 import aiohttp
 import json
-from config import GEMINI_API_KEY
+from typing import Tuple
+from config import GEMINI_API_KEY, GEMINI_MODEL
+from .http_session import http_session_manager
+from .image_preprocessor import image_preprocessor, encode_base64
+from .photo_store import photo_store
+from .offload import offloader
+from .analysis_provider import AnalysisProvider
+from .gemini_errors import GeminiServiceError
 
 logger = logging.getLogger(__name__)
 
-class GeminiService:
+class GeminiService(AnalysisProvider):
+    name = "direct"
+    
     def __init__(self):
         self.api_key = GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
     
     def encode_image(self, image_path: str) -> str:
         """Кодирует изображение в base64"""
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            return base64.b64encode(photo_store.read(image_path)).decode('utf-8')
         except Exception as e:
             logger.error(f"Ошибка при кодировании изображения: {e}")
             raise
     
+    async def prepare_image(self, image_path: str) -> Tuple[str, str]:
+        """Уменьшает изображение и кодирует его в base64 вне цикла событий, возвращает (данные, MIME тип)"""
+        try:
+            processed = await image_preprocessor.process_file_async(image_path)
+            return await offloader.run_in_thread(encode_base64, processed['data']), processed['mime_type']
+        except Exception as e:
+            logger.error(f"Ошибка при подготовке изображения: {e}")
+            raise
+    
     async def analyze_food(self, image_path: str, weight_grams: int) -> str:
         """
         Анализирует фото еды с помощью Google Gemini API (прямое подключение)
@@ -32,13 +49,8 @@ class GeminiService:
             Строка с анализом КБЖУ и витаминов
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -108,34 +120,36 @@ class GeminiService:
             
             # Выполняем прямой запрос (без VPN)
             logger.info("Выполняем запрос к Gemini API (прямое подключение)")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.base_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
+            session = http_session_manager.get_session()
+            async with session.post(
+                self.base_url,
+                headers=headers,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
                     
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
-                        return f"Ошибка анализа изображения: {response.status}"
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
+                    raise GeminiServiceError(f"HTTP {response.status}", status=response.status)
                     
-                    result = await response.json()
+                result = await response.json()
                     
-                    # Извлекаем текст ответа
-                    if 'candidates' in result and len(result['candidates']) > 0:
-                        if 'content' in result['candidates'][0]:
-                            if 'parts' in result['candidates'][0]['content']:
-                                if len(result['candidates'][0]['content']['parts']) > 0:
-                                    return result['candidates'][0]['content']['parts'][0]['text']
+                # Извлекаем текст ответа
+                if 'candidates' in result and len(result['candidates']) > 0:
+                    if 'content' in result['candidates'][0]:
+                        if 'parts' in result['candidates'][0]['content']:
+                            if len(result['candidates'][0]['content']['parts']) > 0:
+                                return result['candidates'][0]['content']['parts'][0]['text']
                     
-                    logger.error(f"Неожиданный формат ответа Gemini: {result}")
-                    return "Не удалось получить анализ изображения"
+                logger.error(f"Неожиданный формат ответа Gemini: {result}")
+                raise GeminiServiceError("Неожиданный формат ответа Gemini")
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через Gemini: {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
     
     async def analyze_food_auto_weight(self, image_path: str) -> str:
         """
@@ -148,13 +162,8 @@ class GeminiService:
             Строка с анализом КБЖУ и витаминов с автоопределенным весом
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -228,34 +237,36 @@ class GeminiService:
             
             # Выполняем прямой запрос (без VPN)
             logger.info("Выполняем запрос к Gemini API (автовес, прямое подключение)")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.base_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
+            session = http_session_manager.get_session()
+            async with session.post(
+                self.base_url,
+                headers=headers,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
                     
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
-                        return f"Ошибка анализа изображения: {response.status}"
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
+                    raise GeminiServiceError(f"HTTP {response.status}", status=response.status)
                     
-                    result = await response.json()
+                result = await response.json()
                     
-                    # Извлекаем текст ответа
-                    if 'candidates' in result and len(result['candidates']) > 0:
-                        if 'content' in result['candidates'][0]:
-                            if 'parts' in result['candidates'][0]['content']:
-                                if len(result['candidates'][0]['content']['parts']) > 0:
-                                    return result['candidates'][0]['content']['parts'][0]['text']
+                # Извлекаем текст ответа
+                if 'candidates' in result and len(result['candidates']) > 0:
+                    if 'content' in result['candidates'][0]:
+                        if 'parts' in result['candidates'][0]['content']:
+                            if len(result['candidates'][0]['content']['parts']) > 0:
+                                return result['candidates'][0]['content']['parts'][0]['text']
                     
-                    logger.error(f"Неожиданный формат ответа Gemini: {result}")
-                    return "Не удалось получить анализ изображения"
+                logger.error(f"Неожиданный формат ответа Gemini: {result}")
+                raise GeminiServiceError("Неожиданный формат ответа Gemini")
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через Gemini (автовес): {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
     
     async def correct_analysis(self, original_analysis: str, user_correction: str) -> str:
         """
@@ -309,31 +320,33 @@ class GeminiService:
             
             # Выполняем запрос коррекции
             logger.info("Выполняем запрос коррекции анализа к Gemini API")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.base_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
+            session = http_session_manager.get_session()
+            async with session.post(
+                self.base_url,
+                headers=headers,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
                     
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Gemini API при коррекции {response.status}: {error_text}")
-                        return f"Ошибка при исправлении анализа: {response.status}"
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"Ошибка Gemini API при коррекции {response.status}: {error_text}")
+                    raise GeminiServiceError(f"HTTP {response.status}", status=response.status)
                     
-                    result = await response.json()
+                result = await response.json()
                     
-                    # Извлекаем текст ответа
-                    if 'candidates' in result and len(result['candidates']) > 0:
-                        if 'content' in result['candidates'][0]:
-                            if 'parts' in result['candidates'][0]['content']:
-                                if len(result['candidates'][0]['content']['parts']) > 0:
-                                    return result['candidates'][0]['content']['parts'][0]['text']
+                # Извлекаем текст ответа
+                if 'candidates' in result and len(result['candidates']) > 0:
+                    if 'content' in result['candidates'][0]:
+                        if 'parts' in result['candidates'][0]['content']:
+                            if len(result['candidates'][0]['content']['parts']) > 0:
+                                return result['candidates'][0]['content']['parts'][0]['text']
                     
-                    logger.error(f"Неожиданный формат ответа Gemini при коррекции: {result}")
-                    return "Не удалось исправить анализ"
+                logger.error(f"Неожиданный формат ответа Gemini при коррекции: {result}")
+                raise GeminiServiceError("Неожиданный формат ответа Gemini")
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при коррекции анализа через Gemini: {e}")
-            return f"Произошла ошибка при исправлении анализа: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
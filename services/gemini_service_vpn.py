@@ -2,26 +2,42 @@ import base64
 import logging
 import aiohttp
 import json
-from config import GEMINI_API_KEY
+from typing import Tuple
+from config import GEMINI_API_KEY, GEMINI_MODEL
 from .vpn_connector import VPNConnector
+from .analysis_provider import AnalysisProvider
+from .gemini_errors import GeminiServiceError, GeminiRetryableError
+from .image_preprocessor import image_preprocessor, encode_base64
+from .photo_store import photo_store
+from .offload import offloader
 
 logger = logging.getLogger(__name__)
 
-class GeminiService:
+class GeminiService(AnalysisProvider):
+    name = "vpn"
+    
     def __init__(self):
         self.api_key = GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+        self.base_url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
         self.vpn_connector = VPNConnector()
     
     def encode_image(self, image_path: str) -> str:
         """Кодирует изображение в base64"""
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            return base64.b64encode(photo_store.read(image_path)).decode('utf-8')
         except Exception as e:
             logger.error(f"Ошибка при кодировании изображения: {e}")
             raise
     
+    async def prepare_image(self, image_path: str) -> Tuple[str, str]:
+        """Уменьшает изображение и кодирует его в base64 вне цикла событий, возвращает (данные, MIME тип)"""
+        try:
+            processed = await image_preprocessor.process_file_async(image_path)
+            return await offloader.run_in_thread(encode_base64, processed['data']), processed['mime_type']
+        except Exception as e:
+            logger.error(f"Ошибка при подготовке изображения: {e}")
+            raise
+    
     async def _make_vpn_request(self, payload: dict) -> dict:
         """Выполняет запрос к Gemini API через VPN"""
         headers = {
@@ -29,41 +45,25 @@ class GeminiService:
             'X-goog-api-key': self.api_key
         }
         
-        # Пробуем использовать VPN сессию
+        # Без VPN запрос не выполняем: переключение на прямое подключение
+        # делает цепочка бэкендов с circuit breaker
         vpn_session = await self.vpn_connector.create_vpn_session()
-        if vpn_session:
-            try:
-                logger.info("Выполняем запрос к Gemini через VPN")
-                async with vpn_session.post(
-                    self.base_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Gemini API через VPN {response.status}: {error_text}")
-                        raise aiohttp.ClientError(f"API error: {response.status}")
-                    
-                    return await response.json()
-            finally:
-                await vpn_session.close()
+        if not vpn_session:
+            raise GeminiRetryableError("VPN недоступен")
         
-        # Fallback: обычный запрос без VPN
-        logger.warning("VPN недоступен, пробуем обычный запрос")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.base_url,
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка Gemini API {response.status}: {error_text}")
-                    raise aiohttp.ClientError(f"API error: {response.status}")
-                
-                return await response.json()
+        logger.info("Выполняем запрос к Gemini через VPN")
+        async with vpn_session.post(
+            self.base_url,
+            headers=headers,
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=60)
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"Ошибка Gemini API через VPN {response.status}: {error_text}")
+                raise GeminiServiceError(f"HTTP {response.status}", status=response.status)
+            
+            return await response.json()
     
     async def analyze_food(self, image_path: str, weight_grams: int) -> str:
         """
@@ -77,13 +77,8 @@ class GeminiService:
             Строка с анализом КБЖУ и витаминов
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -157,11 +152,13 @@ class GeminiService:
                             return result['candidates'][0]['content']['parts'][0]['text']
             
             logger.error(f"Неожиданный формат ответа Gemini: {result}")
-            return "Не удалось получить анализ изображения"
+            raise GeminiServiceError("Неожиданный формат ответа Gemini")
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через Gemini: {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
     
     async def analyze_food_auto_weight(self, image_path: str) -> str:
         """
@@ -174,13 +171,8 @@ class GeminiService:
             Строка с анализом КБЖУ и витаминов с автоопределенным весом
         """
         try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Определяем MIME тип
-            mime_type = "image/jpeg"
-            if image_path.lower().endswith('.png'):
-                mime_type = "image/png"
+            # Сжимаем и кодируем изображение
+            base64_image, mime_type = await self.prepare_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -258,8 +250,10 @@ class GeminiService:
                             return result['candidates'][0]['content']['parts'][0]['text']
             
             logger.error(f"Неожиданный формат ответа Gemini: {result}")
-            return "Не удалось получить анализ изображения"
+            raise GeminiServiceError("Неожиданный формат ответа Gemini")
             
+        except GeminiServiceError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через Gemini (автовес): {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            raise GeminiServiceError(str(e)) from e
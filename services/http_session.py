@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+import aiohttp
+from config import (
+    GEMINI_HTTP_POOL_LIMIT,
+    GEMINI_HTTP_POOL_LIMIT_PER_HOST,
+    GEMINI_HTTP_KEEPALIVE_TIMEOUT,
+    GEMINI_HTTP_DNS_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+GEMINI_API_HOST = "https://generativelanguage.googleapis.com"
+
+
+class HttpSessionManager:
+    """Общий пул HTTP соединений к Gemini API на весь процесс.
+
+    Сессии создаются один раз и переиспользуются всеми сервисами, поэтому
+    TCP/TLS рукопожатие с generativelanguage.googleapis.com выполняется
+    только при открытии нового соединения в пуле, а не на каждое фото.
+    Жизненным циклом управляет bot.py: start() при запуске и close() при остановке.
+    """
+
+    def __init__(self):
+        # Ключ - локальный адрес привязки (None - обычное подключение, IP - VPN интерфейс)
+        self._sessions: Dict[Optional[str], aiohttp.ClientSession] = {}
+        self._lock = asyncio.Lock()
+
+    def _create_session(self, local_addr: Optional[str] = None) -> aiohttp.ClientSession:
+        """Создает сессию с настроенным TCPConnector"""
+        connector = aiohttp.TCPConnector(
+            limit=GEMINI_HTTP_POOL_LIMIT,
+            limit_per_host=GEMINI_HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=GEMINI_HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=GEMINI_HTTP_DNS_TTL,
+            use_dns_cache=True,
+            enable_cleanup_closed=True,
+            local_addr=(local_addr, 0) if local_addr else None,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        logger.info(f"Создана общая HTTP сессия (local_addr={local_addr or 'default'})")
+        return session
+
+    def get_session(self, local_addr: Optional[str] = None) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая ее при первом обращении"""
+        session = self._sessions.get(local_addr)
+        if session is None or session.closed:
+            session = self._create_session(local_addr)
+            self._sessions[local_addr] = session
+        return session
+
+    async def start(self) -> aiohttp.ClientSession:
+        """Создает основную сессию при запуске бота"""
+        async with self._lock:
+            return self.get_session()
+
+    async def warmup(self, url: str = GEMINI_API_HOST) -> bool:
+        """Прогревает пул: резолвит DNS и устанавливает TLS соединение заранее"""
+        try:
+            session = self.get_session()
+            async with session.head(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                await response.read()
+            logger.info(f"HTTP пул прогрет ({url})")
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось прогреть HTTP пул: {e}")
+            return False
+
+    async def close(self):
+        """Закрывает все сессии при остановке бота"""
+        async with self._lock:
+            for local_addr, session in list(self._sessions.items()):
+                try:
+                    if not session.closed:
+                        await session.close()
+                except Exception as e:
+                    logger.error(f"Ошибка закрытия HTTP сессии ({local_addr or 'default'}): {e}")
+            self._sessions.clear()
+            logger.info("HTTP сессии закрыты")
+
+
+# Глобальный экземпляр пула соединений
+http_session_manager = HttpSessionManager()
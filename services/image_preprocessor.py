@@ -0,0 +1,226 @@
+import base64
+import io
+import logging
+from typing import Dict, List, Optional
+from PIL import Image, ImageOps
+from config import (
+    IMAGE_PREPROCESS_ENABLED,
+    IMAGE_MAX_SIDE,
+    IMAGE_QUALITY,
+    IMAGE_OUTPUT_FORMAT,
+)
+from .photo_store import photo_store, is_photo_ref
+from .offload import offloader
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png",
+}
+
+
+def encode_base64(data: bytes) -> str:
+    """Base64 для inline_data запроса (вызывается в пуле потоков)"""
+    return base64.b64encode(data).decode('utf-8')
+
+
+def _initial_result(data: bytes) -> Dict:
+    """Результат без обработки: исходные байты"""
+    return {
+        'data': data,
+        'mime_type': ImagePreprocessor.detect_mime_type(data),
+        'original_size': len(data),
+        'processed_size': len(data),
+        'bytes_saved': 0,
+        'resized': False,
+        'data_changed': False,
+        'dimensions': None,
+        'original_dimensions': None,
+    }
+
+
+def transform_image(data: bytes, max_side: int, quality: int, output_format: str) -> Dict:
+    """
+    Пережимает изображение (без состояния: выполняется и в пуле процессов)
+
+    Ошибка Pillow не бросается, а возвращается в поле error вместе с оригиналом.
+    """
+    result = _initial_result(data)
+    result['error'] = None
+    original_size = len(data)
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            original_dimensions = image.size
+            result['dimensions'] = result['original_dimensions'] = original_dimensions
+
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            # thumbnail сохраняет пропорции и никогда не увеличивает изображение
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            resized = image.size != original_dimensions
+
+            # Метаданные не передаются в save(), поэтому EXIF/ICC отбрасываются
+            buffer = io.BytesIO()
+            image.save(buffer, format=output_format, quality=quality, optimize=True)
+            processed = buffer.getvalue()
+
+        # Если изображение уже маленькое и хорошо сжато, оставляем оригинал
+        if not resized and len(processed) >= original_size:
+            return result
+
+        result.update({
+            'data': processed,
+            'mime_type': MIME_TYPES[output_format],
+            'processed_size': len(processed),
+            'bytes_saved': original_size - len(processed),
+            'resized': resized,
+            'data_changed': True,
+            'dimensions': image.size,
+        })
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def crop_regions(data: bytes, boxes: List[List[int]], padding: float, quality: int,
+                 output_format: str, box_scale: int = 1000) -> List[bytes]:
+    """
+    Вырезает области фото (без состояния: выполняется и в пуле процессов)
+
+    Args:
+        boxes: рамки [ymin, xmin, ymax, xmax] в координатах 0..box_scale
+            (относительно фото с примененной EXIF ориентацией)
+        padding: поле вокруг рамки в долях ее стороны (модель режет блюда впритык)
+
+    Returns:
+        байты каждой области в формате output_format
+    """
+    crops = []
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        width, height = image.size
+        for ymin, xmin, ymax, xmax in boxes:
+            pad_y = (ymax - ymin) * padding
+            pad_x = (xmax - xmin) * padding
+            region = (
+                max(0, round((xmin - pad_x) / box_scale * width)),
+                max(0, round((ymin - pad_y) / box_scale * height)),
+                min(width, round((xmax + pad_x) / box_scale * width)),
+                min(height, round((ymax + pad_y) / box_scale * height)),
+            )
+            buffer = io.BytesIO()
+            image.crop(region).save(buffer, format=output_format, quality=quality)
+            crops.append(buffer.getvalue())
+    return crops
+
+
+class ImagePreprocessor:
+    """Уменьшает и пережимает фото перед отправкой в Gemini"""
+
+    def __init__(self, max_side: int = IMAGE_MAX_SIDE, quality: int = IMAGE_QUALITY,
+                 output_format: str = IMAGE_OUTPUT_FORMAT, enabled: bool = IMAGE_PREPROCESS_ENABLED):
+        self.max_side = max_side
+        self.quality = quality
+        self.output_format = output_format.upper()
+        if self.output_format not in ("JPEG", "WEBP"):
+            logger.warning(f"Неподдерживаемый формат {output_format}, используем JPEG")
+            self.output_format = "JPEG"
+        self.enabled = enabled
+
+        # Накопительная статистика для оценки экономии
+        self._processed_count = 0
+        self._original_bytes = 0
+        self._processed_bytes = 0
+
+    @staticmethod
+    def detect_mime_type(data: bytes) -> str:
+        """Определяет MIME тип по сигнатуре файла"""
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return "image/png"
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "image/webp"
+        return "image/jpeg"
+
+    def process_bytes(self, data: bytes, max_side: Optional[int] = None) -> Dict:
+        """
+        Применяет EXIF ориентацию, ограничивает длинную сторону и пережимает изображение
+
+        Args:
+            data: исходные байты изображения
+            max_side: длинная сторона результата (None - self.max_side)
+
+        Returns:
+            Словарь с байтами результата, MIME типом, размерами до/после
+            и габаритами изображения (dimensions, original_dimensions)
+        """
+        if not self.enabled:
+            return _initial_result(data)
+        return self._finish(transform_image(data, max_side or self.max_side, self.quality, self.output_format))
+
+    def process_file(self, image_path: str, max_side: Optional[int] = None) -> Dict:
+        """Читает фото (из буфера в памяти или файла) и обрабатывает его"""
+        return self.process_bytes(photo_store.read(image_path), max_side)
+
+    async def process_file_async(self, image_path: str, max_side: Optional[int] = None) -> Dict:
+        """Как process_file, но чтение файла и Pillow выполняются вне цикла событий"""
+        if is_photo_ref(image_path):
+            data = photo_store.read(image_path)
+        else:
+            data = await offloader.run_in_thread(photo_store.read, image_path)
+        if not self.enabled:
+            return _initial_result(data)
+        result = await offloader.run_in_process(
+            transform_image, data, max_side or self.max_side, self.quality, self.output_format)
+        return self._finish(result)
+
+    async def crop_file_async(self, image_path: str, boxes: List[List[int]], padding: float) -> List[bytes]:
+        """Вырезает области фото (блюда мульти-тарелки) вне цикла событий"""
+        if is_photo_ref(image_path):
+            data = photo_store.read(image_path)
+        else:
+            data = await offloader.run_in_thread(photo_store.read, image_path)
+        return await offloader.run_in_process(crop_regions, data, boxes, padding, self.quality, self.output_format)
+
+    def _finish(self, result: Dict) -> Dict:
+        """Пишет в лог и статистику результат transform_image"""
+        error = result.pop('error')
+        if error:
+            logger.warning(f"Не удалось обработать изображение, отправляем оригинал: {error}")
+            return result
+
+        self._record(result['original_size'], result['processed_size'])
+        if result['data_changed']:
+            original_dimensions, dimensions = result['original_dimensions'], result['dimensions']
+            logger.info(
+                f"Изображение сжато: {original_dimensions[0]}x{original_dimensions[1]} -> "
+                f"{dimensions[0]}x{dimensions[1]}, {result['original_size']} -> {result['processed_size']} байт "
+                f"(сэкономлено {result['bytes_saved']} байт)"
+            )
+        return result
+
+    def _record(self, original_size: int, processed_size: int):
+        """Обновляет накопительную статистику"""
+        self._processed_count += 1
+        self._original_bytes += original_size
+        self._processed_bytes += processed_size
+
+    def get_stats(self) -> Dict:
+        """Возвращает статистику сжатия с момента запуска"""
+        saved = self._original_bytes - self._processed_bytes
+        return {
+            'processed_count': self._processed_count,
+            'original_bytes': self._original_bytes,
+            'processed_bytes': self._processed_bytes,
+            'bytes_saved': saved,
+            'saved_percent': (saved / self._original_bytes * 100) if self._original_bytes else 0.0,
+        }
+
+
+# Глобальный экземпляр препроцессора
+image_preprocessor = ImagePreprocessor()
@@ -0,0 +1,249 @@
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+from utils import extract_portion_weight, parse_nutrition_values, rescale_analysis_text
+from .nutrition_schema import scale_nutrition, render_analysis_text
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать долю локальных исправлений в лог (в коррекциях)
+STATS_LOG_INTERVAL = 50
+
+# Пределы веса порции, как в weight_handler
+MIN_WEIGHT_GRAMS = 1
+MAX_WEIGHT_GRAMS = 5000
+
+_WEIGHT_VALUE_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(кг|килограмм\w*|г|гр|грамм\w*|g)?(?![а-яa-z])')
+_TIMES_RE = re.compile(r'(?:в\s+)?(\d+(?:[.,]\d+)?|два|две|три|четыре|пять)\s+раза?\s+(больше|меньше)')
+_MULTIPLIER_RE = re.compile(r'(?:^|\s)[x×*х]\s*(\d+(?:[.,]\d+)?)(?:\s|$)')
+_PORTIONS_RE = re.compile(r'(\d+(?:[.,]\d+)?|две|три|полторы)\s+порци[иийя]')
+_REMOVE_RE = re.compile(r'^(?:убери|убрать|удали|удалить|исключи|без|минус|не\s+было|нет)\s+(.+)$')
+_NOT_PRESENT_RE = re.compile(r'^(.+?)\s+(?:не\s+было|нет|не\s+ел|не\s+ела)$')
+_ITEM_SPLIT_RE = re.compile(r'\s*(?:,|\sи\s)\s*')
+
+_NUMBER_WORDS = {'два': 2, 'две': 2, 'три': 3, 'четыре': 4, 'пять': 5, 'полторы': 1.5}
+
+_PORTION_WORDS = {
+    'половина': 0.5, 'половину': 0.5, 'пол': 0.5, 'полпорции': 0.5, 'полпорция': 0.5,
+    'треть': 1 / 3, 'четверть': 0.25,
+    'двойная': 2.0, 'двойную': 2.0, 'двойной': 2.0, 'вдвое больше': 2.0, 'вдвое меньше': 0.5,
+    'полторы': 1.5,
+}
+
+# Слова, которые не меняют смысл исправления веса или порции.
+# Если в сообщении осталось что-то кроме них - это смысловое исправление для модели.
+_FILLER_WORDS = {
+    'вес', 'весит', 'весом', 'масса', 'порция', 'порции', 'порцию', 'порций', 'тарелка', 'тарелки',
+    'не', 'а', 'на', 'самом', 'деле', 'было', 'была', 'был', 'это', 'там', 'всего', 'только', 'же',
+    'я', 'съел', 'съела', 'ел', 'ела', 'примерно', 'около', 'где-то', 'точнее', 'правильно',
+    'получилось', 'нет', 'в', 'раз', 'раза', 'больше', 'меньше', 'из', 'от', 'всей',
+    'г', 'гр', 'грамм', 'грамма', 'граммов', 'кг', 'g', 'x', 'х', '×',
+}
+
+_WORD_RE = re.compile(r'[а-яa-z×\-]+')
+# Фразы размера порции целыми словами, длинные раньше коротких: "пол" не должно резать "полторы"
+_PORTION_PHRASE_RE = re.compile(
+    r'(?<![а-яa-z])(?:' + '|'.join(re.escape(phrase) for phrase in sorted(_PORTION_WORDS, key=len, reverse=True))
+    + r')(?![а-яa-z])'
+)
+# Минимальная длина слова из названия продукта при сравнении
+_MIN_STEM = 3
+_STEM_LENGTH = 5
+
+
+def _normalize(text: str) -> str:
+    text = (text or '').lower().replace('ё', 'е')
+    # Точку между цифрами оставляем: "0.5 кг"
+    return re.sub(r'[!?;:«»"()]+|\.(?!\d)', ' ', text).strip()
+
+
+def _to_number(value: str) -> float:
+    return _NUMBER_WORDS.get(value) or float(value.replace(',', '.'))
+
+
+def _only_fillers(text: str) -> bool:
+    """Остались ли в тексте только служебные слова (без продуктов и прочего смысла)"""
+    text = _PORTION_PHRASE_RE.sub(' ', text)
+    return all(word in _FILLER_WORDS or word in _NUMBER_WORDS for word in _WORD_RE.findall(text))
+
+
+def _words_match(a: str, b: str) -> bool:
+    # Сравниваем начала слов, чтобы "хлеба" совпадало с "хлеб", а "курицы" с "курица"
+    length = min(len(a), len(b), _STEM_LENGTH)
+    return length >= _MIN_STEM and a[:length] == b[:length]
+
+
+class LocalCorrectionEngine:
+    """Исправления анализа, которые считаются без модели
+
+    Узнает три вида исправлений:
+      - вес порции: "Вес не 450г, а 300г", "300 г";
+      - размер порции: "половина", "в 2 раза больше", "x2";
+      - удаление продукта: "убери хлеб", "соуса не было" (нужны КБЖУ по продуктам
+        из структурированного ответа).
+    Всё остальное (замена продуктов, добавление) уходит в correct_analysis модели.
+    """
+
+    def __init__(self):
+        self._stats = {
+            'total': 0,
+            'weight': 0,
+            'portion': 0,
+            'remove': 0,
+            'model': 0,
+        }
+
+    def correct(self, analysis_text: str, correction: str, nutrition: Optional[Dict] = None,
+                weight: Optional[int] = None) -> Optional[Dict]:
+        """
+        Пробует исправить анализ локально
+
+        Args:
+            analysis_text: текущий текст анализа
+            correction: сообщение пользователя
+            nutrition: проверенные значения структурированного ответа (если есть)
+            weight: вес порции, указанный пользователем (None - автоопределение)
+
+        Returns:
+            {'analysis_text', 'nutrition', 'weight', 'kind'} или None, если нужна модель
+        """
+        self._stats['total'] += 1
+        text = _normalize(correction)
+        current_weight = (nutrition or {}).get('weight') or weight or extract_portion_weight(analysis_text)
+
+        result = None
+        removed = self._parse_removal(text)
+        if removed:
+            result = self._remove_products(analysis_text, nutrition, removed)
+        if result is None and _only_fillers(text):
+            factor = self._parse_portion_factor(text)
+            new_weight = self._parse_weight(text) if factor is None else None
+            if new_weight and current_weight:
+                result = self._rescale(analysis_text, nutrition, new_weight / current_weight, new_weight, 'weight')
+            elif factor and current_weight:
+                result = self._rescale(analysis_text, nutrition, factor, round(current_weight * factor), 'portion')
+
+        if result is None:
+            self._stats['model'] += 1
+        else:
+            self._stats[result['kind']] += 1
+            logger.info(f"Исправление \"{correction}\" выполнено локально ({result['kind']})")
+        self._log_stats()
+        return result
+
+    @staticmethod
+    def _parse_weight(text: str) -> Optional[int]:
+        """Новый вес - последнее число в сообщении ("не 450г, а 300г" -> 300)"""
+        values = _WEIGHT_VALUE_RE.findall(text)
+        if not values:
+            return None
+        number, unit = values[-1]
+        grams = float(number.replace(',', '.')) * (1000 if unit.startswith('к') else 1)
+        if not MIN_WEIGHT_GRAMS <= grams <= MAX_WEIGHT_GRAMS:
+            return None
+        return round(grams)
+
+    @staticmethod
+    def _parse_portion_factor(text: str) -> Optional[float]:
+        match = _TIMES_RE.search(text)
+        if match:
+            times = _to_number(match.group(1))
+            if times <= 0:
+                return None
+            return times if match.group(2) == 'больше' else 1 / times
+        match = _MULTIPLIER_RE.search(text)
+        if match:
+            return _to_number(match.group(1))
+        match = _PORTIONS_RE.search(text)
+        if match:
+            return _to_number(match.group(1))
+        match = _PORTION_PHRASE_RE.search(text)
+        if match:
+            return _PORTION_WORDS[match.group(0)]
+        return None
+
+    @staticmethod
+    def _parse_removal(text: str) -> List[str]:
+        match = _REMOVE_RE.match(text) or _NOT_PRESENT_RE.match(text)
+        if not match:
+            return []
+        return [item for item in _ITEM_SPLIT_RE.split(match.group(1).strip(' ,')) if item]
+
+    def _rescale(self, analysis_text: str, nutrition: Optional[Dict], factor: float,
+                 new_weight: int, kind: str) -> Optional[Dict]:
+        if factor <= 0 or not MIN_WEIGHT_GRAMS <= new_weight <= MAX_WEIGHT_GRAMS:
+            return None
+        if nutrition:
+            scaled = scale_nutrition(nutrition, factor, new_weight)
+            text = render_analysis_text(scaled)
+        else:
+            scaled = None
+            text = rescale_analysis_text(analysis_text, factor, new_weight)
+            if not parse_nutrition_values(text)['calories']:
+                return None
+        return {'analysis_text': text, 'nutrition': scaled, 'weight': new_weight, 'kind': kind}
+
+    def _remove_products(self, analysis_text: str, nutrition: Optional[Dict],
+                         items: List[str]) -> Optional[Dict]:
+        """Убирает продукты, если для каждого известны граммы и КБЖУ"""
+        if not nutrition or not nutrition.get('products'):
+            return None
+
+        removed: List[Dict] = []
+        for item in items:
+            item_words = [w for w in _WORD_RE.findall(item) if len(w) >= _MIN_STEM]
+            if not item_words:
+                return None
+            matches = [
+                product for product in nutrition['products']
+                if all(any(_words_match(word, product_word)
+                           for product_word in _WORD_RE.findall(_normalize(product['name'])))
+                       for word in item_words)
+            ]
+            if not matches:
+                return None
+            removed.extend(p for p in matches if p not in removed)
+
+        remaining = [p for p in nutrition['products'] if p not in removed]
+        if not remaining:
+            return None
+
+        total_grams = sum(p['grams'] for p in nutrition['products'])
+        left_grams = sum(p['grams'] for p in remaining)
+        updated, removed_grams = self._subtract(nutrition, removed)
+        updated['products'] = remaining
+        updated['weight'] = max(MIN_WEIGHT_GRAMS, round((nutrition.get('weight') or total_grams) - removed_grams))
+        # % витаминов по продуктам неизвестны - уменьшаем пропорционально массе
+        share = left_grams / total_grams if total_grams else 1.0
+        updated['vitamins'] = {name: round(percent * share) for name, percent in nutrition.get('vitamins', {}).items()}
+
+        auto_weight = 'ПРИМЕРНЫЙ ВЕС' in (analysis_text or '').upper()
+        return {'analysis_text': render_analysis_text(updated, auto_weight=auto_weight), 'nutrition': updated,
+                'weight': updated['weight'], 'kind': 'remove'}
+
+    @staticmethod
+    def _subtract(nutrition: Dict, removed: List[Dict]) -> Tuple[Dict, float]:
+        updated = dict(nutrition)
+        updated['calories'] = max(0, round(nutrition['calories'] - sum(p['calories'] for p in removed)))
+        for key in ('proteins', 'fats', 'carbs'):
+            updated[key] = max(0.0, round(nutrition[key] - sum(p[key] for p in removed), 1))
+        return updated, sum(p['grams'] for p in removed)
+
+    def _log_stats(self):
+        if self._stats['total'] % STATS_LOG_INTERVAL:
+            return
+        stats = self.get_stats()
+        logger.info(f"Исправления анализа: {stats['total']}, локально {stats['local_share'] * 100:.0f}% "
+                    f"(вес {stats['weight']}, порция {stats['portion']}, удаление {stats['remove']})")
+
+    def get_stats(self) -> Dict:
+        """Метрики исправлений: сколько выполнено локально, сколько ушло в модель"""
+        stats = dict(self._stats)
+        local = stats['weight'] + stats['portion'] + stats['remove']
+        stats['local'] = local
+        stats['local_share'] = local / stats['total'] if stats['total'] else 0.0
+        return stats
+
+
+# Глобальный движок локальных исправлений
+local_correction_engine = LocalCorrectionEngine()
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from config import (
+    LOOP_LAG_MONITOR_ENABLED,
+    LOOP_LAG_INTERVAL,
+    LOOP_LAG_WARN_SECONDS,
+)
+from .gemini_retry import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику в лог (в замерах)
+STATS_LOG_INTERVAL = 600
+
+
+class LoopLagMonitor:
+    """Замер задержки цикла событий
+
+    Фоновая задача засыпает на interval секунд и смотрит, насколько позже
+    она проснулась. Опоздание - время, на которое цикл был занят синхронной
+    работой (кодирование фото, JSON) и не обрабатывал другие апдейты.
+    Перцентили - по последним замерам, опоздания больше warn_seconds
+    пишутся в лог.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, warn_seconds: float = LOOP_LAG_WARN_SECONDS,
+                 enabled: bool = LOOP_LAG_MONITOR_ENABLED):
+        self.interval = interval
+        self.warn_seconds = warn_seconds
+        self.enabled = enabled
+        self._task: Optional[asyncio.Task] = None
+        self._lags = LatencyTracker(window=1000)
+        self._stats = {'samples': 0, 'slow': 0, 'max_lag': 0.0}
+
+    def start(self):
+        """Запускает замер (в работающем цикле событий)"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Замер задержки цикла событий: каждые {self.interval} с")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - started - self.interval))
+
+    def record(self, lag: float):
+        """Учитывает одно опоздание цикла событий"""
+        self._lags.record(lag)
+        self._stats['samples'] += 1
+        self._stats['max_lag'] = max(self._stats['max_lag'], lag)
+        if lag > self.warn_seconds:
+            self._stats['slow'] += 1
+            logger.warning(f"Цикл событий был занят {lag * 1000:.0f} мс")
+        if self._stats['samples'] % STATS_LOG_INTERVAL == 0:
+            stats = self.get_stats()
+            logger.info(f"Задержка цикла событий: p50 {stats['lag_p50'] * 1000:.1f} мс, "
+                        f"p99 {stats['lag_p99'] * 1000:.1f} мс, max {stats['max_lag'] * 1000:.0f} мс")
+
+    def get_stats(self) -> Dict:
+        """Перцентили задержки цикла событий (в секундах) и число долгих блокировок"""
+        return {
+            **self._stats,
+            'lag_p50': self._lags.percentile(50) or 0.0,
+            'lag_p95': self._lags.percentile(95) or 0.0,
+            'lag_p99': self._lags.percentile(99) or 0.0,
+        }
+
+
+# Глобальный замер задержки цикла событий
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+from aiogram.types import Message
+from config import MEDIA_GROUP_WINDOW_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class MediaGroupCollector:
+    """Сбор фото альбома (media group) в одну пачку
+
+    Telegram присылает каждое фото альбома отдельным апдейтом с общим
+    media_group_id. Первый апдейт ждет, пока window_seconds не приходит
+    новых фото альбома, и получает весь альбом; остальные апдейты только
+    добавляют свое фото и больше ничего не делают.
+    """
+
+    def __init__(self, window_seconds: float = MEDIA_GROUP_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        # media_group_id -> {'messages', 'last_at'}
+        self._groups: Dict[str, Dict] = {}
+        self._stats = {'albums': 0, 'photos': 0}
+
+    async def collect(self, message: Message) -> Optional[List[Message]]:
+        """
+        Добавляет сообщение в альбом
+
+        Returns:
+            все сообщения альбома по порядку - для первого сообщения альбома,
+            None - для остальных (их обработает первое)
+        """
+        group_id = message.media_group_id
+        self._stats['photos'] += 1
+        group = self._groups.get(group_id)
+        if group is not None:
+            group['messages'].append(message)
+            group['last_at'] = time.monotonic()
+            return None
+
+        group = {'messages': [message], 'last_at': time.monotonic()}
+        self._groups[group_id] = group
+        try:
+            while True:
+                wait = group['last_at'] + self.window_seconds - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            self._groups.pop(group_id, None)
+
+        self._stats['albums'] += 1
+        messages = sorted(group['messages'], key=lambda item: item.message_id)
+        logger.info(f"Альбом {group_id}: собрано {len(messages)} фото")
+        return messages
+
+    def get_stats(self) -> Dict:
+        """Собранные альбомы и фото в них"""
+        albums = self._stats['albums']
+        return {
+            **self._stats,
+            'pending': len(self._groups),
+            'avg_photos': self._stats['photos'] / albums if albums else 0.0,
+        }
+
+
+# Глобальный сборщик альбомов
+media_group_collector = MediaGroupCollector()
@@ -0,0 +1,54 @@
+import logging
+from typing import Dict, List, Optional
+from config import GEMINI_MODEL, GEMINI_MODEL_TIERS, GEMINI_MODEL_ESCALATION
+
+logger = logging.getLogger(__name__)
+
+
+class ModelTiers:
+    """Выбор модели Gemini по операции и тарифу пользователя
+
+    Уровни задаются в GEMINI_MODEL_TIERS: сначала ищется "операция/тариф",
+    затем "операция", иначе используется основная модель GEMINI_MODEL.
+    Ответ более дешевой модели, не прошедший проверку, повторяется на
+    основной модели (escalation).
+    """
+
+    def __init__(self, tiers: Optional[Dict[str, str]] = None, default_model: str = GEMINI_MODEL,
+                 escalation_enabled: bool = GEMINI_MODEL_ESCALATION):
+        self.tiers = dict(tiers if tiers is not None else GEMINI_MODEL_TIERS)
+        self.default_model = default_model
+        self.escalation_enabled = escalation_enabled
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def resolve(self, operation: str, plan: Optional[str] = None) -> str:
+        """Модель для операции и тарифа (без учета в метриках)"""
+        return (self.tiers.get(f"{operation}/{plan}") if plan else None) or self.tiers.get(operation) \
+            or self.default_model
+
+    def select(self, operation: str, plan: Optional[str] = None) -> str:
+        """Модель для запроса операции и тарифа"""
+        model = self.resolve(operation, plan)
+        stats = self._stats.setdefault(operation, {})
+        stats[model] = stats.get(model, 0) + 1
+        return model
+
+    def escalation_model(self, model: str) -> Optional[str]:
+        """Модель для повтора, если ответ model не прошел проверку (None - повтора не будет)"""
+        if not self.escalation_enabled or model == self.default_model:
+            return None
+        return self.default_model
+
+    def record_escalation(self, operation: str, model: str, problems: List[str]):
+        stats = self._stats.setdefault(operation, {})
+        stats['escalations'] = stats.get('escalations', 0) + 1
+        logger.warning(f"Ответ {model} для {operation} не прошел проверку ({'; '.join(problems)}), "
+                       f"повторяем на {self.default_model}")
+
+    def get_stats(self) -> Dict:
+        """Сколько запросов ушло на каждую модель и сколько повторено на основной"""
+        return {operation: dict(stats) for operation, stats in self._stats.items()}
+
+
+# Глобальный выбор моделей Gemini
+model_tiers = ModelTiers()
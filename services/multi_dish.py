@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+from config import (
+    MULTI_DISH_SPLIT_ENABLED,
+    MULTI_DISH_MAX_DISHES,
+    MULTI_DISH_CROP_PADDING,
+)
+from utils import parse_nutrition_values, extract_portion_weight, extract_meal_title
+from .analysis_provider import ProgressCallback
+from .analysis_router import analysis_router
+from .speculative_analysis import speculative_analysis
+from .image_preprocessor import image_preprocessor
+from .photo_store import photo_store
+from .nutrition_schema import merge_nutrition, render_analysis_text
+from .gemini_errors import GeminiServiceError, GeminiQueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику в лог (в анализах)
+STATS_LOG_INTERVAL = 20
+
+
+def dish_nutrition(name: str, analysis: Dict) -> Dict:
+    """Значения анализа блюда; для текстового ответа - разобранные из текста, блюдо как один продукт"""
+    if analysis['nutrition']:
+        return analysis['nutrition']
+    values = parse_nutrition_values(analysis['analysis_text'])
+    weight = extract_portion_weight(analysis['analysis_text']) or 0
+    return {
+        **values,
+        'weight': weight,
+        'products': [{'name': name, 'grams': weight, 'calories': values['calories'],
+                      'proteins': values['proteins'], 'fats': values['fats'], 'carbs': values['carbs']}],
+    }
+
+
+def render_multi_dish_text(dishes: List[Dict], merged: Dict) -> str:
+    """Текст анализа тарелки: список блюд с калориями и общий анализ в привычном формате"""
+    lines = ["БЛЮДА:"]
+    for dish in dishes:
+        if dish['nutrition']:
+            lines.append(f"- {dish['name']} (~{dish['nutrition']['weight']} г): {dish['nutrition']['calories']} ккал")
+        else:
+            lines.append(f"- {dish['name']}: не удалось проанализировать")
+    return "\n".join(lines) + "\n\n" + render_analysis_text(merged, auto_weight=True)
+
+
+class MultiDishAnalyzer:
+    """Анализ мульти-тарелки по блюдам
+
+    1. Быстрый запрос по уменьшенной копии фото находит блюда и их рамки.
+    2. Вырезанные блюда анализируются одновременно, каждое через общую
+       очередь Gemini, - время ответа определяет самое медленное блюдо,
+       а не один большой запрос на всю тарелку.
+    3. Значения блюд складываются в общий анализ.
+    Если блюд меньше двух или поиск не удался, анализируется фото целиком
+    (результат упреждающего анализа, если он есть). Фото альбома
+    анализируются так же, как вырезанные блюда: параллельно и с общим итогом.
+    """
+
+    def __init__(self, enabled: bool = MULTI_DISH_SPLIT_ENABLED, max_dishes: int = MULTI_DISH_MAX_DISHES,
+                 crop_padding: float = MULTI_DISH_CROP_PADDING):
+        self.enabled = enabled
+        self.max_dishes = max_dishes
+        self.crop_padding = crop_padding
+        self._stats = {
+            'analyses': 0,
+            'albums': 0,
+            'split': 0,
+            'whole_photo': 0,
+            'dishes': 0,
+            'dish_failures': 0,
+            'split_seconds': 0.0,
+            'slowest_dish_seconds': 0.0,
+            'dish_seconds': 0.0,
+        }
+
+    async def analyze(self, image_path: str, user_id: int, subscription_type: Optional[str] = None,
+                      file_unique_id: Optional[str] = None,
+                      on_progress: Optional[ProgressCallback] = None) -> Dict:
+        """
+        Анализирует фото с несколькими блюдами
+
+        Returns:
+            {'analysis_text', 'nutrition', 'dishes'}: dishes - анализы отдельных
+            блюд [{'name', 'box', 'analysis_text', 'nutrition'}] (пусто, если
+            фото анализировалось целиком)
+        """
+        self._stats['analyses'] += 1
+        dishes = await self._locate(image_path, user_id, subscription_type) if self.enabled else []
+        if len(dishes) < 2:
+            self._stats['whole_photo'] += 1
+            analysis = await self._analyze_whole(image_path, user_id, subscription_type, file_unique_id, on_progress)
+            self._log_stats()
+            return {**analysis, 'dishes': []}
+
+        # Фото целиком больше не нужно
+        speculative_analysis.cancel(user_id)
+        result = await self._analyze_split(image_path, dishes, user_id, subscription_type, on_progress)
+        self._log_stats()
+        return result
+
+    async def _locate(self, image_path: str, user_id: int, subscription_type: Optional[str]) -> List[Dict]:
+        try:
+            dishes = await analysis_router.locate_dishes(image_path, user_id=user_id,
+                                                         subscription_type=subscription_type)
+        except GeminiQueueTimeoutError:
+            raise
+        except GeminiServiceError as e:
+            logger.warning(f"Не удалось найти блюда на фото ({e}), анализируем фото целиком")
+            return []
+        if len(dishes) > self.max_dishes:
+            logger.warning(f"Найдено {len(dishes)} блюд, анализируем первые {self.max_dishes}")
+        return dishes[:self.max_dishes]
+
+    async def _analyze_whole(self, image_path: str, user_id: int, subscription_type: Optional[str],
+                             file_unique_id: Optional[str], on_progress: Optional[ProgressCallback]) -> Dict:
+        analysis = await speculative_analysis.take(user_id, image_path, on_progress=on_progress)
+        if analysis is None:
+            analysis = await analysis_router.analyze_food_auto_weight(
+                image_path,
+                file_unique_id=file_unique_id,
+                user_id=user_id,
+                subscription_type=subscription_type,
+                on_progress=on_progress
+            )
+        return analysis
+
+    async def analyze_album(self, photos: List[Dict], user_id: int, subscription_type: Optional[str] = None,
+                            on_progress: Optional[ProgressCallback] = None) -> Dict:
+        """
+        Анализирует фото альбома (каждое - отдельный прием пищи) параллельно и складывает их
+
+        Args:
+            photos: [{'image_path', 'file_unique_id'}] в порядке альбома
+
+        Returns:
+            {'analysis_text', 'nutrition', 'dishes'} как в analyze, dishes - анализы фото
+        """
+        self._stats['albums'] += 1
+        parts = [{'name': f"Фото {index + 1}", 'image_path': photo['image_path'],
+                  'file_unique_id': photo.get('file_unique_id')} for index, photo in enumerate(photos)]
+        analyzed = await self._analyze_parts(parts, user_id, subscription_type, on_progress,
+                                             f"Фото в альбоме: {len(parts)}", name_from_analysis=True)
+        self._stats['dishes'] += len(parts)
+        return self._merge(analyzed)
+
+    async def _analyze_split(self, image_path: str, dishes: List[Dict], user_id: int,
+                             subscription_type: Optional[str], on_progress: Optional[ProgressCallback]) -> Dict:
+        crops = await image_preprocessor.crop_file_async(image_path, [dish['box'] for dish in dishes],
+                                                         self.crop_padding)
+        refs = [photo_store.put(user_id, crop) for crop in crops]
+        logger.info(f"Мульти-тарелка: {len(dishes)} блюд ({', '.join(d['name'] for d in dishes)}), "
+                    f"анализируем параллельно")
+        try:
+            analyzed = await self._analyze_parts(
+                [{**dish, 'image_path': ref} for dish, ref in zip(dishes, refs)],
+                user_id, subscription_type, on_progress, f"Найдено блюд: {len(dishes)}")
+        finally:
+            for ref in refs:
+                photo_store.discard(ref)
+        self._stats['split'] += 1
+        self._stats['dishes'] += len(dishes)
+        return self._merge(analyzed)
+
+    async def _analyze_parts(self, parts: List[Dict], user_id: int, subscription_type: Optional[str],
+                             on_progress: Optional[ProgressCallback], header: str,
+                             name_from_analysis: bool = False) -> List[Dict]:
+        """
+        Анализирует части (блюда или фото) одновременно, каждую через общую очередь Gemini
+
+        Returns:
+            части с analysis_text и nutrition (None у не проанализированных)
+
+        Raises:
+            GeminiServiceError: не удалось проанализировать ни одну часть
+        """
+        started = time.monotonic()
+        status = [f"⏳ {part['name']}" for part in parts]
+        durations: List[float] = []
+
+        async def report():
+            if on_progress:
+                await on_progress(header + "\n" + "\n".join(status))
+
+        async def analyze_part(index: int) -> Dict:
+            part = parts[index]
+            part_started = time.monotonic()
+            try:
+                analysis = await analysis_router.analyze_food_auto_weight(
+                    part['image_path'], file_unique_id=part.get('file_unique_id'),
+                    user_id=user_id, subscription_type=subscription_type)
+            except GeminiServiceError:
+                status[index] = f"⚠️ {part['name']}"
+                await report()
+                raise
+            durations.append(time.monotonic() - part_started)
+            name = part['name']
+            if name_from_analysis:
+                name = extract_meal_title(analysis['analysis_text'], analysis['nutrition'])
+            nutrition = dish_nutrition(name, analysis)
+            status[index] = f"✅ {name}: {nutrition['calories']} ккал"
+            await report()
+            return {**part, 'name': name, 'analysis_text': analysis['analysis_text'], 'nutrition': nutrition}
+
+        await report()
+        results = await asyncio.gather(*(analyze_part(index) for index in range(len(parts))),
+                                       return_exceptions=True)
+
+        analyzed = []
+        errors = []
+        for part, result in zip(parts, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"{part['name']}: анализ не удался: {result}")
+                self._stats['dish_failures'] += 1
+                errors.append(result)
+                analyzed.append({**part, 'analysis_text': None, 'nutrition': None})
+            else:
+                analyzed.append(result)
+        if len(errors) == len(parts):
+            raise errors[0]
+
+        elapsed = time.monotonic() - started
+        self._stats['split_seconds'] += elapsed
+        self._stats['slowest_dish_seconds'] += max(durations, default=0.0)
+        self._stats['dish_seconds'] += sum(durations)
+        logger.info(f"{header}: проанализировано за {elapsed:.1f} с "
+                    f"(самое медленное {max(durations, default=0.0):.1f} с, сумма {sum(durations):.1f} с)")
+        return analyzed
+
+    @staticmethod
+    def _merge(analyzed: List[Dict]) -> Dict:
+        merged = merge_nutrition([part['nutrition'] for part in analyzed if part['nutrition']])
+        return {
+            'analysis_text': render_multi_dish_text(analyzed, merged),
+            'nutrition': merged,
+            # Ссылки на фото частей после анализа недействительны
+            'dishes': [{key: value for key, value in part.items() if key != 'image_path'} for part in analyzed],
+        }
+
+    def _log_stats(self):
+        if self._stats['analyses'] % STATS_LOG_INTERVAL:
+            return
+        stats = self.get_stats()
+        logger.info(f"Мульти-тарелка: {stats['analyses']} анализов, по блюдам {stats['split']}, "
+                    f"в среднем {stats['avg_dishes']:.1f} блюд за {stats['avg_split_seconds']:.1f} с")
+
+    def get_stats(self) -> Dict:
+        """Анализы по блюдам, целиком и альбомов, среднее время и выигрыш от параллельного анализа"""
+        split = self._stats['split'] + self._stats['albums']
+        return {
+            **self._stats,
+            'avg_dishes': self._stats['dishes'] / split if split else 0.0,
+            'avg_split_seconds': self._stats['split_seconds'] / split if split else 0.0,
+            # Во сколько раз сумма времени блюд больше времени самого медленного
+            'parallel_speedup': (self._stats['dish_seconds'] / self._stats['slowest_dish_seconds']
+                                 if self._stats['slowest_dish_seconds'] else 0.0),
+        }
+
+
+# Глобальный анализатор мульти-тарелки
+multi_dish_analyzer = MultiDishAnalyzer()
@@ -0,0 +1,324 @@
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional
+from .gemini_errors import GeminiServiceError
+
+logger = logging.getLogger(__name__)
+
+# Схема ответа Gemini в структурированном режиме (responseSchema, подмножество OpenAPI)
+NUTRITION_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "products": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "grams": {"type": "NUMBER"},
+                    "calories": {"type": "NUMBER"},
+                    "proteins": {"type": "NUMBER"},
+                    "fats": {"type": "NUMBER"},
+                    "carbs": {"type": "NUMBER"},
+                },
+                "required": ["name", "grams", "calories", "proteins", "fats", "carbs"],
+            },
+        },
+        "total_weight_grams": {"type": "NUMBER"},
+        "calories": {"type": "NUMBER"},
+        "proteins": {"type": "NUMBER"},
+        "fats": {"type": "NUMBER"},
+        "carbs": {"type": "NUMBER"},
+        "vitamins": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "percent": {"type": "NUMBER"},
+                },
+                "required": ["name", "percent"],
+            },
+        },
+        "confidence": {
+            "type": "NUMBER",
+            "description": "Уверенность в распознавании продуктов и веса от 0 до 1",
+        },
+    },
+    "required": ["products", "total_weight_grams", "calories", "proteins", "fats", "carbs", "vitamins",
+                 "confidence"],
+    "propertyOrdering": ["products", "total_weight_grams", "calories", "proteins", "fats", "carbs", "vitamins",
+                         "confidence"],
+}
+
+# Схема ответа локализации блюд для мульти-тарелки: рамки в координатах 0-1000
+DISH_LOCATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "dishes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "box_2d": {
+                        "type": "ARRAY",
+                        "items": {"type": "INTEGER"},
+                        "description": "Рамка блюда [ymin, xmin, ymax, xmax], координаты от 0 до 1000",
+                    },
+                },
+                "required": ["name", "box_2d"],
+            },
+        },
+    },
+    "required": ["dishes"],
+}
+
+# Рамки координат локализации
+BOX_SCALE = 1000
+# Рамка меньше этой доли стороны фото - скорее ошибка модели, чем блюдо
+MIN_BOX_SIDE = 30
+
+# Разумные пределы для одной порции
+MAX_PORTION_GRAMS = 5000
+MAX_PORTION_CALORIES = 10000
+MAX_VITAMIN_PERCENT = 2000
+
+
+def _number(value: Any, field: str, upper: float) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{field}: ожидалось число, получено {value!r}")
+    if value < 0 or value > upper:
+        raise ValueError(f"{field}: значение {value} вне допустимого диапазона")
+    return float(value)
+
+
+def validate_nutrition(data: Any, weight_grams: Optional[int] = None) -> Dict:
+    """
+    Проверяет структурированный ответ модели и приводит его к формату хранения
+
+    Формат совпадает с utils.parse_nutrition_values (calories, proteins,
+    fats, carbs, vitamins) и дополнен списком продуктов и весом порции.
+
+    Raises:
+        GeminiServiceError: ответ не соответствует схеме или содержит невозможные значения
+    """
+    try:
+        if not isinstance(data, dict):
+            raise ValueError("ответ не является объектом")
+
+        products: List[Dict] = []
+        for index, item in enumerate(data.get("products") or []):
+            if not isinstance(item, dict) or not str(item.get("name", "")).strip():
+                raise ValueError(f"products[{index}]: нет названия продукта")
+            products.append({
+                'name': str(item["name"]).strip(),
+                'grams': round(_number(item.get("grams"), f"products[{index}].grams", MAX_PORTION_GRAMS)),
+                'calories': round(_number(item.get("calories"), f"products[{index}].calories", MAX_PORTION_CALORIES)),
+                'proteins': round(_number(item.get("proteins"), f"products[{index}].proteins", MAX_PORTION_GRAMS), 1),
+                'fats': round(_number(item.get("fats"), f"products[{index}].fats", MAX_PORTION_GRAMS), 1),
+                'carbs': round(_number(item.get("carbs"), f"products[{index}].carbs", MAX_PORTION_GRAMS), 1),
+            })
+        if not products:
+            raise ValueError("на фото не найдено продуктов")
+
+        vitamins = {}
+        for index, item in enumerate(data.get("vitamins") or []):
+            if not isinstance(item, dict) or not str(item.get("name", "")).strip():
+                raise ValueError(f"vitamins[{index}]: нет названия")
+            vitamins[str(item["name"]).strip()] = round(
+                _number(item.get("percent"), f"vitamins[{index}].percent", MAX_VITAMIN_PERCENT))
+
+        nutrition = {
+            'products': products,
+            'weight': weight_grams or round(_number(data.get("total_weight_grams"), "total_weight_grams", MAX_PORTION_GRAMS)),
+            'calories': round(_number(data.get("calories"), "calories", MAX_PORTION_CALORIES)),
+            'proteins': round(_number(data.get("proteins"), "proteins", MAX_PORTION_GRAMS), 1),
+            'fats': round(_number(data.get("fats"), "fats", MAX_PORTION_GRAMS), 1),
+            'carbs': round(_number(data.get("carbs"), "carbs", MAX_PORTION_GRAMS), 1),
+            'vitamins': vitamins,
+        }
+        # Уверенность модели нужна для выбора разрешения фото, в старых ответах ее нет
+        if data.get("confidence") is not None:
+            nutrition['confidence'] = round(_number(data["confidence"], "confidence", 1), 2)
+    except (ValueError, TypeError) as e:
+        logger.error(f"Структурированный ответ Gemini не прошел проверку: {e}")
+        raise GeminiServiceError(f"Некорректный структурированный ответ: {e}") from None
+
+    # Итог должен сходиться с суммой по продуктам (модель иногда ошибается в сложении)
+    products_calories = sum(p['calories'] for p in products)
+    if products_calories and abs(products_calories - nutrition['calories']) > max(50, 0.15 * products_calories):
+        logger.warning(
+            f"Калории по продуктам ({products_calories}) не сходятся с итогом ({nutrition['calories']}), "
+            f"используем сумму по продуктам"
+        )
+        nutrition['calories'] = products_calories
+        for key in ('proteins', 'fats', 'carbs'):
+            nutrition[key] = round(sum(p[key] for p in products), 1)
+    return nutrition
+
+
+# Энергетическая плотность еды не выше, чем у чистого жира (~9 ккал/г)
+MAX_KCAL_PER_GRAM = 9.5
+# Допустимое расхождение калорий с расчетом по БЖУ (4/4/9 ккал на грамм)
+MACRO_ENERGY_TOLERANCE = 0.35
+
+
+def nutrition_problems(nutrition: Dict, weight_grams: Optional[float] = None) -> List[str]:
+    """
+    Ищет в анализе признаки ошибки модели: нет КБЖУ или невозможные значения
+
+    Returns:
+        список найденных проблем (пустой - анализ правдоподобен)
+    """
+    problems = []
+    calories = nutrition.get('calories') or 0
+    macros = [nutrition.get(key) or 0 for key in ('proteins', 'fats', 'carbs')]
+    if not calories:
+        problems.append("нет калорий")
+    if not any(macros):
+        problems.append("нет БЖУ")
+
+    weight = weight_grams or nutrition.get('weight')
+    if calories and weight and calories / weight > MAX_KCAL_PER_GRAM:
+        problems.append(f"{calories / weight:.1f} ккал/г")
+
+    macro_calories = 4 * macros[0] + 9 * macros[1] + 4 * macros[2]
+    if calories and any(macros) and abs(macro_calories - calories) > max(80, MACRO_ENERGY_TOLERANCE * calories):
+        problems.append(f"калории ({calories}) не сходятся с БЖУ ({macro_calories:.0f})")
+    return problems
+
+
+def validate_dish_locations(data: Any) -> List[Dict]:
+    """
+    Проверяет ответ локализации блюд: [{'name', 'box': [ymin, xmin, ymax, xmax]}]
+
+    Некорректные рамки пропускаются (остальные блюда полезны и без них).
+
+    Raises:
+        GeminiServiceError: ответ не является объектом со списком dishes
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("dishes"), list):
+        logger.error(f"Некорректный ответ локализации блюд: {str(data)[:200]}")
+        raise GeminiServiceError("Некорректный ответ локализации блюд")
+
+    dishes = []
+    for index, item in enumerate(data["dishes"]):
+        box = item.get("box_2d") if isinstance(item, dict) else None
+        name = str(item.get("name", "")).strip() if isinstance(item, dict) else ""
+        if (not name or not isinstance(box, list) or len(box) != 4
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in box)):
+            logger.warning(f"dishes[{index}]: некорректная рамка блюда, пропускаем: {item!r}")
+            continue
+        ymin, xmin, ymax, xmax = (min(BOX_SCALE, max(0, round(v))) for v in box)
+        if ymax - ymin < MIN_BOX_SIDE or xmax - xmin < MIN_BOX_SIDE:
+            logger.warning(f"dishes[{index}]: слишком маленькая рамка блюда {name}, пропускаем")
+            continue
+        dishes.append({'name': name, 'box': [ymin, xmin, ymax, xmax]})
+    return dishes
+
+
+def merge_nutrition(parts: List[Dict]) -> Dict:
+    """Складывает значения анализов отдельных блюд в общий анализ тарелки
+
+    % витаминов тоже складываются (это норма на всю тарелку) и ограничены
+    MAX_VITAMIN_PERCENT, как значения одного анализа.
+    """
+    merged = {
+        'products': [product for part in parts for product in part.get('products', [])],
+        'weight': sum(part.get('weight') or 0 for part in parts) or None,
+        'calories': sum(part['calories'] for part in parts),
+        'proteins': round(sum(part['proteins'] for part in parts), 1),
+        'fats': round(sum(part['fats'] for part in parts), 1),
+        'carbs': round(sum(part['carbs'] for part in parts), 1),
+        'vitamins': {},
+    }
+    for part in parts:
+        for name, percent in part.get('vitamins', {}).items():
+            merged['vitamins'][name] = min(MAX_VITAMIN_PERCENT, merged['vitamins'].get(name, 0) + percent)
+    return merged
+
+
+def scale_nutrition(nutrition: Dict, factor: float, new_weight: Optional[int] = None) -> Dict:
+    """Пересчитывает числовые значения анализа пропорционально весу"""
+    scaled = {
+        'products': [
+            {**product,
+             'grams': round(product['grams'] * factor),
+             'calories': round(product['calories'] * factor),
+             'proteins': round(product['proteins'] * factor, 1),
+             'fats': round(product['fats'] * factor, 1),
+             'carbs': round(product['carbs'] * factor, 1)}
+            for product in nutrition.get('products', [])
+        ],
+        'weight': new_weight or (round(nutrition['weight'] * factor) if nutrition.get('weight') else None),
+        'calories': round(nutrition['calories'] * factor),
+        'proteins': round(nutrition['proteins'] * factor, 1),
+        'fats': round(nutrition['fats'] * factor, 1),
+        'carbs': round(nutrition['carbs'] * factor, 1),
+        'vitamins': {name: min(MAX_VITAMIN_PERCENT, round(percent * factor))
+                     for name, percent in nutrition.get('vitamins', {}).items()},
+    }
+    return scaled
+
+
+def _format_grams(value: float) -> str:
+    return f"{value:.1f}".rstrip('0').rstrip('.')
+
+
+def render_analysis_text(nutrition: Dict, auto_weight: bool = False) -> str:
+    """
+    Собирает текст анализа в привычном формате из проверенных значений
+
+    Текст нужен для показа пользователю, коррекций и старых потребителей,
+    которые читают analysis_text. Если вес порции неизвестен (None),
+    граммы в заголовке не пишутся.
+    """
+    weight = nutrition.get('weight')
+    products = ", ".join(f"{p['name']} (~{p['grams']} г)" for p in nutrition['products'])
+    lines = [f"ПРОДУКТЫ: {products}", ""]
+    if auto_weight and weight:
+        lines += [f"ПРИМЕРНЫЙ ВЕС: {weight} г (визуальная оценка)", ""]
+    lines += [
+        f"ПИЩЕВАЯ ЦЕННОСТЬ ({weight} г):" if weight else "ПИЩЕВАЯ ЦЕННОСТЬ:",
+        f"- Калории: {nutrition['calories']} ккал",
+        f"- Белки: {_format_grams(nutrition['proteins'])} г",
+        f"- Жиры: {_format_grams(nutrition['fats'])} г",
+        f"- Углеводы: {_format_grams(nutrition['carbs'])} г",
+    ]
+    if nutrition['vitamins']:
+        lines += ["", "ВИТАМИНЫ И МИНЕРАЛЫ (% от дневной нормы):"]
+        lines += [f"- {name}: {percent}% от дневной нормы" for name, percent in nutrition['vitamins'].items()]
+    return "\n".join(lines)
+
+
+# Законченный объект продукта внутри еще не законченного JSON
+_PARTIAL_OBJECT_RE = re.compile(r'\{[^{}]*\}')
+
+
+def render_partial_preview(partial_json: str) -> Optional[str]:
+    """
+    Собирает промежуточный текст из незаконченного JSON потокового ответа
+
+    Продукты идут в схеме первыми, поэтому их можно показать до того,
+    как модель досчитает КБЖУ и витамины.
+    """
+    start = partial_json.find('"products"')
+    if start == -1:
+        return None
+    end = partial_json.find('"total_weight_grams"', start)
+    section = partial_json[start:end if end != -1 else len(partial_json)]
+
+    products = []
+    for match in _PARTIAL_OBJECT_RE.finditer(section):
+        try:
+            item = json.loads(match.group(0))
+        except ValueError:
+            continue
+        if isinstance(item, dict) and item.get('name'):
+            grams = item.get('grams')
+            products.append(f"{item['name']} (~{round(grams)} г)" if isinstance(grams, (int, float)) else str(item['name']))
+    if not products:
+        return None
+    return f"ПРОДУКТЫ: {', '.join(products)}\n\n⏳ Считаю КБЖУ и витамины..."
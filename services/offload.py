@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, TypeVar
+from config import OFFLOAD_THREAD_WORKERS, OFFLOAD_PROCESS_WORKERS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Offloader:
+    """Выполнение тяжелой синхронной работы вне цикла событий
+
+    Чтение фото, base64 и сериализация JSON идут в пул потоков (они
+    отпускают GIL или короткие). Обработка фото Pillow - в пул процессов,
+    если OFFLOAD_PROCESS_WORKERS > 0, иначе тоже в пул потоков. Пулы
+    создаются при первом вызове. Если пул процессов сломался (процесс
+    убит), задача повторяется в потоке.
+    """
+
+    def __init__(self, thread_workers: int = OFFLOAD_THREAD_WORKERS,
+                 process_workers: int = OFFLOAD_PROCESS_WORKERS):
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._stats = {
+            kind: {'tasks': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            for kind in ('thread', 'process')
+        }
+
+    def _thread_pool(self) -> ThreadPoolExecutor:
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix="offload")
+        return self._threads
+
+    def _process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.process_workers <= 0:
+            return None
+        if self._processes is None:
+            self._processes = ProcessPoolExecutor(max_workers=self.process_workers)
+            logger.info(f"Пул процессов для обработки фото: {self.process_workers}")
+        return self._processes
+
+    async def run_in_thread(self, func: Callable[..., T], *args) -> T:
+        """Выполняет func(*args) в пуле потоков"""
+        return await self._run(self._thread_pool(), 'thread', func, *args)
+
+    async def run_in_process(self, func: Callable[..., T], *args) -> T:
+        """
+        Выполняет func(*args) в пуле процессов (или в потоке, если процессы выключены)
+
+        func и аргументы должны сериализоваться pickle: функция уровня модуля, байты, числа.
+        """
+        pool = self._process_pool()
+        if pool is None:
+            return await self.run_in_thread(func, *args)
+        try:
+            return await self._run(pool, 'process', func, *args)
+        except BrokenProcessPool:
+            logger.error("Пул процессов сломался, пересоздаем его; задача выполняется в потоке")
+            self._processes = None
+            pool.shutdown(wait=False)
+            return await self.run_in_thread(func, *args)
+
+    async def _run(self, pool: Executor, kind: str, func: Callable[..., T], *args) -> T:
+        stats = self._stats[kind]
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats['tasks'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def shutdown(self):
+        """Останавливает пулы (при остановке бота)"""
+        if self._threads is not None:
+            self._threads.shutdown(wait=False)
+            self._threads = None
+        if self._processes is not None:
+            # Ждем выхода процессов, иначе при завершении интерпретатора падают их каналы
+            self._processes.shutdown(wait=True, cancel_futures=True)
+            self._processes = None
+
+    def get_stats(self) -> Dict:
+        """Задачи по пулам: количество, ошибки, среднее и максимальное время (с очередью)"""
+        pools = {}
+        for kind, stats in self._stats.items():
+            pools[kind] = {
+                **stats,
+                'avg_seconds': stats['total_seconds'] / stats['tasks'] if stats['tasks'] else 0.0,
+            }
+        return {
+            'thread_workers': self.thread_workers,
+            'process_workers': self.process_workers,
+            'pools': pools,
+        }
+
+
+# Глобальный исполнитель тяжелой работы
+offloader = Offloader()
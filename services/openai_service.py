@@ -1,19 +1,25 @@
-import base64
+import asyncio
 import logging
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError
 from config import OPENAI_API_KEY
+from .analysis_provider import AnalysisProvider
+from .gemini_errors import GeminiServiceError, GeminiRetryableError
+from .image_preprocessor import encode_base64
+from .photo_store import photo_store
+from .offload import offloader
 
 logger = logging.getLogger(__name__)
 
-class OpenAIService:
+class OpenAIService(AnalysisProvider):
+    name = "openai"
+    
     def __init__(self):
         self.client = OpenAI(api_key=OPENAI_API_KEY)
     
-    def encode_image(self, image_path: str) -> str:
-        """Кодирует изображение в base64"""
+    async def encode_image(self, image_path: str) -> str:
+        """Кодирует изображение в base64 (вне цикла событий)"""
         try:
-            with open(image_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+            return await offloader.run_in_thread(encode_base64, photo_store.read(image_path))
         except Exception as e:
             logger.error(f"Ошибка при кодировании изображения: {e}")
             raise
@@ -31,7 +37,7 @@ class OpenAIService:
         """
         try:
             # Кодируем изображение
-            base64_image = self.encode_image(image_path)
+            base64_image = await self.encode_image(image_path)
             
             prompt = f"""
             Проанализируй это изображение еды и определи:
@@ -60,7 +66,9 @@ class OpenAIService:
             Будь максимально точным в расчетах, основываясь на визуальной оценке порции.
             """
             
-            response = self.client.chat.completions.create(
+            # Клиент OpenAI синхронный - выполняем запрос в потоке, не блокируя event loop
+            response = await asyncio.to_thread(
+                self.client.chat.completions.create,
                 model="gpt-4o",
                 messages=[
                     {
@@ -83,6 +91,10 @@ class OpenAIService:
             
             return response.choices[0].message.content
             
+        except APIConnectionError as e:
+            logger.error(f"Ошибка соединения с OpenAI: {e}")
+            raise GeminiRetryableError(f"ошибка соединения: {e!r}") from e
         except Exception as e:
             logger.error(f"Ошибка при анализе еды через OpenAI: {e}")
-            return f"Произошла ошибка при анализе изображения: {str(e)}"
+            # У ответов API с ошибкой есть status_code - по нему circuit breaker отличает 5xx от 4xx
+            raise GeminiServiceError(str(e), status=getattr(e, 'status_code', None)) from e
@@ -371,13 +371,10 @@ class PaymentService:
                 
             elif product == "multi_dish_24h":
                 # Временно активируем мульти-тарелку на 24 часа
-                from firebase_admin import firestore
-                user_ref = self.subscription_service.firebase_service.db.collection('users').document(str(user_id))
-                
                 expire_time = datetime.now() + timedelta(hours=24)
-                user_ref.update({
+                await self.subscription_service.firebase_service.update_user(user_id, {
                     'temp_multi_dish_expires': expire_time
-                })
+                }, 'activate_multi_dish_24h', immediate=True)
                 
                 await self.bot.send_message(
                     user_id,
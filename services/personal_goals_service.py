@@ -155,10 +155,9 @@ class PersonalGoalsService:
             }
             
             # Сохраняем в Firebase
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.set({
+            await self.firebase_service.merge_user(user_id, {
                 'personal_goal': goal_data
-            }, merge=True)
+            }, 'set_user_goal')
             
             logger.info(f"Установлена цель {goal_type} для пользователя {user_id}")
             return True
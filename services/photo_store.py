@@ -0,0 +1,179 @@
+import io
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from config import (
+    PHOTO_STORE_MAX_BYTES,
+    PHOTO_STORE_MAX_PHOTO_BYTES,
+    PHOTO_STORE_MAX_PER_USER,
+    PHOTO_STORE_TTL_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Префикс ссылок на фото в памяти (остальные ссылки - пути к файлам)
+PHOTO_REF_PREFIX = "mem://"
+
+
+class PhotoTooLargeError(ValueError):
+    """Фото больше допустимого размера буфера"""
+
+
+class BoundedBuffer(io.BytesIO):
+    """BytesIO с ограничением размера: скачивание прерывается, как только фото превысит лимит"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def write(self, data) -> int:
+        if self.tell() + len(data) > self.max_bytes:
+            raise PhotoTooLargeError(f"фото больше {self.max_bytes} байт")
+        return super().write(data)
+
+
+def is_photo_ref(image_path: str) -> bool:
+    """Ссылка на фото в памяти (а не путь к файлу)"""
+    return isinstance(image_path, str) and image_path.startswith(PHOTO_REF_PREFIX)
+
+
+class PhotoStore:
+    """Фото пользователей в памяти вместо временных файлов
+
+    Скачанное фото хранится в буфере, в состоянии FSM лежит только ссылка
+    вида mem://<user_id>/<id>, которую провайдеры анализа получают вместо
+    пути к файлу. Объем ограничен: на пользователя - max_per_user последних
+    фото, всего - max_bytes (вытесняются давно не использованные), записи
+    старше ttl_seconds удаляются. Так забытые фото не копятся, как файлы
+    в TEMP_DIR, которые убирались только при запуске бота.
+    """
+
+    def __init__(self, max_bytes: int = PHOTO_STORE_MAX_BYTES, max_photo_bytes: int = PHOTO_STORE_MAX_PHOTO_BYTES,
+                 max_per_user: int = PHOTO_STORE_MAX_PER_USER, ttl_seconds: int = PHOTO_STORE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_photo_bytes = max_photo_bytes
+        self.max_per_user = max_per_user
+        self.ttl_seconds = ttl_seconds
+
+        # ссылка -> {'user_id', 'data', 'created_at'} (порядок = порядок использования)
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._total_bytes = 0
+
+        self._stats = {
+            'stored': 0,
+            'bytes_stored': 0,
+            'reads': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def new_buffer(self) -> BoundedBuffer:
+        """Буфер для скачивания фото с лимитом max_photo_bytes"""
+        return BoundedBuffer(self.max_photo_bytes)
+
+    def put(self, user_id: int, data: bytes) -> str:
+        """
+        Сохраняет фото пользователя
+
+        Returns:
+            ссылка на фото для состояния FSM и провайдеров анализа
+
+        Raises:
+            PhotoTooLargeError: фото больше max_photo_bytes
+        """
+        if len(data) > self.max_photo_bytes:
+            raise PhotoTooLargeError(f"фото больше {self.max_photo_bytes} байт")
+
+        self._expire()
+        ref = f"{PHOTO_REF_PREFIX}{user_id}/{uuid.uuid4().hex}"
+        self._entries[ref] = {'user_id': user_id, 'data': bytes(data), 'created_at': time.monotonic()}
+        self._total_bytes += len(data)
+        self._stats['stored'] += 1
+        self._stats['bytes_stored'] += len(data)
+
+        user_refs = self._user_refs(user_id)
+        for old_ref in user_refs[:-self.max_per_user]:
+            self._remove(old_ref)
+            self._stats['evictions'] += 1
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats['evictions'] += 1
+            logger.info(f"Буфер фото переполнен, вытеснено фото {oldest}")
+        return ref
+
+    def get(self, ref: str) -> Optional[bytes]:
+        """Содержимое фото по ссылке или None, если фото удалено или устарело"""
+        entry = self._entries.get(ref)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+        if time.monotonic() - entry['created_at'] > self.ttl_seconds:
+            self._remove(ref)
+            self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return None
+        self._entries.move_to_end(ref)
+        self._stats['reads'] += 1
+        return entry['data']
+
+    def exists(self, ref: str) -> bool:
+        """Есть ли еще фото по ссылке"""
+        if is_photo_ref(ref):
+            entry = self._entries.get(ref)
+            return entry is not None and time.monotonic() - entry['created_at'] <= self.ttl_seconds
+        return False
+
+    def read(self, image_path: str) -> bytes:
+        """
+        Байты фото по ссылке из буфера или по пути к файлу
+
+        Raises:
+            FileNotFoundError: фото уже удалено из буфера
+        """
+        if not is_photo_ref(image_path):
+            with open(image_path, "rb") as image_file:
+                return image_file.read()
+        data = self.get(image_path)
+        if data is None:
+            raise FileNotFoundError(f"Фото {image_path} больше нет в буфере")
+        return data
+
+    def discard(self, ref: str):
+        """Удаляет фото после анализа"""
+        if ref in self._entries:
+            self._remove(ref)
+
+    def discard_user(self, user_id: int):
+        """Удаляет все фото пользователя (отмена, новое фото)"""
+        for ref in self._user_refs(user_id):
+            self._remove(ref)
+
+    def _user_refs(self, user_id: int) -> List[str]:
+        return [ref for ref, entry in self._entries.items() if entry['user_id'] == user_id]
+
+    def _remove(self, ref: str):
+        entry = self._entries.pop(ref)
+        self._total_bytes -= len(entry['data'])
+
+    def _expire(self):
+        border = time.monotonic() - self.ttl_seconds
+        for ref in [ref for ref, entry in self._entries.items() if entry['created_at'] < border]:
+            self._remove(ref)
+            self._stats['expirations'] += 1
+
+    def get_stats(self) -> Dict:
+        """Фото и байты в буфере, вытеснения по лимиту и TTL"""
+        return {
+            **self._stats,
+            'photos': len(self._entries),
+            'bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+# Глобальный буфер фото пользователей
+photo_store = PhotoStore()
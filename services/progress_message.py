@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from config import TELEGRAM_EDIT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины текста сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ProgressMessage:
+    """Сообщение-заглушка, которое обновляется по мере генерации ответа
+
+    Правки сообщения прореживаются: не чаще одной за min_interval секунд,
+    промежуточные версии текста пропускаются, последняя показывается
+    отложенной правкой. TelegramRetryAfter сдвигает следующую правку.
+    """
+
+    def __init__(self, message: Message, header: str = "", min_interval: float = TELEGRAM_EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self._shown_text = message.text or ""
+        self._pending_text: Optional[str] = None
+        self._next_edit_at = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._finished = False
+        self.edits = 0
+
+    @classmethod
+    async def create(cls, reply_to: Message, placeholder: str, header: str = "") -> "ProgressMessage":
+        """Отправляет заглушку и возвращает объект для ее обновления"""
+        message = await reply_to.answer(placeholder)
+        return cls(message, header)
+
+    async def update(self, text: str):
+        """Показывает промежуточный текст (с прореживанием правок)"""
+        if self._finished:
+            return
+        self._pending_text = f"{self.header}{text}"[:MAX_MESSAGE_LENGTH]
+        delay = self._next_edit_at - time.monotonic()
+        if delay <= 0:
+            await self._flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            text = self._pending_text
+            self._pending_text = None
+            if self._finished or not text or text == self._shown_text:
+                return
+            await self._edit(text)
+
+    async def _edit(self, text: str, parse_mode: Optional[str] = None) -> bool:
+        try:
+            await self.message.edit_text(text, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram ограничил правки сообщения на {e.retry_after} с")
+            self._next_edit_at = time.monotonic() + e.retry_after
+            return False
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return True
+            logger.warning(f"Не удалось обновить сообщение: {e}")
+            return False
+        self._shown_text = text
+        self._next_edit_at = time.monotonic() + self.min_interval
+        self.edits += 1
+        return True
+
+    async def finish(self, text: str, parse_mode: Optional[str] = "Markdown"):
+        """Заменяет заглушку итоговым текстом (или отправляет его новым сообщением)"""
+        self._finished = True
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+
+        async with self._lock:
+            wait = self._next_edit_at - time.monotonic()
+            if 0 < wait <= self.min_interval:
+                # Последнюю правку не пропускаем - ждем окончания интервала
+                await asyncio.sleep(wait)
+            if len(text) <= MAX_MESSAGE_LENGTH:
+                if await self._edit(text, parse_mode):
+                    return
+                if parse_mode and await self._edit(text):
+                    return
+        try:
+            await self.message.answer(text, parse_mode=parse_mode)
+        except Exception as e:
+            logger.warning(f"Ошибка отправки с {parse_mode}: {e}")
+            await self.message.answer(text)
@@ -98,10 +98,9 @@ class ReminderService:
     async def update_user_reminders(self, user_id: int, reminder_settings: Dict) -> bool:
         """Обновляет настройки напоминаний пользователя"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.set({
+            await self.firebase_service.merge_user(user_id, {
                 'reminders': reminder_settings
-            }, merge=True)
+            }, 'update_user_reminders')
             
             logger.info(f"Настройки напоминаний обновлены для пользователя {user_id}")
             return True
@@ -151,10 +150,9 @@ class ReminderService:
             if reminder_type == ReminderType.CALORIE_LIMIT:
                 # Добавляем информацию о текущих калориях
                 today = datetime.now().strftime('%Y-%m-%d')
-                analyses = await self.firebase_service.get_daily_analyses(user_id, today)
+                daily_nutrition = await self.firebase_service.get_daily_nutrition(user_id, today)
                 
-                if analyses:
-                    daily_nutrition = await self.firebase_service.aggregate_daily_nutrition(analyses)
+                if daily_nutrition['meals']:
                     current_calories = daily_nutrition.get('calories', 0)
                     
                     # Получаем цель пользователя
@@ -229,10 +227,9 @@ class ReminderService:
     async def update_last_reminder_time(self, user_id: int):
         """Обновляет время последнего напоминания"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.set({
+            await self.firebase_service.merge_user(user_id, {
                 'reminders.last_reminder_sent': datetime.now()
-            }, merge=True)
+            }, 'update_last_reminder_time')
             
         except Exception as e:
             logger.error(f"Ошибка обновления времени напоминания: {e}")
@@ -283,11 +280,10 @@ class ReminderService:
             # Получаем данные пользователя
             goal = await self.personal_goals_service.get_user_goal(user_id)
             today = datetime.now().strftime('%Y-%m-%d')
-            analyses = await self.firebase_service.get_daily_analyses(user_id, today)
+            daily_nutrition = await self.firebase_service.get_daily_nutrition(user_id, today)
             
             # Генерируем персонализированное мотивационное сообщение
-            if goal and analyses:
-                daily_nutrition = await self.firebase_service.aggregate_daily_nutrition(analyses)
+            if goal and daily_nutrition['meals']:
                 current_calories = daily_nutrition.get('calories', 0)
                 daily_target = goal.get('daily_calories', 2000)
                 
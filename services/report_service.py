@@ -22,17 +22,14 @@ class ReportService:
             user_info = await self.firebase.get_user_info(user_id)
             user_display = self._get_user_display_name(user_info, user_id)
             
-            # Получаем анализы за день
-            analyses = await self.firebase.get_daily_analyses(user_id, date)
+            # Итоги дня из сводки (один документ вместо всех анализов дня)
+            total_nutrition = await self.firebase.get_daily_nutrition(user_id, date)
             
-            if not analyses:
+            if not total_nutrition['meals']:
                 return f"📅 Итоги дня ({date})\n👤 {user_display}\n\n❌ За этот день не было записей о питании."
             
-            # Агрегируем данные
-            total_nutrition = await self.firebase.aggregate_daily_nutrition(analyses)
-            
             # Формируем отчет
-            report = await self._format_daily_report(user_id, date, total_nutrition, len(analyses), user_display)
+            report = await self._format_daily_report(user_id, date, total_nutrition, total_nutrition['meals'], user_display)
             return report
             
         except Exception as e:
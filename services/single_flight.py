@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from .analysis_provider import ProgressCallback
+from .photo_store import photo_store
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику в лог (в вызовах)
+STATS_LOG_INTERVAL = 50
+
+
+def file_digest(path: str) -> Optional[str]:
+    """SHA-256 содержимого фото (одинаковые фото от разных пользователей дают один ключ)"""
+    try:
+        return hashlib.sha256(photo_store.read(path)).hexdigest()
+    except OSError as e:
+        logger.warning(f"Не удалось вычислить хэш фото {path}: {e}")
+        return None
+
+
+class SingleFlight:
+    """Объединение одновременных одинаковых запросов в один
+
+    Пока запрос с таким ключом выполняется, новые вызовы ждут его результат
+    (или ошибку) вместо повторного обращения к модели. Промежуточный текст
+    получают все ожидающие. Отмена одного ожидающего не отменяет запрос для
+    остальных; запрос отменяется, только когда его больше никто не ждет.
+    """
+
+    def __init__(self):
+        # ключ -> {'task', 'waiters', 'listeners'}
+        self._flights: Dict[Hashable, Dict] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def run(self, key: Tuple, compute: Callable[[ProgressCallback], Awaitable],
+                  on_progress: Optional[ProgressCallback] = None):
+        """
+        Выполняет compute один раз для всех одновременных вызовов с ключом key
+
+        Args:
+            key: кортеж, первый элемент - имя операции (для метрик)
+            compute: фабрика корутины, принимает колбэк промежуточного текста
+            on_progress: колбэк промежуточного текста этого вызова
+        """
+        stats = self._stats.setdefault(str(key[0]), {'calls': 0, 'shared': 0, 'cancelled': 0})
+        stats['calls'] += 1
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = {'waiters': 0, 'listeners': []}
+            listeners: List[ProgressCallback] = flight['listeners']
+
+            async def fan_out(text: str):
+                for listener in list(listeners):
+                    try:
+                        await listener(text)
+                    except Exception as e:
+                        logger.warning(f"Ошибка колбэка промежуточного текста: {e}")
+
+            flight['task'] = asyncio.create_task(compute(fan_out))
+            flight['task'].add_done_callback(lambda task: self._on_done(key, task))
+            self._flights[key] = flight
+        else:
+            stats['shared'] += 1
+            logger.info(f"Запрос {key[0]} уже выполняется, ждем общий результат")
+
+        flight['waiters'] += 1
+        if on_progress:
+            flight['listeners'].append(on_progress)
+        self._log_stats()
+        try:
+            return await asyncio.shield(flight['task'])
+        except asyncio.CancelledError:
+            if not flight['task'].done():
+                stats['cancelled'] += 1
+                if on_progress in flight['listeners']:
+                    flight['listeners'].remove(on_progress)
+                if flight['waiters'] == 1:
+                    # Результат больше никому не нужен: убираем запрос сразу, чтобы
+                    # новый вызов с тем же ключом не присоединился к отменяемой задаче
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                    flight['task'].cancel()
+            raise
+        finally:
+            flight['waiters'] -= 1
+
+    def _on_done(self, key: Hashable, task: asyncio.Task):
+        if self._flights.get(key, {}).get('task') is task:
+            del self._flights[key]
+        # Забираем исключение, даже если результат никто не дождался
+        if not task.cancelled():
+            task.exception()
+
+    def _log_stats(self):
+        total = sum(s['calls'] for s in self._stats.values())
+        if total % STATS_LOG_INTERVAL:
+            return
+        shared = sum(s['shared'] for s in self._stats.values())
+        logger.info(f"Объединение запросов: {shared} из {total} вызовов ({shared / total * 100:.1f}%) "
+                    f"получили результат уже идущего запроса")
+
+    def get_stats(self) -> Dict:
+        """Метрики по операциям: вызовы, объединенные вызовы (сэкономленные запросы), отмены"""
+        operations = {op: dict(stats) for op, stats in self._stats.items()}
+        return {
+            'operations': operations,
+            'calls': sum(s['calls'] for s in operations.values()),
+            'shared': sum(s['shared'] for s in operations.values()),
+            'in_flight': len(self._flights),
+        }
+
+
+# Глобальный экземпляр объединения запросов анализа
+single_flight = SingleFlight()
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from config import (
+    SPECULATIVE_ANALYSIS_ENABLED,
+    SPECULATIVE_MAX_RESCALE_RATIO,
+    SPECULATIVE_TTL_SECONDS,
+)
+from utils import extract_portion_weight, rescale_analysis_text
+from .analysis_provider import ProgressCallback
+from .analysis_router import analysis_router
+from .nutrition_schema import scale_nutrition, render_analysis_text
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeAnalysisManager:
+    """Анализ фото с автоопределением веса, запущенный до ответа пользователя
+
+    Пока пользователь вводит вес, модель уже разбирает фото. Введенный вес
+    применяется локальным пересчетом, если он не слишком далек от оценки
+    модели (иначе нужен обычный анализ с весом). На пользователя хранится
+    одна задача: новое фото или /cancel ее отменяют. Счетчик анализов
+    увеличивает обработчик, который использовал результат, - отмененные
+    и неиспользованные задачи в лимит не засчитываются.
+    """
+
+    def __init__(self, enabled: bool = SPECULATIVE_ANALYSIS_ENABLED,
+                 max_rescale_ratio: float = SPECULATIVE_MAX_RESCALE_RATIO,
+                 ttl_seconds: int = SPECULATIVE_TTL_SECONDS):
+        self.enabled = enabled
+        self.max_rescale_ratio = max_rescale_ratio
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[int, Dict] = {}
+        self._stats = {
+            'started': 0,
+            'cancelled': 0,
+            'expired': 0,
+            'failed': 0,
+            'used': 0,
+            'rescaled': 0,
+            'fallbacks': 0,
+            'waited': 0,
+        }
+
+    def start(self, user_id: int, photo_path: str, file_unique_id: Optional[str] = None,
+              subscription_type: Optional[str] = None):
+        """Запускает анализ фото в фоне (предыдущий анализ пользователя отменяется)"""
+        if not self.enabled:
+            return
+        self.cancel(user_id)
+        self._drop_expired()
+
+        entry = {
+            'photo_path': photo_path,
+            'created_at': time.monotonic(),
+            'listener': None,
+        }
+
+        async def forward_progress(text: str):
+            if entry['listener']:
+                await entry['listener'](text)
+
+        entry['task'] = asyncio.create_task(analysis_router.analyze_food_auto_weight(
+            photo_path,
+            file_unique_id=file_unique_id,
+            user_id=user_id,
+            subscription_type=subscription_type,
+            on_progress=forward_progress
+        ))
+        entry['task'].add_done_callback(self._on_done)
+        self._entries[user_id] = entry
+        self._stats['started'] += 1
+        logger.info(f"Запущен упреждающий анализ фото пользователя {user_id}")
+
+    def _on_done(self, task: asyncio.Task):
+        # Забираем исключение, чтобы оно не попало в лог как необработанное
+        if not task.cancelled() and task.exception() is not None:
+            self._stats['failed'] += 1
+            logger.warning(f"Упреждающий анализ не удался: {task.exception()}")
+
+    def cancel(self, user_id: int) -> bool:
+        """Отменяет фоновый анализ пользователя (новое фото, /cancel)"""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        if not entry['task'].done():
+            entry['task'].cancel()
+            self._stats['cancelled'] += 1
+            logger.info(f"Упреждающий анализ пользователя {user_id} отменен")
+        return True
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for user_id in [uid for uid, entry in self._entries.items()
+                        if now - entry['created_at'] > self.ttl_seconds]:
+            self.cancel(user_id)
+            self._stats['expired'] += 1
+
+    def has(self, user_id: int, photo_path: str) -> bool:
+        """Есть ли фоновый анализ этого фото"""
+        entry = self._entries.get(user_id)
+        return entry is not None and entry['photo_path'] == photo_path
+
+    async def take(self, user_id: int, photo_path: str, weight_grams: Optional[int] = None,
+                   on_progress: Optional[ProgressCallback] = None) -> Optional[Dict]:
+        """
+        Забирает результат фонового анализа для фото
+
+        Args:
+            user_id: ID пользователя
+            photo_path: фото из состояния FSM (результат для другого фото не подходит)
+            weight_grams: введенный вес (None - нужен результат с автоопределением веса)
+            on_progress: колбэк промежуточного текста, если анализ еще идет
+
+        Returns:
+            {'analysis_text', 'nutrition'} или None, если нужен обычный анализ
+        """
+        if not self.has(user_id, photo_path):
+            return None
+        entry = self._entries.pop(user_id)
+
+        task = entry['task']
+        if not task.done():
+            self._stats['waited'] += 1
+            # Промежуточный текст с оценкой веса показываем, только если вес не указан
+            if weight_grams is None:
+                entry['listener'] = on_progress
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+
+        if weight_grams is not None:
+            result = self._rescale(result, weight_grams)
+            if result is None:
+                self._stats['fallbacks'] += 1
+                return None
+            self._stats['rescaled'] += 1
+        self._stats['used'] += 1
+        return result
+
+    def _rescale(self, result: Dict, weight_grams: int) -> Optional[Dict]:
+        """Пересчитывает анализ под введенный вес или возвращает None, если оценка слишком далека"""
+        nutrition = result['nutrition']
+        estimated = (nutrition or {}).get('weight') or extract_portion_weight(result['analysis_text'])
+        if not estimated:
+            return None
+
+        factor = weight_grams / estimated
+        if not 1 / self.max_rescale_ratio <= factor <= self.max_rescale_ratio:
+            logger.info(f"Вес {weight_grams} г слишком далек от оценки модели ({estimated} г), нужен анализ с весом")
+            return None
+
+        if nutrition:
+            scaled = scale_nutrition(nutrition, factor, weight_grams)
+            return {'analysis_text': render_analysis_text(scaled), 'nutrition': scaled}
+        return {'analysis_text': rescale_analysis_text(result['analysis_text'], factor, weight_grams),
+                'nutrition': None}
+
+    def get_stats(self) -> Dict:
+        """Метрики упреждающего анализа"""
+        stats = dict(self._stats)
+        stats['pending'] = len(self._entries)
+        return stats
+
+
+# Глобальный менеджер упреждающего анализа
+speculative_analysis = SpeculativeAnalysisManager()
@@ -121,7 +121,6 @@ class SubscriptionService:
     async def _init_user_subscription(self, user_id: int):
         """Инициализирует подписку для нового пользователя"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
             subscription_data = {
                 'subscription_type': 'lite',
                 'subscription_status': 'active',
@@ -131,7 +130,7 @@ class SubscriptionService:
                 'last_reset_date': datetime.now(timezone.utc).strftime('%Y-%m-%d'),
                 'created_at': datetime.now(timezone.utc)
             }
-            user_ref.set(subscription_data, merge=True)
+            await self.firebase_service.merge_user(user_id, subscription_data, '_init_user_subscription')
             logger.info(f"Инициализирована подписка Lite для пользователя {user_id}")
             
         except Exception as e:
@@ -175,11 +174,10 @@ class SubscriptionService:
     async def _reset_daily_counters(self, user_id: int):
         """Сбрасывает дневные счетчики"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.firebase_service.update_user(user_id, {
                 'daily_photo_count': 0,
                 'last_reset_date': datetime.now(timezone.utc).strftime('%Y-%m-%d')
-            })
+            }, '_reset_daily_counters')
             logger.info(f"Сброшены дневные счетчики для пользователя {user_id}")
             
         except Exception as e:
@@ -188,12 +186,11 @@ class SubscriptionService:
     async def _downgrade_to_lite(self, user_id: int):
         """Переводит пользователя на план Lite"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.firebase_service.update_user(user_id, {
                 'subscription_type': 'lite',
                 'subscription_status': 'active',
                 'subscription_end_date': None,
-            })
+            }, '_downgrade_to_lite')
             logger.info(f"Пользователь {user_id} переведен на план Lite")
             
         except Exception as e:
@@ -218,14 +215,24 @@ class SubscriptionService:
             logger.error(f"Ошибка проверки лимитов: {e}")
             return False, "Ошибка проверки лимитов"
 
-    async def increment_photo_count(self, user_id: int) -> bool:
-        """Увеличивает счетчик анализов фото"""
+    async def remaining_daily_photos(self, user_id: int) -> int:
+        """Сколько фото пользователь еще может проанализировать сегодня (для альбомов)"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.update({
-                'daily_photo_count': firestore.Increment(1),
-                'monthly_photo_count': firestore.Increment(1),
-            })
+            subscription = await self.get_user_subscription(user_id)
+            limits = self.PLAN_LIMITS[SubscriptionType(subscription['type'])]
+            return max(0, limits['daily_photos'] - subscription['daily_photo_count'])
+            
+        except Exception as e:
+            logger.error(f"Ошибка проверки лимитов: {e}")
+            return 0
+
+    async def increment_photo_count(self, user_id: int, count: int = 1) -> bool:
+        """Увеличивает счетчик анализов фото (count - фото в альбоме)"""
+        try:
+            await self.firebase_service.update_user(user_id, {
+                'daily_photo_count': firestore.Increment(count),
+                'monthly_photo_count': firestore.Increment(count),
+            }, 'increment_photo_count', immediate=True)
             return True
             
         except Exception as e:
@@ -275,14 +282,13 @@ class SubscriptionService:
             # Устанавливаем триал на 7 дней
             end_date = datetime.now(timezone.utc) + timedelta(days=7)
             
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.firebase_service.update_user(user_id, {
                 'subscription_type': 'trial',
                 'subscription_status': 'active',
                 'subscription_end_date': end_date,
                 'trial_used': True,
                 'trial_start_date': datetime.now(timezone.utc)
-            })
+            }, 'start_trial', immediate=True)
             
             logger.info(f"Запущен триал для пользователя {user_id}")
             return True
@@ -296,13 +302,12 @@ class SubscriptionService:
         try:
             end_date = datetime.now(timezone.utc) + timedelta(days=30 * duration_months)
             
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
-            user_ref.update({
+            await self.firebase_service.update_user(user_id, {
                 'subscription_type': 'pro',
                 'subscription_status': 'active',
                 'subscription_end_date': end_date,
                 'pro_activated_at': datetime.now(timezone.utc)
-            })
+            }, 'activate_pro_subscription', immediate=True)
             
             logger.info(f"Активирована Pro подписка на {duration_months} мес. для пользователя {user_id}")
             return True
@@ -314,14 +319,13 @@ class SubscriptionService:
     async def add_stars_analyses(self, user_id: int, count: int) -> bool:
         """Добавляет дополнительные анализы за Stars"""
         try:
-            user_ref = self.firebase_service.db.collection('users').document(str(user_id))
             user_data = await self.firebase_service.get_user_info(user_id)
             
             current_bonus = user_data.get('bonus_analyses', 0)
-            user_ref.update({
+            await self.firebase_service.update_user(user_id, {
                 'bonus_analyses': current_bonus + count,
                 'last_stars_purchase': datetime.now(timezone.utc)
-            })
+            }, 'add_stars_analyses', immediate=True)
             
             logger.info(f"Добавлено {count} бонусных анализов для пользователя {user_id}")
             return True
@@ -333,9 +337,8 @@ class SubscriptionService:
     async def save_payment(self, payment_data: Dict) -> bool:
         """Сохраняет информацию о платеже"""
         try:
-            payments_ref = self.firebase_service.db.collection('payments')
             payment_data['created_at'] = datetime.now(timezone.utc)
-            payments_ref.add(payment_data)
+            await self.firebase_service.add_document('payments', payment_data, 'save_payment')
             
             logger.info(f"Сохранен платеж для пользователя {payment_data.get('user_id')}")
             return True
@@ -352,6 +355,13 @@ class SubscriptionService:
         except (ValueError, KeyError):
             return self.PLAN_LIMITS[SubscriptionType.LITE]
 
+    def get_queue_tier(self, subscription_type: str) -> str:
+        """Возвращает очередь запросов к Gemini: тарифы без priority_queue идут в общую очередь Lite"""
+        limits = self.get_plan_limits(subscription_type)
+        if limits.get('priority_queue'):
+            return subscription_type
+        return SubscriptionType.LITE.value
+
     def get_pricing_info(self) -> Dict:
         """Возвращает информацию о ценах"""
         return {
@@ -0,0 +1,161 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from config import (
+    USER_CACHE_ENABLED,
+    USER_CACHE_MAX_SIZE,
+    USER_CACHE_TTL_SECONDS,
+)
+from .user_context import apply_user_write, WRITE_UPDATE
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику кэша в лог (в обращениях)
+STATS_LOG_INTERVAL = 500
+
+
+class UserDocumentCache:
+    """LRU кэш документов users/{id} с TTL на весь процесс бота
+
+    Чтение идет через кэш (read-through): промах читает документ из
+    Firestore и кладет его в кэш. Записи бота (update_user, merge_user,
+    коммит отложенных записей апдейта) после успеха применяются к записи
+    кэша (write-through), поэтому Pro после оплаты виден сразу. Изменения
+    в обход бота (консоль Firebase, другой экземпляр) видны не позже чем
+    через ttl_seconds. Чтение, начатое до записи, не кладет в кэш старый
+    документ: у каждого пользователя есть номер поколения.
+
+    Устаревание: при перечитывании истекшей записи документ из Firestore
+    сравнивается с закэшированным - если они разные, кэш отдавал старые
+    данные (изменение в обход бота), это считается в stale_refreshes.
+    Записи, измененные ботом после чтения, не сравниваются: даты, записанные
+    локально, отличаются от прочитанных из Firestore типом, а не значением.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_MAX_SIZE, ttl_seconds: float = USER_CACHE_TTL_SECONDS,
+                 enabled: bool = USER_CACHE_ENABLED):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        # user_id -> {'document', 'loaded_at', 'expired', 'written'} (порядок = порядок использования)
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        # user_id -> поколение (растет при каждой записи)
+        self._generations: Dict[int, int] = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expirations': 0,
+            'evictions': 0,
+            'stores': 0,
+            'write_through': 0,
+            'invalidations': 0,
+            'stale_refreshes': 0,
+            'stale_loads_dropped': 0,
+            'max_hit_age': 0.0,
+            'hit_age_total': 0.0,
+        }
+
+    def get(self, user_id: int) -> Tuple[bool, Optional[Dict]]:
+        """
+        Ищет документ пользователя
+
+        Returns:
+            (найден, копия документа или None, если документа нет в Firestore)
+        """
+        if not self.enabled:
+            return False, None
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self._count('misses')
+            return False, None
+        age = time.monotonic() - entry['loaded_at']
+        if age > self.ttl_seconds:
+            # Запись остается до перечитывания, чтобы сравнить ее с новым документом
+            entry['expired'] = True
+            self._stats['expirations'] += 1
+            self._count('misses')
+            return False, None
+        self._entries.move_to_end(user_id)
+        self._stats['hit_age_total'] += age
+        self._stats['max_hit_age'] = max(self._stats['max_hit_age'], age)
+        self._count('hits')
+        return True, copy.deepcopy(entry['document'])
+
+    def generation(self, user_id: int) -> int:
+        """Поколение пользователя перед чтением из Firestore (передается в put)"""
+        return self._generations.get(user_id, 0)
+
+    def put(self, user_id: int, document: Optional[Dict], generation: int):
+        """Кладет прочитанный из Firestore документ (None - документа нет)"""
+        if not self.enabled:
+            return
+        if generation != self.generation(user_id):
+            # Пока документ читался, бот его изменил - прочитанное могло устареть
+            self._stats['stale_loads_dropped'] += 1
+            return
+        previous = self._entries.get(user_id)
+        if (previous is not None and previous.get('expired') and not previous.get('written')
+                and previous['document'] != document):
+            self._stats['stale_refreshes'] += 1
+        self._entries[user_id] = {'document': copy.deepcopy(document), 'loaded_at': time.monotonic()}
+        self._entries.move_to_end(user_id)
+        self._stats['stores'] += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def apply_writes(self, user_id: int, writes: List[Tuple[str, Dict]]):
+        """Применяет успешные записи бота к закэшированному документу"""
+        self._generations[user_id] = self.generation(user_id) + 1
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        document = entry['document']
+        for kind, data in writes:
+            if document is None:
+                if kind == WRITE_UPDATE:
+                    # update несуществующего документа - состояние Firestore неизвестно
+                    self.invalidate(user_id)
+                    return
+                document = {}
+            apply_user_write(document, kind, data)
+        entry['document'] = document
+        entry['written'] = True
+        self._stats['write_through'] += 1
+
+    def invalidate(self, user_id: int):
+        """Удаляет документ пользователя (после неудачной или неизвестной записи)"""
+        self._generations[user_id] = self.generation(user_id) + 1
+        if self._entries.pop(user_id, None) is not None:
+            self._stats['invalidations'] += 1
+
+    def _count(self, counter: str):
+        self._stats[counter] += 1
+        lookups = self._stats['hits'] + self._stats['misses']
+        if lookups % STATS_LOG_INTERVAL == 0:
+            stats = self.get_stats()
+            logger.info(f"Кэш пользователей: {stats['hits']}/{stats['lookups']} попаданий "
+                        f"({stats['hit_rate']:.1f}%), записей: {stats['size']}, "
+                        f"устаревших при перечитывании: {stats['stale_refreshes']}")
+
+    def get_stats(self) -> Dict:
+        """Попадания и промахи (каждое попадание - сэкономленное чтение Firestore), возраст и устаревание"""
+        lookups = self._stats['hits'] + self._stats['misses']
+        return {
+            **self._stats,
+            'lookups': lookups,
+            'hit_rate': (self._stats['hits'] / lookups * 100) if lookups else 0.0,
+            'avg_hit_age': self._stats['hit_age_total'] / self._stats['hits'] if self._stats['hits'] else 0.0,
+            'size': len(self._entries),
+        }
+
+    def clear(self):
+        """Очищает кэш"""
+        self._entries.clear()
+        self._generations.clear()
+
+
+# Глобальный кэш документов пользователей
+user_document_cache = UserDocumentCache()
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+# Как часто писать статистику в лог (в апдейтах)
+STATS_LOG_INTERVAL = 200
+
+# Виды отложенных записей: update (ключи - пути через точку) и set с merge=True
+WRITE_UPDATE = 'update'
+WRITE_MERGE = 'merge'
+
+
+def apply_user_write(document: Dict, kind: str, data: Dict):
+    """Применяет запись Firestore к локальной копии документа (Increment, Maximum, DELETE_FIELD, вложенные поля)"""
+    for key, value in data.items():
+        path = key.split('.') if kind == WRITE_UPDATE else [key]
+        target = document
+        for part in path[:-1]:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        field = path[-1]
+        if value is firestore.DELETE_FIELD:
+            target.pop(field, None)
+        elif isinstance(value, firestore.Increment):
+            target[field] = (target.get(field) or 0) + value.value
+        elif isinstance(value, firestore.Maximum):
+            target[field] = max(target.get(field) or value.value, value.value)
+        elif isinstance(value, dict):
+            if kind == WRITE_UPDATE or not isinstance(target.get(field), dict):
+                target[field] = {}
+            apply_user_write(target[field], WRITE_MERGE, value)
+        else:
+            target[field] = value
+
+
+class UserContext:
+    """Документ users/{id} на время обработки одного апдейта
+
+    Документ читается из Firestore один раз - при первом обращении -
+    и дальше get_user_info отдает его копию. Записи в документ не уходят
+    в Firestore сразу: они применяются к копии (следующие чтения их видят)
+    и записываются одним batch-коммитом в конце апдейта. Записи оплат,
+    подписки и лимитов (immediate=True в update_user/merge_user) уходят
+    сразу вместе с отложенными до них - до ответа пользователю.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.document: Optional[Dict] = None
+        self.exists = False
+        self.writes: List[Tuple[str, Dict]] = []
+        self.reads = 0
+        self.hits = 0
+        self.staged = 0
+        self.flushes = 0
+        self.closed = False
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.document is not None
+
+    async def get(self, load: Callable[[], Awaitable[Optional[Dict]]]) -> Dict:
+        """
+        Возвращает копию документа, читая его через load() только в первый раз
+
+        Args:
+            load: чтение документа из Firestore (None - документа нет)
+        """
+        async with self._load_lock:
+            if self.document is None:
+                data = await load()
+                self.reads += 1
+                self.exists = data is not None
+                self.document = data or {}
+                # Записи, сделанные до чтения, применяются поверх прочитанного
+                for kind, write in self.writes:
+                    apply_user_write(self.document, kind, write)
+            else:
+                self.hits += 1
+        return dict(self.document)
+
+    def stage(self, kind: str, data: Dict):
+        """Откладывает запись до конца апдейта и применяет ее к копии документа"""
+        self.writes.append((kind, data))
+        self.staged += 1
+        if self.document is not None:
+            apply_user_write(self.document, kind, data)
+
+    def take_writes(self) -> List[Tuple[str, Dict]]:
+        """Забирает отложенные записи для коммита"""
+        writes, self.writes = self.writes, []
+        return writes
+
+    def mark_flushed(self):
+        """Отложенные записи сохранены до конца апдейта: документ уже существует"""
+        self.flushes += 1
+        self.exists = True
+
+    def discard_document(self):
+        """Копия содержит несохраненные записи - при следующем обращении документ перечитается"""
+        self.document = None
+        self.exists = False
+
+
+_current_context: ContextVar[Optional[UserContext]] = ContextVar('user_context', default=None)
+
+
+def current_user_context(user_id: int) -> Optional[UserContext]:
+    """Контекст апдейта, если сейчас обрабатывается апдейт этого пользователя"""
+    context = _current_context.get()
+    if context is None or context.closed or context.user_id != user_id:
+        return None
+    return context
+
+
+class UserDocumentMiddleware(BaseMiddleware):
+    """Контекст пользователя на каждый апдейт и запись отложенных изменений в конце
+
+    Регистрируется как outer-middleware апдейтов (после встроенного
+    middleware aiogram, который определяет event_from_user). Обработчики
+    могут получить контекст параметром user_context. Фоновые задачи,
+    пережившие апдейт, работают с Firestore напрямую. Если записи в конце
+    апдейта не сохранились, ошибка пробрасывается диспетчеру (кроме случая,
+    когда упал сам обработчик - тогда пробрасывается его ошибка).
+    """
+
+    def __init__(self, firebase_service):
+        self.firebase_service = firebase_service
+        self._stats = {'updates': 0, 'firestore_reads': 0, 'context_hits': 0, 'writes': 0, 'commits': 0,
+                       'failed_commits': 0}
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user: Optional[User] = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        context = UserContext(user.id)
+        token = _current_context.set(context)
+        data['user_context'] = context
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            await self._finish(context, token, raise_errors=False)
+            raise
+        await self._finish(context, token, raise_errors=True)
+        return result
+
+    async def _finish(self, context: UserContext, token, raise_errors: bool):
+        """Закрывает контекст и записывает оставшиеся отложенные записи"""
+        context.closed = True
+        _current_context.reset(token)
+        writes = context.take_writes()
+        try:
+            if writes:
+                self._stats['commits'] += 1
+                await self.firebase_service.commit_user_writes(context.user_id, writes)
+        except Exception as e:
+            self._stats['failed_commits'] += 1
+            fields = ', '.join(key for _, data in writes for key in data)
+            logger.error(f"Записи апдейта пользователя {context.user_id} не сохранены ({fields}): {e}")
+            if raise_errors:
+                raise
+        finally:
+            self._record(context)
+
+    def _record(self, context: UserContext):
+        self._stats['updates'] += 1
+        self._stats['firestore_reads'] += context.reads
+        self._stats['context_hits'] += context.hits
+        self._stats['writes'] += context.staged
+        self._stats['commits'] += context.flushes
+        if self._stats['updates'] % STATS_LOG_INTERVAL == 0:
+            stats = self.get_stats()
+            logger.info(f"Контекст пользователя: {stats['updates']} апдейтов, "
+                        f"{stats['reads_per_update']:.2f} чтений и {stats['commits_per_update']:.2f} "
+                        f"коммитов на апдейт, из контекста {stats['context_hits']} чтений, "
+                        f"неудачных коммитов: {stats['failed_commits']}")
+
+    def get_stats(self) -> Dict:
+        """Чтения документа пользователя из Firestore и из контекста, отложенные записи и коммиты"""
+        updates = self._stats['updates']
+        return {
+            **self._stats,
+            'reads_per_update': self._stats['firestore_reads'] / updates if updates else 0.0,
+            'commits_per_update': self._stats['commits'] / updates if updates else 0.0,
+        }
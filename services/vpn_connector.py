@@ -3,6 +3,7 @@ import logging
 import asyncio
 import subprocess
 from typing import Optional
+from .http_session import http_session_manager
 
 logger = logging.getLogger(__name__)
 
@@ -50,7 +51,7 @@ class VPNConnector:
             return False
     
     async def create_vpn_session(self) -> Optional[aiohttp.ClientSession]:
-        """Создает HTTP сессию, которая использует VPN"""
+        """Возвращает общую HTTP сессию, которая использует VPN"""
         try:
             # Проверяем VPN подключение
             if not await self.is_vpn_connected():
@@ -60,20 +61,13 @@ class VPNConnector:
             # Добавляем маршрут для Google API
             await self.add_route_for_host("generativelanguage.googleapis.com")
             
-            # Создаем коннектор с привязкой к VPN интерфейу
-            connector = aiohttp.TCPConnector(
-                local_addr=await self._get_vpn_local_ip(),
-                limit=10,
-                limit_per_host=5
-            )
-            
-            session = aiohttp.ClientSession(
-                connector=connector,
-                timeout=aiohttp.ClientTimeout(total=60)
-            )
+            # Берем общую сессию из пула с привязкой к VPN интерфейсу
+            # (сессия живет весь процесс, закрывать ее после запроса не нужно)
+            vpn_local_ip = await self._get_vpn_local_ip()
+            if not vpn_local_ip:
+                return None
             
-            logger.info("Создана VPN HTTP сессия")
-            return session
+            return http_session_manager.get_session(local_addr=vpn_local_ip)
             
         except Exception as e:
             logger.error(f"Ошибка создания VPN сессии: {e}")
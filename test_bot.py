@@ -11,6 +11,7 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from handlers import register_handlers
 from config import TEMP_DIR
 from utils import setup_logging, clean_temp_files
+from services.http_session import http_session_manager
 
 # Настройка логирования
 setup_logging()
@@ -59,6 +60,7 @@ async def main():
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally:
+        await http_session_manager.close()
         await bot.session.close()
         logger.info("Бот остановлен")
 
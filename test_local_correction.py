@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Тесты разбора исправлений, которые считаются без модели (services/local_correction.py)
+"""
+import sys
+from services.local_correction import LocalCorrectionEngine
+
+ANALYSIS = (
+    "ПРОДУКТЫ: гречка (~200 г), курица (~100 г)\n"
+    "\n"
+    "ПИЩЕВАЯ ЦЕННОСТЬ (300 г):\n"
+    "- Калории: 450 ккал\n"
+    "- Белки: 30 г\n"
+    "- Жиры: 12 г\n"
+    "- Углеводы: 54 г"
+)
+
+
+def _correct(correction: str):
+    return LocalCorrectionEngine().correct(ANALYSIS, correction)
+
+
+def test_one_and_a_half_portions():
+    """"полторы" не режется словом "пол" """
+    for correction in ("полторы порции", "полторы"):
+        result = _correct(correction)
+        assert result is not None, correction
+        assert result['kind'] == 'portion'
+        assert result['weight'] == 450
+
+
+def test_half_portion():
+    for correction in ("половина", "пол порции", "полпорции"):
+        result = _correct(correction)
+        assert result is not None, correction
+        assert result['weight'] == 150
+
+
+def test_multiplier():
+    for correction in ("x2", "х2", "× 2"):
+        result = _correct(correction)
+        assert result is not None, correction
+        assert result['kind'] == 'portion'
+        assert result['weight'] == 600
+
+
+def test_times_more_or_less():
+    assert _correct("в 2 раза больше")['weight'] == 600
+    assert _correct("в три раза меньше")['weight'] == 100
+    # Ноль раз - не исправление порции
+    assert _correct("в 0 раз больше") is None
+
+
+def test_weight_not_x_but_y():
+    result = _correct("Вес не 300г, а 200г")
+    assert result is not None
+    assert result['kind'] == 'weight'
+    assert result['weight'] == 200
+    assert "300 ккал" in result['analysis_text']
+
+
+def test_meaningful_correction_goes_to_model():
+    """Замена продукта не считается локально, даже если в тексте есть вес"""
+    assert _correct("это не курица, а индейка 200г") is None
+    assert _correct("добавь хлеб") is None
+
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith('test_')]
+    failed = 0
+    for test_func in tests:
+        try:
+            test_func()
+            print(f"✅ {test_func.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test_func.__name__}: {e}")
+    print(f"📊 Результаты: {len(tests) - failed}/{len(tests)} тестов пройдено")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Тесты сервисов, которые работают без Firebase и Gemini: сводки дня,
+локальная копия документа пользователя, объединение запросов, проверка
+структурированного ответа модели
+"""
+import sys
+import asyncio
+from firebase_admin import firestore
+from services.daily_rollup import rollup_change, rollup_increment
+from services.user_context import apply_user_write, WRITE_UPDATE, WRITE_MERGE
+from services.single_flight import SingleFlight
+from services.gemini_errors import GeminiServiceError
+from services.nutrition_schema import (
+    MAX_VITAMIN_PERCENT,
+    validate_nutrition,
+    merge_nutrition,
+    render_analysis_text,
+)
+
+
+def _nutrition(calories=300, vitamins=None):
+    return {'calories': calories, 'proteins': 20, 'fats': 10, 'carbs': 30, 'vitamins': vitamins or {}}
+
+
+def test_rollup_increment():
+    update = rollup_increment(_nutrition(vitamins={'C': 40}), '2025-01-01')
+    assert update['meals'].value == 1
+    assert update['calories'].value == 300
+    assert isinstance(update['vitamins']['C'], firestore.Maximum)
+
+
+def test_rollup_change_applies_difference():
+    update = rollup_change(_nutrition(300), _nutrition(450), '2025-01-01')
+    assert update['calories'].value == 150
+    assert update['proteins'].value == 0
+    assert 'meals' not in update
+    assert 'needs_rebuild' not in update
+
+
+def test_rollup_change_lowered_vitamin_needs_rebuild():
+    """Максимум витамина нельзя уменьшить приращением"""
+    update = rollup_change(_nutrition(vitamins={'C': 80}), _nutrition(vitamins={'C': 20}), '2025-01-01')
+    assert update['needs_rebuild'] is True
+    update = rollup_change(_nutrition(vitamins={'C': 80}), _nutrition(), '2025-01-01')
+    assert update['needs_rebuild'] is True
+    update = rollup_change(_nutrition(vitamins={'C': 20}), _nutrition(vitamins={'C': 80}), '2025-01-01')
+    assert 'needs_rebuild' not in update
+
+
+def test_apply_user_write_update_nests_dotted_keys():
+    document = {'subscription': {'type': 'free', 'trial_used': True}}
+    apply_user_write(document, WRITE_UPDATE, {'subscription.type': 'pro', 'stats.photos': firestore.Increment(2)})
+    assert document['subscription'] == {'type': 'pro', 'trial_used': True}
+    assert document['stats'] == {'photos': 2}
+
+
+def test_apply_user_write_merge_keeps_dotted_keys_literal():
+    """set(merge=True) не разбирает точки: "a.b" - это имя поля"""
+    document = {'subscription': {'type': 'free'}}
+    apply_user_write(document, WRITE_MERGE, {'subscription.type': 'pro', 'subscription': {'until': 'x'}})
+    assert document['subscription.type'] == 'pro'
+    assert document['subscription'] == {'type': 'free', 'until': 'x'}
+
+
+def test_apply_user_write_update_replaces_map_and_deletes():
+    document = {'goals': {'calories': 2000, 'proteins': 100}, 'temp': 1}
+    apply_user_write(document, WRITE_UPDATE, {'goals': {'calories': 1800}, 'temp': firestore.DELETE_FIELD})
+    assert document == {'goals': {'calories': 1800}}
+
+
+def test_single_flight_shares_result():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def compute(on_progress):
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        results = await asyncio.gather(*(flights.run(('op', 'key'), compute) for _ in range(3)))
+        assert results == ['result'] * 3
+        assert len(calls) == 1
+        assert flights.get_stats()['shared'] == 2
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_cancellation():
+    """Отмена одного ожидающего не отменяет запрос; отмена последнего - отменяет и освобождает ключ"""
+    async def scenario():
+        flights = SingleFlight()
+        started = []
+
+        async def compute(on_progress):
+            started.append(1)
+            await asyncio.sleep(0.05)
+            return len(started)
+
+        first = asyncio.create_task(flights.run(('op', 'key'), compute))
+        second = asyncio.create_task(flights.run(('op', 'key'), compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 1
+
+        last = asyncio.create_task(flights.run(('op', 'key'), compute))
+        await asyncio.sleep(0)
+        last.cancel()
+        try:
+            await last
+        except asyncio.CancelledError:
+            pass
+        # Ключ свободен сразу: новый вызов запускает новый запрос, а не ждет отмененный
+        assert flights.get_stats()['in_flight'] == 0
+        assert await flights.run(('op', 'key'), compute) == 3
+
+    asyncio.run(scenario())
+
+
+def _response(**overrides):
+    data = {
+        'products': [
+            {'name': 'гречка', 'grams': 200, 'calories': 220, 'proteins': 8, 'fats': 2, 'carbs': 44},
+            {'name': 'курица', 'grams': 100, 'calories': 165, 'proteins': 31, 'fats': 3.6, 'carbs': 0},
+        ],
+        'total_weight_grams': 300,
+        'calories': 385,
+        'proteins': 39,
+        'fats': 5.6,
+        'carbs': 44,
+        'vitamins': [{'name': 'B1', 'percent': 25}],
+        'confidence': 0.9,
+    }
+    data.update(overrides)
+    return data
+
+
+def _rejected(data) -> bool:
+    try:
+        validate_nutrition(data)
+    except GeminiServiceError:
+        return True
+    return False
+
+
+def test_validate_nutrition():
+    nutrition = validate_nutrition(_response())
+    assert nutrition['weight'] == 300
+    assert nutrition['calories'] == 385
+    assert nutrition['vitamins'] == {'B1': 25}
+    assert nutrition['confidence'] == 0.9
+    assert [p['name'] for p in nutrition['products']] == ['гречка', 'курица']
+    # Вес, указанный пользователем, важнее оценки модели
+    assert validate_nutrition(_response(), weight_grams=250)['weight'] == 250
+
+
+def test_validate_nutrition_rejects_bad_values():
+    assert _rejected([])
+    assert _rejected(_response(products=[]))
+    assert _rejected(_response(calories=-1))
+    assert _rejected(_response(calories='385'))
+    assert _rejected(_response(proteins=True))
+    assert _rejected(_response(vitamins=[{'name': 'C', 'percent': MAX_VITAMIN_PERCENT + 1}]))
+
+
+def test_validate_nutrition_uses_products_sum():
+    """Итог, не сходящийся с суммой по продуктам, заменяется суммой"""
+    nutrition = validate_nutrition(_response(calories=900))
+    assert nutrition['calories'] == 385
+    assert nutrition['proteins'] == 39
+
+
+def test_merge_nutrition_clamps_vitamins():
+    part = validate_nutrition(_response(vitamins=[{'name': 'C', 'percent': 1500}]))
+    merged = merge_nutrition([part, part])
+    assert merged['vitamins']['C'] == MAX_VITAMIN_PERCENT
+    assert merged['weight'] == 600
+
+
+def test_render_without_weight():
+    nutrition = {**validate_nutrition(_response()), 'weight': None}
+    text = render_analysis_text(nutrition, auto_weight=True)
+    assert 'None' not in text
+    assert 'ПИЩЕВАЯ ЦЕННОСТЬ:' in text
+
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith('test_')]
+    failed = 0
+    for test_func in tests:
+        try:
+            test_func()
+            print(f"✅ {test_func.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test_func.__name__}: {e}")
+    print(f"📊 Результаты: {len(tests) - failed}/{len(tests)} тестов пройдено")
+    sys.exit(1 if failed else 0)
@@ -1,8 +1,9 @@
 import os
+import re
 import logging
 from datetime import datetime
 from functools import wraps
-from typing import Callable, Any
+from typing import Callable, Any, Dict, List, Optional
 
 def setup_logging():
     """Настройка системы логирования"""
@@ -194,9 +195,14 @@ def format_nutrition_info(analysis_text: str) -> str:
     
     return formatted
 
-def extract_meal_title(analysis_text: str) -> str:
-    """Извлекает краткое название блюда из текста анализа."""
+def extract_meal_title(analysis_text: str, nutrition: Optional[Dict] = None) -> str:
+    """Извлекает краткое название блюда из текста анализа (или из структурированного ответа)."""
     try:
+        # В структурированном ответе продукты уже перечислены, текст разбирать не нужно
+        if nutrition and nutrition.get('products'):
+            products = sorted(nutrition['products'], key=lambda p: p.get('grams', 0), reverse=True)
+            return ', '.join(p['name'].capitalize() for p in products[:2])
+        
         text = analysis_text or ""
         lines = [l.strip() for l in text.split('\n') if l.strip()]
         if not lines:
@@ -294,3 +300,132 @@ def _extract_main_products(text: str) -> str:
         return ' '.join(filtered_words[:3])  # Максимум 3 слова
     
     return None
+
+# Маркеры строк с КБЖУ в тексте анализа
+NUTRIENT_MARKERS = {
+    'Калории': 'calories',
+    'Белки': 'proteins',
+    'Жиры': 'fats',
+    'Углеводы': 'carbs',
+}
+_NUTRIENT_VALUE_RE = re.compile(r'(:\**\s*)(\d+(?:[.,]\d+)?)')
+_VITAMIN_LINE_RE = re.compile(r'- \**([^:*]+)\**:\s*\**\s*(\d+)\s*%')
+_VITAMIN_VALUE_RE = re.compile(r'(:\s*\**\s*)(\d+)(\s*%)')
+_WEIGHT_RE = re.compile(r'(\d+)\s*(?:г|гр|g)(?![А-Яа-яA-Za-z])')
+_NUTRITION_HEADER_RE = re.compile(r'(ПИЩЕВАЯ ЦЕННОСТЬ\s*)\([^)\n]*\)')
+# Продукты через запятую (запятые в скобках не разделяют): "курица (~150 г), рис (~100 г)"
+_PRODUCT_SPLIT_RE = re.compile(r',\s*(?![^()]*\))')
+_PRODUCT_RE = re.compile(r'^(.+?)\s*\(\s*~?\s*(\d+)\s*(?:г|гр|g)(?![А-Яа-яA-Za-z])[^)]*\)')
+
+def _find_nutrient(line: str) -> Optional[str]:
+    """Возвращает ключ нутриента, если строка содержит КБЖУ"""
+    for marker, key in NUTRIENT_MARKERS.items():
+        if marker in line and ':' in line:
+            return key
+    return None
+
+def _format_amount(value: float, integer: bool = False) -> str:
+    """Форматирует число без лишних нулей после запятой"""
+    if integer:
+        return str(int(round(value)))
+    rounded = round(value, 1)
+    return str(int(rounded)) if rounded == int(rounded) else str(rounded)
+
+def parse_products(products_text: str) -> List[Dict]:
+    """Разбирает список продуктов "название (~N г), ..." в [{'name', 'grams'}] (grams - если указан вес)"""
+    products = []
+    for item in _PRODUCT_SPLIT_RE.split(products_text.strip(' *.[]')):
+        item = item.strip(' *.')
+        if not item:
+            continue
+        match = _PRODUCT_RE.match(item)
+        if match:
+            products.append({'name': match.group(1).strip(' *'), 'grams': int(match.group(2))})
+        else:
+            products.append({'name': item})
+    return products
+
+def parse_nutrition_values(analysis_text: str) -> Dict:
+    """Извлекает калории, БЖУ, витамины (% нормы) и продукты из текста анализа"""
+    nutrition = {
+        'calories': 0,
+        'proteins': 0,
+        'fats': 0,
+        'carbs': 0,
+        'vitamins': {},
+        'products': []
+    }
+    
+    products_pending = False
+    for line in (analysis_text or '').split('\n'):
+        line = line.strip()
+        if products_pending and line:
+            products_pending = False
+            if not (_find_nutrient(line) or 'ПИЩЕВАЯ ЦЕННОСТЬ' in line.upper()):
+                # Список продуктов на следующей строке после "ПРОДУКТЫ:"
+                nutrition['products'] = parse_products(line)
+                continue
+        key = _find_nutrient(line)
+        if key:
+            match = _NUTRIENT_VALUE_RE.search(line)
+            if match and not nutrition[key]:
+                value = float(match.group(2).replace(',', '.'))
+                nutrition[key] = int(value) if key == 'calories' else value
+        elif 'ПРОДУКТЫ' in line.upper() and ':' in line and not nutrition['products']:
+            products_text = line.split(':', 1)[1]
+            if products_text.strip(' *'):
+                nutrition['products'] = parse_products(products_text)
+            else:
+                products_pending = True
+        elif line.startswith('-') and '%' in line:
+            match = _VITAMIN_LINE_RE.search(line)
+            if match:
+                nutrition['vitamins'][match.group(1).strip()] = int(match.group(2))
+    
+    return nutrition
+
+def extract_portion_weight(analysis_text: str) -> Optional[int]:
+    """Извлекает вес порции (указанный или примерный) из текста анализа"""
+    for line in (analysis_text or '').split('\n'):
+        upper = line.upper()
+        if 'ПРИМЕРНЫЙ ВЕС' in upper or 'ПИЩЕВАЯ ЦЕННОСТЬ' in upper:
+            match = _WEIGHT_RE.search(line)
+            if match and int(match.group(1)) > 0:
+                return int(match.group(1))
+    return None
+
+def rescale_analysis_text(analysis_text: str, factor: float, new_weight: Optional[int] = None) -> str:
+    """
+    Пересчитывает калории, БЖУ и % витаминов в тексте анализа с коэффициентом factor
+    
+    Args:
+        analysis_text: исходный текст анализа
+        factor: во сколько раз изменилась порция
+        new_weight: новый вес порции для заголовка (строка примерного веса убирается)
+    """
+    lines = []
+    for line in (analysis_text or '').split('\n'):
+        upper = line.upper()
+        if 'ПИЩЕВАЯ ЦЕННОСТЬ' in upper:
+            if new_weight is not None:
+                line = _NUTRITION_HEADER_RE.sub(lambda m: f"{m.group(1)}({new_weight} г)", line)
+        elif new_weight is not None and 'ПРИМЕРНЫЙ ВЕС' in upper:
+            # Вместе со строкой убираем и пустую строку перед ней
+            if lines and not lines[-1].strip():
+                lines.pop()
+            continue
+        elif _find_nutrient(line):
+            is_calories = _find_nutrient(line) == 'calories'
+            line = _NUTRIENT_VALUE_RE.sub(
+                lambda m: m.group(1) + _format_amount(float(m.group(2).replace(',', '.')) * factor, integer=is_calories),
+                line,
+                count=1
+            )
+        elif line.strip().startswith('-') and '%' in line:
+            line = _VITAMIN_VALUE_RE.sub(
+                lambda m: m.group(1) + _format_amount(int(m.group(2)) * factor, integer=True) + m.group(3),
+                line,
+                count=1
+            )
+        lines.append(line)
+    return '\n'.join(lines)